@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+
+# ==============================================================================
+# DỒN TÍCH DOANH THU / CHI PHÍ THEO NGÀY (ACCRUAL)
+# Giá thuê (Giá) và giá HĐ chủ (Giá HĐ) là giá theo THÁNG. Mỗi kỳ chỉ ghi nhận
+# phần ngày thực sự nằm trong kỳ: tiền = giá x số ngày phủ / số ngày của tháng.
+# Tính một lần cho toàn bộ (dòng x kỳ) bằng broadcasting NumPy.
+# ==============================================================================
+
+MODE_FULL = "Đủ giá tháng"
+MODE_ACCRUAL = "Dồn tích theo ngày"
+MODES = [MODE_FULL, MODE_ACCRUAL]
+
+
+def month_bounds(year, months):
+    starts = pd.DatetimeIndex([pd.Timestamp(year, m, 1) for m in months])
+    ends = starts + pd.offsets.MonthEnd(0)
+    return starts, ends
+
+
+def covered_days(df, col_start, col_end, starts, ends):
+    # Ma trận (số dòng x số kỳ): số ngày khoảng [col_start, col_end] nằm trong từng kỳ
+    s = df[col_start].to_numpy(dtype='datetime64[D]')[:, None]
+    e = df[col_end].to_numpy(dtype='datetime64[D]')[:, None]
+    p_s = starts.to_numpy(dtype='datetime64[D]')[None, :]
+    p_e = ends.to_numpy(dtype='datetime64[D]')[None, :]
+
+    valid = ~(np.isnat(s) | np.isnat(e))
+    lo = np.where(s > p_s, s, p_s)
+    hi = np.where(e < p_e, e, p_e)
+    days = (hi - lo).astype('timedelta64[D]').astype(np.int64) + 1
+    return np.where(valid & (days > 0), days, 0)
+
+
+def accrue(df, col_start, col_end, col_amount, starts, ends):
+    # Trả về (tiền dồn tích, số ngày) dạng DataFrame: index = index của df, cột = ngày đầu kỳ
+    days = covered_days(df, col_start, col_end, starts, ends)
+    month_len = ends.days_in_month.to_numpy(dtype=float)[None, :]
+    price = pd.to_numeric(df[col_amount], errors='coerce').fillna(0).to_numpy(dtype=float)[:, None]
+    amount = price * days / month_len
+    return (pd.DataFrame(amount, index=df.index, columns=starts),
+            pd.DataFrame(days, index=df.index, columns=starts))
+
+
+def accrue_contracts(df_main, starts, ends, stages=None):
+    # Dồn tích cả hai phía cho mọi dòng HOP_DONG: chi phí chủ nhà và doanh thu khách.
+    # stages (schedule.StageIndex): HĐ có giá theo giai đoạn -> dồn tích từng giai đoạn rồi cộng về dòng
+    if stages is not None and len(stages):
+        own = stages.expand(df_main.reset_index(drop=True))     # index = vị trí dòng gốc
+        cost, cost_days = accrue(own, 'Ngày ký', 'Ngày hết HĐ', 'Giá HĐ', starts, ends)
+        cost = cost.groupby(level=0).sum().set_axis(df_main.index)
+        cost_days = cost_days.groupby(level=0).sum().set_axis(df_main.index)
+    else:
+        cost, cost_days = accrue(df_main, 'Ngày ký', 'Ngày hết HĐ', 'Giá HĐ', starts, ends)
+    rev, rev_days = accrue(df_main, 'Ngày in', 'Ngày out', 'Giá', starts, ends)
+    return {'cost': cost, 'cost_days': cost_days, 'rev': rev, 'rev_days': rev_days}
@@ -0,0 +1,170 @@
+import os
+import re
+import threading
+
+import pandas as pd
+
+import commission
+import revisions
+import storage
+from core import normalize_hop_dong
+
+# ==============================================================================
+# PHÂN MẢNH NÓNG / LẠNH CỦA HOP_DONG
+# - HOP_DONG (nóng): HĐ còn hiệu lực và HĐ mới đóng trong khoảng horizon ngày gần đây
+# - HOP_DONG_<năm> (lạnh): dòng đã đóng hẳn (ngày kết thúc muộn nhất < hôm nay - horizon),
+#   chia theo năm đóng. Luồng nền chuyển dòng sang khi tải lại; app không sửa mảnh lạnh.
+# - Báo cáo chỉ đọc các mảnh lạnh khi khoảng thời gian cần tới (mảnh năm >= năm bắt đầu),
+#   mảnh đã đọc được giữ trong bộ nhớ tiến trình cho tới lần chuyển kế tiếp.
+# Cấu hình: MT60_ARCHIVE_HORIZON_DAYS hoặc Secrets "archive_horizon_days". Mặc định 0 = tắt: bật là luồng nền
+# ghi lại HOP_DONG trên kho nên phải chủ động chọn. Tắt mà kho vẫn còn mảnh năm (đã chuyển trước đó) -> vẫn đọc.
+# ==============================================================================
+
+ARCHIVE_PREFIX = "HOP_DONG_"
+DEFAULT_HORIZON_DAYS = 0
+# Tối thiểu hơn 1 năm: năm hiện tại, cảnh báo và trợ lý luôn chỉ cần mảnh nóng
+MIN_HORIZON_DAYS = 400
+ARCHIVE_USER = "(lưu trữ tự động)"    # người sửa ghi vào nhật ký cho lần chuyển dòng
+
+_SHARD_RE = re.compile(rf"^{ARCHIVE_PREFIX}(\d{{4}})$")
+
+
+def get_horizon_days(secrets=None):
+    def _secret(key):
+        try:
+            return secrets[key] if secrets is not None and key in secrets else None
+        except Exception:
+            return None
+
+    value = os.environ.get("MT60_ARCHIVE_HORIZON_DAYS") or _secret("archive_horizon_days")
+    days = int(value) if value not in (None, "") else DEFAULT_HORIZON_DAYS
+    return 0 if days <= 0 else max(days, MIN_HORIZON_DAYS)
+
+
+def shard_name(year):
+    return f"{ARCHIVE_PREFIX}{year}"
+
+
+def shard_year(name):
+    m = _SHARD_RE.match(str(name))
+    return int(m.group(1)) if m else None
+
+
+def closed_rows(df_norm, cutoff):
+    # (mask dòng đã đóng trước cutoff, ngày kết thúc muộn nhất của dòng)
+    df = df_norm.reindex(columns=['Toà', 'Ngày ký', 'Ngày hết HĐ', 'Ngày in', 'Ngày out'])
+    end = df[['Ngày hết HĐ', 'Ngày out']].max(axis=1)
+    # Đã bắt đầu mà chưa có ngày kết thúc -> còn mở, không chuyển
+    dang_mo = (df['Ngày ký'].notna() & df['Ngày hết HĐ'].isna()) | (df['Ngày in'].notna() & df['Ngày out'].isna())
+    co_toa = df['Toà'].fillna('').astype(str).str.strip() != ''
+    return (end.notna() & (end < cutoff) & ~dang_mo & co_toa).to_numpy(), end
+
+
+def split_hot_cold(df_raw, cutoff):
+    # Bảng thô HOP_DONG -> (phần nóng, {năm đóng: phần lạnh}); giữ nguyên giá trị thô để ghi lại
+    mask, end = closed_rows(normalize_hop_dong(df_raw.copy()), cutoff)
+    if not mask.any(): return df_raw, {}
+    cold = df_raw[mask]
+    years = end[mask].dt.year.to_numpy()
+    return df_raw[~mask].reset_index(drop=True), {int(y): g.reset_index(drop=True) for y, g in cold.groupby(years)}
+
+
+def _merge_new_rows(existing, rows):
+    # Nối dòng mới vào mảnh, bỏ dòng đã có sẵn (chuyển lại sau khi ai đó lưu từ bản cũ)
+    cols = list(dict.fromkeys(list(existing.columns) + list(rows.columns)))
+    ex = existing.reindex(columns=cols).fillna("").astype(str)
+    new = rows.reindex(columns=cols).fillna("").astype(str)
+    seen = set(map(tuple, ex.to_numpy().tolist()))
+    keep = [tuple(r) not in seen for r in new.to_numpy().tolist()]
+    return pd.concat([ex, new[keep]], ignore_index=True), int(sum(keep))
+
+
+class Archive:
+    def __init__(self, backend, horizon_days=DEFAULT_HORIZON_DAYS, tab_name="HOP_DONG", journal=None):
+        self.backend = backend
+        self.journal = journal  # journal.Journal (tùy chọn): ghi lần chuyển dòng như một lần lưu
+        self.horizon_days = horizon_days
+        self.tab_name = tab_name
+        self._lock = threading.Lock()
+        self._years = []
+        self._frames = {}       # năm -> bảng đã chuẩn hóa (đã đọc)
+        self.generation = 0     # tăng mỗi lần chuyển dòng sang kho lạnh
+
+    @property
+    def enabled(self):
+        return self.horizon_days > 0
+
+    @property
+    def readable(self):
+        # Có mảnh lạnh để đọc (kể cả khi đã tắt việc chuyển dòng)
+        return self.enabled or bool(self._years)
+
+    @property
+    def years(self):
+        return list(self._years)
+
+    @property
+    def version(self):
+        return f"a{self.generation}:{','.join(map(str, self._years))}"
+
+    def cutoff(self, today):
+        return pd.Timestamp(today).normalize() - pd.Timedelta(days=self.horizon_days)
+
+    def _read_raw(self, tab_name):
+        return revisions.frame_of(self.backend.get_all_values(tab_name))
+
+    def refresh_names(self):
+        years = sorted(y for y in (shard_year(n) for n in self.backend.worksheet_names()) if y is not None)
+        with self._lock:
+            if years != self._years:
+                self._years = years
+                self._frames = {y: f for y, f in self._frames.items() if y in years}
+
+    def archive_closed(self, df_raw, today):
+        # Chuyển dòng đã đóng sang mảnh năm rồi ghi lại HOP_DONG nóng. Trả về (HOP_DONG mới, số dòng chuyển)
+        if not self.enabled or df_raw.empty or commission.has_legacy(df_raw): return df_raw, 0
+        hot, cold = split_hot_cold(df_raw, self.cutoff(today))
+        if not cold: return df_raw, 0
+        # Chỉ ghi khi HOP_DONG trên kho vẫn đúng phiên bản vừa tải (không đè lên lần lưu của người khác)
+        version = revisions.sheet_version(df_raw)
+        if revisions.values_version(self.backend.values_or_empty(self.tab_name)) != version: return df_raw, 0
+
+        moved = 0
+        for year, rows in cold.items():
+            name = shard_name(year)
+            existing = self._read_raw(name) if year in self._years else pd.DataFrame()
+            merged, n = _merge_new_rows(existing, rows)
+            if n: self.backend.update(name, storage.frame_to_values(merged))
+            moved += len(rows)
+        # Ghi có điều kiện như save_data: có người vừa lưu sau lượt kiểm tra trên -> bỏ lần chuyển này.
+        # Mảnh năm đã ghi thì không sao: dòng còn ở mảnh nóng chỉ được tính một lần (Snapshot._cold_rows),
+        # lần chuyển sau không nối trùng (_merge_new_rows)
+        hot_values = storage.frame_to_values(hot)
+        ok, _ = self.backend.update_if_version(self.tab_name, hot_values, version, revisions.values_version)
+        if not ok: return df_raw, 0
+        # hot tách từ df_raw nên mang theo phiên bản cũ trong attrs -> đặt lại theo đúng giá trị vừa ghi
+        hot.attrs[revisions.VERSION_ATTR] = revisions.values_version(hot_values)
+        if self.journal is not None: self.journal.record(self.tab_name, df_raw, hot, ARCHIVE_USER)
+        with self._lock:
+            self._years = sorted(set(self._years) | set(cold))
+            for y in cold: self._frames.pop(y, None)
+            self.generation += 1
+        return hot, moved
+
+    def load(self, years):
+        # Mảnh lạnh của các năm yêu cầu (đọc song song các mảnh chưa có trong bộ nhớ)
+        years = [y for y in years if y in self._years]
+        need = [y for y in years if y not in self._frames]
+        if need:
+            results, _ = storage.fetch_all(self._read_raw, [shard_name(y) for y in need])
+            with self._lock:
+                for y in need:
+                    r = results[shard_name(y)]
+                    if not isinstance(r, Exception): self._frames[y] = normalize_hop_dong(r, shard_name(y))
+        parts = [self._frames[y] for y in years if y in self._frames and not self._frames[y].empty]
+        return pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+
+    def rows_since(self, start):
+        # Dòng lạnh có thể chạm tới khoảng từ start: dòng đóng vào năm >= năm của start
+        start_year = pd.Timestamp(start).year
+        return self.load([y for y in self._years if y >= start_year])
@@ -0,0 +1,211 @@
+import importlib.util
+import json
+import os
+import threading
+from collections import OrderedDict
+
+import pandas as pd
+
+import portfolio
+from core import fmt_vnd
+from search import normalize_text
+
+# ==============================================================================
+# TRỢ LÝ "HỎI DỮ LIỆU"
+# Mô hình chỉ nhận bản tóm tắt đã tổng hợp (tổng theo tháng, theo Tòa, top phòng
+# lãi / lỗ, nhóm cảnh báo) - vài KB JSON, không bao giờ gửi cả sheet HOP_DONG.
+# Câu trả lời được nhớ theo (câu hỏi đã chuẩn hóa, phiên bản dữ liệu).
+# Client có thể thay: GeminiClient (online) hoặc StubClient (offline, cố định để kiểm thử).
+# ==============================================================================
+
+CLIENT_GEMINI = "gemini"
+CLIENT_STUB = "stub"
+DEFAULT_MODEL = "gemini-2.0-flash"
+TOP_N = 10
+MAX_ROOMS_PER_ALERT = 20
+CACHE_SIZE = 256
+
+PERIOD_MONTH, PERIOD_QUARTER, PERIOD_YEAR = "thang_nay", "quy_nay", "nam_nay"
+
+ALERT_LABELS = {
+    'hd_het_han': "HĐ chủ hết hạn / sắp hết (≤ 30 ngày)",
+    'khach_sap_ra': "Khách sắp trả phòng (≤ 7 ngày)",
+    'trong_co_hd': "Phòng trống - đang gánh phí HĐ chủ",
+    'trong_khong_hd': "Phòng trống - không có HĐ chủ",
+}
+
+SYSTEM_PROMPT = (
+    "Bạn là trợ lý phân tích dữ liệu cho công ty cho thuê căn hộ MT60. "
+    "Chỉ dùng số liệu trong phần DỮ LIỆU (JSON, đơn vị VND) để trả lời, bằng tiếng Việt, ngắn gọn. "
+    "Lãi/lỗ của phòng = giá thuê khách - giá HĐ chủ (đủ giá tháng, chưa gồm chi phí vận hành). "
+    "Nếu dữ liệu không đủ để trả lời, hãy nói rõ là không có trong dữ liệu."
+)
+
+
+# --- TÓM TẮT DỮ LIỆU ---
+def _period_start(today, period):
+    if period == PERIOD_MONTH: return pd.Timestamp(today.year, today.month, 1)
+    if period == PERIOD_QUARTER: return pd.Timestamp(today.year, (today.month - 1) // 3 * 3 + 1, 1)
+    return pd.Timestamp(today.year, 1, 1)
+
+
+def _room_ranking(df_facts, start, end):
+    f = df_facts[(df_facts['Tháng'] >= start) & (df_facts['Tháng'] <= end)] if not df_facts.empty else df_facts
+    if f.empty: return {'lo_nhieu_nhat': [], 'lai_nhieu_nhat': []}
+    g = f.groupby(['Toà', 'Mã căn'], as_index=False)[['Giá thuê', 'Giá HĐ']].sum()
+    g['Lãi/lỗ'] = g['Giá thuê'] - g['Giá HĐ']
+    g = g[(g['Giá thuê'] != 0) | (g['Giá HĐ'] != 0)].sort_values(['Lãi/lỗ', 'Toà', 'Mã căn'])
+    rows = lambda d: [{'toa': r['Toà'], 'ma_can': r['Mã căn'], 'thu': int(r['Giá thuê']), 'tra_chu': int(r['Giá HĐ']), 'lai_lo': int(r['Lãi/lỗ'])}
+                      for _, r in d.iterrows()]
+    return {'lo_nhieu_nhat': rows(g[g['Lãi/lỗ'] < 0].head(TOP_N)),
+            'lai_nhieu_nhat': rows(g[g['Lãi/lỗ'] > 0].iloc[::-1].head(TOP_N))}
+
+
+def alert_buckets(df_main, today):
+    # Cùng tiêu chí với thanh bên: gom theo phòng rồi so với hôm nay
+    if df_main.empty: return {k: [] for k in ALERT_LABELS}
+    g = df_main.groupby(['Toà', 'Mã căn']).agg(
+        ky=('Ngày ký', 'min'), het=('Ngày hết HĐ', 'max'), vao=('Ngày in', 'min'), ra=('Ngày out', 'max'))
+    has_owner = (g['ky'] <= today) & (g['het'] >= today)
+    has_tenant = (g['vao'] <= today) & (g['ra'] >= today)
+    masks = {
+        'hd_het_han': (g['het'] - today).dt.days.between(-999, 30),
+        'khach_sap_ra': (g['ra'] - today).dt.days.between(0, 7),
+        'trong_co_hd': ~has_tenant & has_owner,
+        'trong_khong_hd': ~has_tenant & ~has_owner,
+    }
+    return {k: [f"{toa}/{can}" for toa, can in g.index[m.to_numpy()]] for k, m in masks.items()}
+
+
+def build_context(df_facts, df_cp, df_main, today, df_rooms=None):
+    today = pd.Timestamp(today).normalize()
+    this_month = pd.Timestamp(today.year, today.month, 1)
+    periods = [PERIOD_MONTH, PERIOD_QUARTER, PERIOD_YEAR]
+    pnl, toa = [], []
+    if not df_facts.empty:
+        f_year = df_facts[df_facts['Tháng'].dt.year == today.year]
+        # Tổng theo tháng = cộng bảng từng Tòa (cùng nguồn với tab HĐKD)
+        parts = portfolio.month_partials(f_year, df_cp, today.year, today.month, False,
+                                         df_rooms if df_rooms is not None else pd.DataFrame(columns=['Toà', 'Mã căn']))
+        pnl = portfolio.merge_months(parts, None, today.month).astype('int64').to_dict('records')
+        df_toa = portfolio.building_totals(parts)
+        toa = df_toa.astype({c: 'int64' for c in df_toa.columns if c != 'Toà'}).to_dict('records')
+    alerts = alert_buckets(df_main, today)
+    return {
+        'hom_nay': today.strftime('%d/%m/%Y'),
+        'ky': {p: f"{_period_start(today, p).strftime('%d/%m/%Y')} - {today.strftime('%d/%m/%Y')}" for p in periods},
+        'tong_theo_thang_nam_nay': pnl,
+        'theo_toa_nam_nay': toa,
+        'phong': {p: _room_ranking(df_facts, _period_start(today, p), this_month) for p in periods},
+        'canh_bao': {k: {'so_luong': len(v), 'phong': v[:MAX_ROOMS_PER_ALERT]} for k, v in alerts.items()},
+    }
+
+
+def build_prompt(question, context):
+    data = json.dumps(context, ensure_ascii=False, separators=(',', ':'))
+    return f"{SYSTEM_PROMPT}\n\nDỮ LIỆU:\n{data}\n\nCÂU HỎI: {question}"
+
+
+# --- CLIENT ---
+class StubClient:
+    # Trả lời cố định bằng luật từ khóa trên chính bản tóm tắt - không cần mạng, dùng để kiểm thử
+    name = CLIENT_STUB
+
+    @staticmethod
+    def _period(q):
+        if 'thang' in q: return PERIOD_MONTH, "tháng này"
+        if 'nam' in q: return PERIOD_YEAR, "năm nay"
+        return PERIOD_QUARTER, "quý này"
+
+    def answer(self, question, context):
+        q = f" {normalize_text(question)} "
+        period, label = self._period(q)
+        if ' lo ' in q or 'thua lo' in q:
+            return self._rooms(context, period, label, 'lo_nhieu_nhat', "lỗ nhiều nhất")
+        if ' lai ' in q or 'loi nhuan cao' in q or 'loi nhat' in q:
+            return self._rooms(context, period, label, 'lai_nhieu_nhat', "lãi nhiều nhất")
+        for key, words in [('trong_co_hd', ['trong', 'ganh phi']), ('hd_het_han', ['het han']), ('khach_sap_ra', ['tra phong', 'sap ra', 'sap out'])]:
+            if any(w in q for w in words):
+                item = context['canh_bao'][key]
+                if not item['so_luong']: return f"Không có phòng nào thuộc nhóm: {ALERT_LABELS[key]}."
+                return f"{ALERT_LABELS[key]}: {item['so_luong']} phòng - " + ", ".join(item['phong'])
+        months = context['tong_theo_thang_nam_nay']
+        if not months: return "Chưa có dữ liệu hoạt động trong năm nay."
+        tong = {k: sum(m[k] for m in months) for k in ['Doanh thu', 'Chi phí HĐ', 'Chi phí VH', 'Lợi nhuận']}
+        return (f"Từ đầu năm đến {context['hom_nay']}: doanh thu {fmt_vnd(tong['Doanh thu'])}, "
+                f"trả chủ nhà {fmt_vnd(tong['Chi phí HĐ'])}, chi phí vận hành {fmt_vnd(tong['Chi phí VH'])}, "
+                f"lợi nhuận {fmt_vnd(tong['Lợi nhuận'])}.")
+
+    @staticmethod
+    def _rooms(context, period, label, key, title):
+        rooms = context['phong'][period][key]
+        if not rooms: return f"Không có phòng nào {title.split()[0]} trong {label} ({context['ky'][period]})."
+        lines = [f"{i}. {r['toa']}/{r['ma_can']}: {fmt_vnd(r['lai_lo'])} (thu {fmt_vnd(r['thu'])}, trả chủ {fmt_vnd(r['tra_chu'])})"
+                 for i, r in enumerate(rooms, 1)]
+        return f"Các phòng {title} {label} ({context['ky'][period]}):\n" + "\n".join(lines)
+
+
+class GeminiClient:
+    name = CLIENT_GEMINI
+
+    def __init__(self, api_key, model=DEFAULT_MODEL):
+        from google import genai
+        self.model = model
+        self._client = genai.Client(api_key=api_key)
+
+    def answer(self, question, context):
+        resp = self._client.models.generate_content(model=self.model, contents=build_prompt(question, context))
+        return (resp.text or "").strip()
+
+
+def get_ai_config(secrets=None):
+    # MT60_AI_CLIENT=stub ép dùng bản offline; khóa lấy từ biến môi trường hoặc Streamlit Secrets
+    def _secret(key):
+        try:
+            return secrets[key] if secrets is not None and key in secrets else None
+        except Exception:
+            return None
+
+    kind = str(os.environ.get("MT60_AI_CLIENT") or _secret("ai_client") or CLIENT_GEMINI).strip().lower()
+    key = os.environ.get("GEMINI_API_KEY") or _secret("gemini_api_key")
+    model = os.environ.get("MT60_AI_MODEL") or _secret("ai_model") or DEFAULT_MODEL
+    return kind, key, model
+
+
+def ai_available():
+    # Chỉ kiểm tra gói google-genai đã cài hay chưa; import thật (~vài trăm ms) để tới lúc tạo client
+    try:
+        return importlib.util.find_spec("google.genai") is not None
+    except (ImportError, ValueError):
+        return False
+
+
+def make_client(kind, api_key=None, model=DEFAULT_MODEL, ai_available=True):
+    if kind == CLIENT_GEMINI and api_key and ai_available:
+        return GeminiClient(api_key, model)
+    return StubClient()
+
+
+class Assistant:
+    def __init__(self, client, cache_size=CACHE_SIZE):
+        self.client = client
+        self._cache = OrderedDict()
+        self._cache_size = cache_size
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(question, version):
+        return " ".join(normalize_text(question).split()), version
+
+    def ask(self, question, context, version):
+        # Trả về (câu trả lời, lấy từ cache?) - lỗi của client được ném ra, không ghi vào cache
+        key = self._key(question, version)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key], True
+        answer = self.client.answer(question, context)
+        with self._lock:
+            self._cache[key] = answer
+            while len(self._cache) > self._cache_size: self._cache.popitem(last=False)
+        return answer, False
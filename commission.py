@@ -0,0 +1,113 @@
+import pandas as pd
+
+from core import COLUMNS_HH, clean_money, contract_moves
+
+# ==============================================================================
+# SỔ HOA HỒNG (SHEET HOA_HONG)
+# Dạng dài: mỗi dòng = (dòng hợp đồng, người nhận, số tiền). Dòng hợp đồng được
+# nhận diện bằng (Toà, Mã căn, Ngày ký, Ngày in) trên ngày giờ gốc. Hoa hồng ghi vào
+# tháng Ngày in (không có thì Ngày ký), giống bảng phòng - tháng.
+# Các cột cũ SALE THẢO / NGA / LINH, Công ty, Cá Nhân trên HOP_DONG được tách sang sổ
+# này; người nhận mới chỉ là một dòng mới, không cần thêm cột.
+# Sửa Toà / Mã căn / Ngày ký / Ngày in của dòng HĐ -> khoản hoa hồng đổi khóa theo (ghép qua
+# mã dòng core.ROW_ID); xóa dòng HĐ -> khoản hoa hồng của dòng đó bị xóa theo.
+# ==============================================================================
+
+LEGACY_COLUMNS = ["Công ty", "Cá Nhân", "SALE THẢO", "SALE NGA", "SALE LINH"]
+DEFAULT_PAYEES = ["Công ty", "Cá Nhân"]
+CONTRACT_KEYS = ["Toà", "Mã căn", "Ngày ký", "Ngày in"]
+
+
+def empty_ledger():
+    return pd.DataFrame(columns=COLUMNS_HH)
+
+
+def has_legacy(df_main):
+    return any(c in df_main.columns for c in LEGACY_COLUMNS)
+
+
+def _contract_keys(df):
+    out = df.reindex(columns=CONTRACT_KEYS).copy()
+    out['Toà'] = out['Toà'].fillna('').astype(str).str.strip()
+    out['Mã căn'] = out['Mã căn'].fillna('').astype(str)
+    for c in ['Ngày ký', 'Ngày in']: out[c] = pd.to_datetime(out[c], errors='coerce')
+    return out
+
+
+def wide_to_long(df_main):
+    # Cột hoa hồng cũ -> sổ dạng dài (bỏ các ô 0 / trống), vector hóa bằng melt
+    cols = [c for c in LEGACY_COLUMNS if c in df_main.columns]
+    if df_main.empty or not cols: return empty_ledger()
+    wide = _contract_keys(df_main)
+    for c in cols: wide[c] = df_main[c].apply(clean_money)
+    long = wide.melt(id_vars=CONTRACT_KEYS, value_vars=cols, var_name='Người nhận', value_name='Tiền')
+    return long[long['Tiền'] != 0].reset_index(drop=True)[COLUMNS_HH]
+
+
+def split_legacy(df_main, df_hh):
+    # Tách cột cũ khỏi HOP_DONG. Dòng HĐ đã có trong sổ thì sổ được ưu tiên (tránh ghi trùng
+    # khi HOP_DONG vẫn còn cột cũ sau lần chuyển trước). Trả về (HOP_DONG gọn, sổ đã gộp, số dòng chuyển)
+    if not has_legacy(df_main): return df_main, df_hh, 0
+    migrated = wide_to_long(df_main)
+    if not df_hh.empty and not migrated.empty:
+        known = pd.MultiIndex.from_frame(_contract_keys(df_hh))
+        migrated = migrated[~pd.MultiIndex.from_frame(migrated[CONTRACT_KEYS]).isin(known)]
+    df_main = df_main.drop(columns=[c for c in LEGACY_COLUMNS if c in df_main.columns])
+    parts = [p for p in [df_hh, migrated] if not p.empty]
+    merged = pd.concat(parts, ignore_index=True) if parts else empty_ledger()
+    return df_main, merged, len(migrated)
+
+
+def follow_contracts(df_hh, old_main, new_main):
+    # Sổ sau khi HOP_DONG đổi từ old_main sang new_main. Trả về (sổ, số dòng sổ đổi khóa / bị xóa)
+    if df_hh.empty: return df_hh, 0
+    moves = contract_moves(old_main, new_main, _contract_keys)
+    if not moves: return df_hh, 0
+    keys = list(_contract_keys(df_hh).itertuples(index=False, name=None))
+    hit = [k in moves for k in keys]
+    if not any(hit): return df_hh, 0
+    out = df_hh.copy()
+    target = [moves[k] if h else None for k, h in zip(keys, hit)]
+    doi = [i for i, (h, t) in enumerate(zip(hit, target)) if h and t is not None]
+    for j, c in enumerate(CONTRACT_KEYS):
+        if doi: out.loc[out.index[doi], c] = [target[i][j] for i in doi]
+    xoa = [h and t is None for h, t in zip(hit, target)]
+    return out[~pd.Series(xoa, index=out.index)].reset_index(drop=True), sum(hit)
+
+
+def payees(df_hh, defaults=DEFAULT_PAYEES):
+    # Danh sách người nhận động: mặc định trước, sau đó theo số lần xuất hiện trong sổ
+    seen = df_hh['Người nhận'].value_counts().index.tolist() if not df_hh.empty else []
+    return list(dict.fromkeys(list(defaults) + seen))
+
+
+def entries_for_row(row, df_input):
+    # Bảng nhập (Người nhận, Tiền) của một form -> các dòng sổ gắn với dòng HĐ vừa tạo
+    if df_input is None or df_input.empty: return empty_ledger()
+    df = df_input.copy()
+    df['Người nhận'] = df['Người nhận'].fillna('').astype(str).str.strip()
+    df['Tiền'] = df['Tiền'].apply(clean_money)
+    df = df[(df['Người nhận'] != '') & (df['Tiền'] != 0)]
+    if df.empty: return empty_ledger()
+    keys = _contract_keys(pd.DataFrame([row]))
+    out = pd.DataFrame({c: [keys[c].iloc[0]] * len(df) for c in CONTRACT_KEYS})
+    out['Người nhận'] = df['Người nhận'].to_numpy()
+    out['Tiền'] = df['Tiền'].to_numpy()
+    return out[COLUMNS_HH]
+
+
+def attribution_month(df_hh):
+    return df_hh['Ngày in'].fillna(df_hh['Ngày ký']).dt.to_period('M').dt.to_timestamp()
+
+
+def rollup(df_hh, year=None):
+    # Báo cáo người nhận x tháng (bảng chéo) + cột Tổng, một lần groupby
+    if df_hh.empty: return pd.DataFrame(columns=['Người nhận', 'Tổng'])
+    df = df_hh.assign(Tháng=attribution_month(df_hh)).dropna(subset=['Tháng'])
+    if year is not None: df = df[df['Tháng'].dt.year == year]
+    if df.empty: return pd.DataFrame(columns=['Người nhận', 'Tổng'])
+    pivot = df.pivot_table(index='Người nhận', columns='Tháng', values='Tiền', aggfunc='sum', fill_value=0)
+    pivot.columns = [f"T{c.month}/{c.year}" if year is None else f"T{c.month}" for c in pivot.columns]
+    pivot['Tổng'] = pivot.sum(axis=1)
+    return pivot.sort_values('Tổng', ascending=False).reset_index()
+
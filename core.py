@@ -0,0 +1,225 @@
+import hashlib
+import pandas as pd
+import re
+import uuid
+
+import dates
+
+# ==============================================================================
+# CẤU TRÚC BẢNG & HÀM CHUẨN HÓA DÙNG CHUNG
+# (quanly.py, loadtest.py và các engine tính toán cùng dùng một bản)
+# ==============================================================================
+
+COLUMNS = [
+    "Tòa nhà", "Mã căn", "Toà", "Chủ nhà - sale", "Ngày ký", "Ngày hết HĐ",
+    "Giá HĐ", "TT cho chủ nhà", "Cọc cho chủ nhà", "Tên khách thuê",
+    "Ngày in", "Ngày out", "Giá", "KH thanh toán", "KH cọc",
+    "Hết hạn khách hàng", "Ráp khách khi hết hạn"
+]
+
+# Mã dòng HOP_DONG: lưu cùng sheet (cột cuối), không đổi khi sửa nội dung dòng -> bảng sửa, sổ hoa hồng / giá HĐ
+# theo được dòng qua các lần sửa. Dòng chưa có mã: lúc đọc gán mã theo nội dung (mọi tiến trình ra cùng mã),
+# lúc lưu gán mã ngẫu nhiên cho dòng mới -> lần lưu đầu tiên ghi cố định mã của mọi dòng
+ROW_ID = "ID dòng"
+
+# Số dòng trên sheet HOP_DONG lúc đọc (chỉ có trong bảng đọc từ kho, không ghi ra sheet): giữ qua split_legacy
+# (bỏ dòng GĐ kiểu cũ trong bộ nhớ) -> báo lỗi dữ liệu đúng dòng người dùng thấy trên sheet
+SHEET_ROW = "Dòng sheet"
+
+COLUMNS_CP = ["Ngày", "Mã căn", "Loại", "Tiền", "Chỉ số đồng hồ"]
+
+# Sổ hoa hồng dạng dài: một dòng cho mỗi (dòng HĐ, người nhận)
+COLUMNS_HH = ["Toà", "Mã căn", "Ngày ký", "Ngày in", "Người nhận", "Tiền"]
+
+# Giá HĐ chủ theo giai đoạn: một dòng cho mỗi (HĐ, giai đoạn); HĐ = (Toà, Mã căn, Ngày ký) của dòng HOP_DONG
+COLUMNS_GD = ["Toà", "Mã căn", "Ngày ký", "Từ ngày", "Đến ngày", "Giá HĐ"]
+
+# Danh mục phòng: một dòng cho mỗi (Toà, Mã căn) đang quản lý; Tòa chưa có phòng nào -> một dòng Mã căn trống
+COLUMNS_TN = ["Toà", "Mã căn", "Ghi chú"]
+
+COLS_MONEY = [
+    "Giá", "Giá HĐ", "TT cho chủ nhà", "Cọc cho chủ nhà", "KH thanh toán", "KH cọc"
+]
+
+COLS_DATE = ["Ngày ký", "Ngày hết HĐ", "Ngày in", "Ngày out"]
+
+
+def clean_money(val):
+    if pd.isna(val) or val == "": return 0.0
+    if isinstance(val, (int, float)): return float(val)
+    s = str(val).strip()
+    if s.endswith('.0'): s = s[:-2]
+    if s.endswith(',0'): s = s[:-2]
+    s = s.replace('.', '').replace(',', '')
+    s = re.sub(r'[^\d-]', '', s)
+    try: return float(s)
+    except: return 0.0
+
+def fmt_vnd(val):
+    try:
+        val = float(val)
+        if pd.isna(val) or val == 0: return "0"
+        if val < 0: return "({:,.0f})".format(abs(val)).replace(",", ".")
+        return "{:,.0f}".format(val).replace(",", ".")
+    except: return "0"
+
+def fmt_date(val):
+    try:
+        if pd.isna(val) or val == "": return ""
+        if isinstance(val, str): val = pd.to_datetime(val, errors='coerce')
+        if pd.isna(val): return ""
+        return val.strftime('%d/%m/%y')
+    except: return ""
+
+def clean_macan(col):
+    return col.astype(str).str.replace(r'\.0$', '', regex=True).str.strip().str.upper()
+
+def frame_version(df):
+    # Dấu vân tay nội dung bảng: đổi bất kỳ ô / cột nào -> đổi phiên bản
+    if df.empty: return f"empty:{len(df.columns)}"
+    # Tên cột băm bằng blake2b (hash() của Python đổi theo tiến trình) -> cùng dữ liệu, cùng phiên bản ở mọi tiến trình
+    cols = hashlib.blake2b("\x1f".join(map(str, df.columns)).encode("utf-8"), digest_size=8).digest()
+    h = int(pd.util.hash_pandas_object(df, index=True).sum()) ^ int.from_bytes(cols, "little")
+    return format(h & 0xFFFFFFFFFFFFFFFF, '016x')
+
+
+def _missing_ids(df):
+    # Dòng chưa có mã hoặc trùng mã với dòng đứng trước (chép dòng trên sheet)
+    ids = df[ROW_ID].fillna("").astype(str).str.strip() if ROW_ID in df.columns else pd.Series("", index=df.index)
+    return ids, (ids == "") | ids.duplicated(keep="first")
+
+
+def content_row_ids(df):
+    # Mã theo nội dung (các cột COLUMNS) + số lần lặp của dòng giống hệt
+    content = df.reindex(columns=[c for c in COLUMNS if c in df.columns]).astype(str)
+    h = pd.util.hash_pandas_object(content, index=False)
+    lan = h.groupby(h.to_numpy(), sort=False).cumcount()
+    return pd.Series([f"{a:016x}-{b}" for a, b in zip(h.to_numpy(), lan.to_numpy())], index=df.index)
+
+
+def assign_row_ids(df):
+    # Trước khi lưu HOP_DONG: dòng chưa có mã (thêm mới / trùng mã) nhận mã ngẫu nhiên
+    ids, missing = _missing_ids(df)
+    if ROW_ID in df.columns and not missing.any(): return df
+    df = df.copy()
+    df[ROW_ID] = ids.where(~missing, pd.Series([str(uuid.uuid4()) for _ in range(len(df))], index=df.index))
+    return df
+
+
+def contract_moves(old_main, new_main, contract_keys):
+    # Khóa HĐ (theo hàm contract_keys của sổ) không còn dòng nào trong bản mới -> khóa mới của cùng dòng
+    # (ghép theo mã dòng), None nếu dòng đã bị xóa. Sổ HOA_HONG / GIA_HD dùng để đi theo khi sửa / xóa dòng HĐ
+    if old_main.empty or ROW_ID not in old_main.columns: return {}
+    old_keys = list(contract_keys(old_main).itertuples(index=False, name=None))
+    if new_main.empty or ROW_ID not in new_main.columns:
+        return {k: None for k in old_keys}
+    new_keys = list(contract_keys(new_main).itertuples(index=False, name=None))
+    still = set(new_keys)
+    new_by_id = dict(zip(new_main[ROW_ID].astype(str), new_keys))
+    moves = {}
+    for rid, key in zip(old_main[ROW_ID].astype(str), old_keys):
+        if key in still: continue
+        target = new_by_id.get(rid)
+        # Nhiều dòng cùng khóa: lấy dòng đầu tiên còn lại
+        if moves.get(key) is None: moves[key] = target
+    return moves
+
+
+# --- CHUẨN HÓA DỮ LIỆU SAU KHI ĐỌC TỪ KHO ---
+# sheet: tên worksheet để nhớ định dạng ngày và ghi ô ngày lỗi (xem dates.py)
+def normalize_hop_dong(df_main, sheet="HOP_DONG"):
+    if df_main.empty: return df_main
+    df_main.columns = df_main.columns.str.strip()
+    if "Mã căn" in df_main.columns: df_main["Mã căn"] = clean_macan(df_main["Mã căn"])
+    for c in COLS_DATE:
+        if c in df_main.columns: df_main[c] = dates.to_datetime(df_main[c], sheet, c)
+    for c in COLS_MONEY:
+        if c in df_main.columns: df_main[c] = df_main[c].apply(clean_money)
+    ids, missing = _missing_ids(df_main)
+    df_main[ROW_ID] = ids.where(~missing, content_row_ids(df_main)) if missing.any() else ids
+    if sheet is not None: df_main[SHEET_ROW] = range(dates.HEADER_ROWS + 1, dates.HEADER_ROWS + 1 + len(df_main))
+    return df_main
+
+def normalize_chi_phi(df_cp, sheet="CHI_PHI"):
+    if df_cp.empty: return pd.DataFrame(columns=COLUMNS_CP)
+    df_cp.columns = df_cp.columns.str.strip()
+    if "Mã căn" in df_cp.columns: df_cp["Mã căn"] = clean_macan(df_cp["Mã căn"])
+    if "Ngày" in df_cp.columns: df_cp["Ngày"] = dates.to_datetime(df_cp["Ngày"], sheet, "Ngày")
+    if "Tiền" in df_cp.columns: df_cp["Tiền"] = df_cp["Tiền"].apply(clean_money)
+    return df_cp
+
+def normalize_hoa_hong(df_hh, sheet="HOA_HONG"):
+    if df_hh.empty: return pd.DataFrame(columns=COLUMNS_HH)
+    df_hh.columns = df_hh.columns.str.strip()
+    df_hh = df_hh.reindex(columns=COLUMNS_HH)
+    df_hh["Toà"] = df_hh["Toà"].fillna("").astype(str).str.strip()
+    df_hh["Mã căn"] = clean_macan(df_hh["Mã căn"].fillna(""))
+    df_hh["Người nhận"] = df_hh["Người nhận"].fillna("").astype(str).str.strip()
+    for c in ["Ngày ký", "Ngày in"]: df_hh[c] = dates.to_datetime(df_hh[c], sheet, c)
+    df_hh["Tiền"] = df_hh["Tiền"].apply(clean_money)
+    return df_hh[(df_hh["Người nhận"] != "") & (df_hh["Tiền"] != 0)].reset_index(drop=True)
+
+def normalize_gia_hd(df_gd, sheet="GIA_HD"):
+    if df_gd.empty: return pd.DataFrame(columns=COLUMNS_GD)
+    df_gd.columns = df_gd.columns.str.strip()
+    df_gd = df_gd.reindex(columns=COLUMNS_GD)
+    df_gd["Toà"] = df_gd["Toà"].fillna("").astype(str).str.strip()
+    df_gd["Mã căn"] = clean_macan(df_gd["Mã căn"].fillna(""))
+    for c in ["Ngày ký", "Từ ngày", "Đến ngày"]: df_gd[c] = dates.to_datetime(df_gd[c], sheet, c)
+    df_gd["Giá HĐ"] = df_gd["Giá HĐ"].apply(clean_money)
+    return df_gd.dropna(subset=["Ngày ký", "Từ ngày", "Đến ngày"]).reset_index(drop=True)
+
+
+def normalize_toa_nha(df_tn):
+    if df_tn.empty: return pd.DataFrame(columns=COLUMNS_TN)
+    df_tn.columns = df_tn.columns.str.strip()
+    df_tn = df_tn.reindex(columns=COLUMNS_TN)
+    df_tn["Toà"] = df_tn["Toà"].fillna("").astype(str).str.strip()
+    df_tn["Mã căn"] = clean_macan(df_tn["Mã căn"].fillna(""))
+    df_tn["Ghi chú"] = df_tn["Ghi chú"].fillna("").astype(str)
+    df_tn = df_tn[df_tn["Toà"] != ""]
+    return df_tn.drop_duplicates(["Toà", "Mã căn"]).reset_index(drop=True)
+
+def gop_du_lieu_phong(df_input):
+    if df_input.empty: return df_input
+    df = df_input.copy()
+    df.columns = df.columns.str.strip()
+    df['Mã căn'] = clean_macan(df['Mã căn'])
+
+    def tao_mo_ta_dong(row):
+        details = []
+        k, h = fmt_date(row.get('Ngày ký')), fmt_date(row.get('Ngày hết HĐ'))
+        i, o = fmt_date(row.get('Ngày in')), fmt_date(row.get('Ngày out'))
+        if k or h: details.append(f"HĐ({k}-{h})")
+        if row.get('Giá HĐ', 0) > 0: details.append(f"GiáHĐ:{fmt_vnd(row['Giá HĐ'])}")
+        if i or o: details.append(f"Khách({i}-{o})")
+        if row.get('Giá', 0) > 0: details.append(f"GiáThuê:{fmt_vnd(row['Giá'])}")
+
+        thu = row.get('KH thanh toán', 0) + row.get('KH cọc', 0)
+        if thu > 0: details.append(f"Thu:{fmt_vnd(thu)}")
+        chi = row.get('TT cho chủ nhà', 0) + row.get('Cọc cho chủ nhà', 0)
+        if chi > 0: details.append(f"Chi:{fmt_vnd(chi)}")
+
+        if not details: return "Trống"
+        return ", ".join(details)
+
+    df['_chi_tiet_nhap'] = df.apply(tao_mo_ta_dong, axis=1)
+
+    agg_rules = {
+        'Ngày ký': 'min', 'Ngày hết HĐ': 'max',
+        'Ngày in': 'min', 'Ngày out': 'max',
+        'Giá HĐ': 'max', 'Giá': 'max',
+        'TT cho chủ nhà': 'sum', 'Cọc cho chủ nhà': 'sum',
+        'KH thanh toán': 'sum', 'KH cọc': 'sum',
+        'Tên khách thuê': 'first',
+        'Chủ nhà - sale': 'first',
+        '_chi_tiet_nhap': lambda x: '\n'.join([f"• Lần {i+1}: {v}" for i, v in enumerate(x) if v != "Trống"])
+    }
+
+    final_agg = {k: v for k, v in agg_rules.items() if k in df.columns}
+    cols_group = ['Toà', 'Mã căn']
+    if not all(col in df.columns for col in cols_group): return df
+
+    df_grouped = df.groupby(cols_group, as_index=False).agg(final_agg)
+    df_grouped = df_grouped.rename(columns={'_chi_tiet_nhap': 'Ghi chú'})
+    return df_grouped
@@ -0,0 +1,159 @@
+import numpy as np
+import pandas as pd
+
+import commission
+import forecast
+
+# ==============================================================================
+# BIỂU ĐỒ THEO DÕI HĐKD
+# Mọi biểu đồ chỉ nhận các bảng đã tổng hợp sẵn (vài chục dòng), không bao giờ
+# nhận dòng HOP_DONG thô -> dữ liệu gửi xuống trình duyệt nhỏ dù lịch sử dài.
+# Chuỗi theo thời gian dài hơn MAX_POINTS tháng được gộp lên quý / năm.
+# plotly chỉ được import khi vẽ biểu đồ lần đầu (không làm chậm lúc khởi động app).
+# ==============================================================================
+
+MAX_POINTS = 36
+CHUA_RO = "Chưa rõ"
+
+COLOR_REV = "#2e7d32"
+COLOR_COST = "#c62828"
+COLOR_OPEX = "#ef6c00"
+COLOR_PROFIT = "#1565c0"
+
+
+def _price_cols(accrual_mode):
+    return ('Giá thuê dồn tích', 'Giá HĐ dồn tích') if accrual_mode else ('Giá thuê', 'Giá HĐ')
+
+
+def _cp_in_year(df_cp, year, max_month):
+    if df_cp.empty: return df_cp
+    start, end = pd.Timestamp(year, 1, 1), pd.Timestamp(year, max_month, 1) + pd.offsets.MonthEnd(0)
+    sub = df_cp[(df_cp['Ngày'] >= start) & (df_cp['Ngày'] <= end)].copy()
+    sub['Tiền'] = pd.to_numeric(sub['Tiền'], errors='coerce').fillna(0)
+    sub['Tháng'] = sub['Ngày'].dt.month
+    return sub
+
+
+def monthly_pnl(df_facts_year, df_cp, year, max_month, accrual_mode=False, rounded=True):
+    # Thu - chi - lợi nhuận từng tháng, cùng cách tính với bảng tổng kết HĐKD
+    # (rounded=False: bảng từng Tòa để cộng lại, làm tròn sau khi cộng)
+    col_thue, col_hd = _price_cols(accrual_mode)
+    months = pd.Index(range(1, max_month + 1), name='Tháng')
+    f = df_facts_year.assign(Tháng=df_facts_year['Tháng'].dt.month)
+    co_hd = f['Có HĐ chủ'].astype(bool)
+    rev = f[co_hd].groupby('Tháng')[col_thue].sum()
+    idle = f[~co_hd].groupby('Tháng')[col_thue].sum()
+    cost = f.groupby('Tháng')[col_hd].sum()
+    cp = _cp_in_year(df_cp, year, max_month)
+    opex = cp.groupby('Tháng')['Tiền'].sum() if not cp.empty else pd.Series(dtype=float)
+
+    out = pd.DataFrame({
+        'Doanh thu': rev.reindex(months, fill_value=0),
+        'Chi phí HĐ': cost.reindex(months, fill_value=0),
+        'Chi phí VH': opex.reindex(months, fill_value=0),
+        'DT treo': idle.reindex(months, fill_value=0),
+    }).astype(float)
+    out['Lợi nhuận'] = out['Doanh thu'] - out['Chi phí HĐ'] - out['Chi phí VH']
+    return (out.round(0) if rounded else out).reset_index()
+
+
+def occupancy_trend(df_facts, until, max_points=MAX_POINTS):
+    # Tỉ lệ lấp đầy theo ngày-phòng (ngày có khách / ngày có HĐ chủ) trên toàn bộ lịch sử
+    if df_facts.empty:
+        return pd.DataFrame(columns=['Kỳ', 'Ngày có HĐ chủ', 'Ngày có khách', 'Tỉ lệ lấp đầy (%)'])
+    f = df_facts[df_facts['Có HĐ chủ'].astype(bool) & (df_facts['Tháng'] <= until)]
+    thue = np.minimum(f['Số ngày thuê'].to_numpy(dtype=float), f['Số ngày HĐ'].to_numpy(dtype=float))
+    g = pd.DataFrame({'Tháng': f['Tháng'].to_numpy(), 'Ngày có HĐ chủ': f['Số ngày HĐ'].to_numpy(dtype=float), 'Ngày có khách': thue})
+    g = g.groupby('Tháng').sum()
+
+    # Gộp lên kỳ dài hơn cho tới khi số điểm <= max_points, tỉ lệ tính lại từ tổng
+    for freq in ['M', 'Q', 'Y']:
+        periods = g.index.to_period(freq)
+        if periods.nunique() <= max_points: break
+    g = g.groupby(periods).sum()
+    g['Tỉ lệ lấp đầy (%)'] = (g['Ngày có khách'] / g['Ngày có HĐ chủ'].where(g['Ngày có HĐ chủ'] > 0) * 100).fillna(0).round(1)
+    g.index = g.index.astype(str)
+    g.index.name = 'Kỳ'
+    return g.reset_index()
+
+
+def commission_breakdown(df_hh, year, max_month):
+    # Hoa hồng từng người nhận theo tháng, lấy thẳng từ sổ HOA_HONG (dạng dài)
+    if df_hh.empty: return pd.DataFrame(columns=['Tháng', 'Khoản', 'Tiền'])
+    thang = commission.attribution_month(df_hh)
+    mask = (thang.dt.year == year) & (thang.dt.month <= max_month)
+    sub = df_hh[mask.to_numpy()]
+    out = sub.groupby([thang[mask].dt.month.to_numpy(), sub['Người nhận'].to_numpy()])['Tiền'].sum()
+    out.index.names = ['Tháng', 'Khoản']
+    out = out.reset_index()
+    return out[out['Tiền'] != 0].round(0).reset_index(drop=True)
+
+
+def build_dashboard(df_facts, df_hh, year, max_month, df_pnl, df_toa):
+    # df_pnl / df_toa: cộng từ bảng tổng hợp từng Tòa (portfolio.merge_months / building_totals)
+    return {
+        'pnl': df_pnl,
+        'toa': df_toa,
+        'occ': occupancy_trend(df_facts, pd.Timestamp(year, max_month, 1)),
+        'hoa_hong': commission_breakdown(df_hh, year, max_month),
+    }
+
+
+# --- FIGURES ---
+def _layout(fig, title):
+    fig.update_layout(
+        title=title, height=360, margin=dict(l=10, r=10, t=40, b=10),
+        legend=dict(orientation='h', y=-0.15), hovermode='x unified', separators=',.'
+    )
+    return fig
+
+
+def fig_pnl(df_pnl):
+    import plotly.graph_objects as go
+    x = [f"T{m}" for m in df_pnl['Tháng']]
+    fig = go.Figure([
+        go.Bar(name='Doanh thu', x=x, y=df_pnl['Doanh thu'], marker_color=COLOR_REV),
+        go.Bar(name='Chi phí HĐ', x=x, y=df_pnl['Chi phí HĐ'], marker_color=COLOR_COST),
+        go.Bar(name='Chi phí VH', x=x, y=df_pnl['Chi phí VH'], marker_color=COLOR_OPEX),
+        go.Scatter(name='Lợi nhuận', x=x, y=df_pnl['Lợi nhuận'], mode='lines+markers', line=dict(color=COLOR_PROFIT, width=3)),
+    ])
+    return _layout(fig.update_layout(barmode='group'), "Thu - Chi - Lợi nhuận theo tháng")
+
+
+def fig_cashflow(df_month):
+    import plotly.graph_objects as go
+    x = df_month['Tháng'].dt.strftime('%m/%Y')
+    thu = df_month[forecast.RENT] + df_month[forecast.RENT_ASSUMED] + df_month[forecast.DEPOSIT_BACK]
+    chi = df_month[forecast.OWNER] + df_month[forecast.OWNER_ASSUMED] + df_month[forecast.DEPOSIT_OUT]
+    fig = go.Figure([
+        go.Bar(name='Thu', x=x, y=thu, marker_color=COLOR_REV),
+        go.Bar(name='Chi', x=x, y=chi, marker_color=COLOR_COST),
+        go.Scatter(name='Lũy kế ròng', x=x, y=df_month['Lũy kế'], mode='lines+markers', line=dict(color=COLOR_PROFIT, width=3)),
+    ])
+    return _layout(fig.update_layout(barmode='group'), "Dự báo dòng tiền theo tháng")
+
+
+def fig_building(df_toa):
+    import plotly.graph_objects as go
+    colors = [COLOR_PROFIT if v >= 0 else COLOR_COST for v in df_toa['Lợi nhuận']]
+    fig = go.Figure(go.Bar(x=df_toa['Toà'], y=df_toa['Lợi nhuận'], marker_color=colors, name='Lợi nhuận'))
+    return _layout(fig, "Lợi nhuận theo Tòa")
+
+
+def fig_occupancy(df_occ):
+    import plotly.graph_objects as go
+    fig = go.Figure(go.Scatter(
+        x=df_occ['Kỳ'], y=df_occ['Tỉ lệ lấp đầy (%)'], mode='lines+markers', name='Lấp đầy',
+        line=dict(color=COLOR_REV, width=3), fill='tozeroy'
+    ))
+    fig.update_yaxes(range=[0, 105], ticksuffix='%')
+    return _layout(fig, "Tỉ lệ lấp đầy (ngày-phòng)")
+
+
+def fig_commission(df_hh):
+    import plotly.graph_objects as go
+    fig = go.Figure()
+    for khoan, grp in df_hh.groupby('Khoản', sort=False):
+        fig.add_bar(name=khoan, x=[f"T{m}" for m in grp['Tháng']], y=grp['Tiền'])
+    fig.update_xaxes(categoryorder='array', categoryarray=[f"T{m}" for m in sorted(df_hh['Tháng'].unique())])
+    return _layout(fig.update_layout(barmode='stack'), "Hoa hồng theo khoản")
@@ -0,0 +1,159 @@
+import threading
+
+import numpy as np
+import pandas as pd
+
+# ==============================================================================
+# ĐỌC CỘT NGÀY THEO ĐỊNH DẠNG
+# Ô ngày trên sheet có thể là:
+#   serial : số ngày kiểu Google Sheets / Excel (45321 = 30/01/2024), gốc 30/12/1899
+#   iso    : 2024-01-30 hoặc 2024-01-30 00:00:00 (app tự ghi)
+#   dmy4   : 30/01/2024 (cũng nhận 30-01-2024, 30.01.2024)
+#   dmy2   : 30/01/24
+# - Mỗi nhóm định dạng được đọc bằng một lần pd.to_datetime với format tường minh:
+#   không suy đoán từng ô, không bao giờ đọc nhầm dd/mm thành mm/dd
+# - Nhớ các định dạng đã gặp của từng (sheet, cột), lần sau thử theo thứ tự đó trước:
+#   cột chỉ có một định dạng -> một lần parse là xong; chỉ ô lệch chuẩn mới qua bước phân loại theo mẫu
+# - Ô có nội dung nhưng không đọc được -> ghi vào danh sách lỗi (kèm dòng sheet), không âm thầm thành NaT
+# ==============================================================================
+
+SERIAL = "serial"
+ISO = "iso"
+DMY4 = "dmy4"
+DMY2 = "dmy2"
+FORMATS = [ISO, DMY4, DMY2, SERIAL]
+
+FORMAT_LABELS = {SERIAL: "Số serial", ISO: "yyyy-mm-dd", DMY4: "dd/mm/yyyy", DMY2: "dd/mm/yy"}
+
+_PATTERNS = {
+    ISO: r'\d{4}-\d{1,2}-\d{1,2}(?:[ T]\d{1,2}:\d{2}(?::\d{2}(?:\.\d+)?)?)?',
+    DMY4: r'\d{1,2}/\d{1,2}/\d{4}',
+    DMY2: r'\d{1,2}/\d{1,2}/\d{2}',
+}
+_STRFTIME = {ISO: 'ISO8601', DMY4: '%d/%m/%Y', DMY2: '%d/%m/%y'}
+
+SERIAL_ORIGIN = pd.Timestamp("1899-12-30")
+SERIAL_MIN, SERIAL_MAX = 18264, 73051    # 01/01/1950 .. 01/01/2100 (số nhỏ hơn như 2024 không phải ngày)
+HEADER_ROWS = 1                          # dòng tiêu đề của sheet -> số dòng sheet = vị trí + 2
+
+ISSUE_COLUMNS = ["Sheet", "Cột", "Dòng sheet", "Giá trị"]
+
+
+def _text(values):
+    # Chuỗi đã strip, dấu - . giữa ngày/tháng/năm đổi thành / (trừ dạng ISO bắt đầu bằng năm)
+    s = values.astype(str).str.strip()
+    return s.where(s.str.match(r'^\d{4}-'), s.str.replace(r'[-.]', '/', regex=True))
+
+
+def _iso_like(values):
+    # ISO8601 của pandas nhận cả "2024", "2024-01" (thành ngày 1/1, 1/tháng) -> chỉ nhận chuỗi >= 8 ký tự;
+    # ô không phải chuỗi (số) -> False
+    return (values.str.len() >= 8).fillna(False).astype(bool)
+
+
+def _parse_serial(values):
+    num = pd.to_numeric(values, errors='coerce')
+    ok = num.between(SERIAL_MIN, SERIAL_MAX)
+    out = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+    if ok.any(): out[ok] = SERIAL_ORIGIN + pd.to_timedelta(num[ok].astype(float), unit='D')
+    return out.dt.floor('D')
+
+
+def _parse(fmt, values):
+    # Đọc đúng một định dạng; ô không thuộc định dạng đó -> NaT
+    if fmt == SERIAL: return _parse_serial(values)
+    if fmt == ISO:
+        if values.dtype != object: return pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+        ok = _iso_like(values)
+        if ok.all(): return pd.to_datetime(values, format=_STRFTIME[ISO], errors='coerce')
+        out = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+        if ok.any(): out[ok] = pd.to_datetime(values[ok], format=_STRFTIME[ISO], errors='coerce')
+        return out
+    return pd.to_datetime(values, format=_STRFTIME[fmt], errors='coerce')
+
+
+def _matches(fmt, text):
+    return text.str.fullmatch(_PATTERNS[fmt])
+
+
+class DateParser:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._formats = {}    # (sheet, cột) -> [định dạng, ...] theo số ô giảm dần ở lần đọc gần nhất
+        self._counts = {}     # (sheet, cột) -> {định dạng: số ô}
+        self._issues = {}     # (sheet, cột) -> bảng ô không đọc được của lần đọc gần nhất
+
+    def formats(self, sheet, column):
+        with self._lock:
+            return list(self._formats.get((sheet, column), []))
+
+    def parse(self, values, sheet=None, column=None):
+        # Series bất kỳ -> Series datetime64 cùng index
+        values = pd.Series(values)
+        if pd.api.types.is_datetime64_any_dtype(values): return values
+        out = pd.Series(pd.NaT, index=values.index, dtype='datetime64[ns]')
+        todo = ~(values.isna().to_numpy() | (values == '').to_numpy())
+        counts = {}
+
+        def _ghi(fmt, pos, got):
+            hit = got.notna().to_numpy()
+            if not hit.any(): return
+            idx = pos[hit]
+            out.iloc[idx] = got[hit].to_numpy()
+            todo[idx] = False
+            counts[fmt] = counts.get(fmt, 0) + int(hit.sum())
+
+        # 1) Đọc thẳng giá trị gốc, mỗi định dạng một lần parse trên phần chưa đọc được;
+        #    thử trước các định dạng đã gặp của cột (cột một định dạng -> xong ngay lần đầu)
+        known = self.formats(sheet, column)
+        for fmt in known + [f for f in FORMATS if f not in known]:
+            if not todo.any(): break
+            pos = np.flatnonzero(todo)
+            _ghi(fmt, pos, _parse(fmt, values if len(pos) == len(values) else values.iloc[pos]))
+
+        # 2) Phần còn lại (khoảng trắng thừa, dấu - . thay cho /): chuẩn hóa chuỗi, phân loại theo mẫu rồi đọc lại
+        if todo.any():
+            pos = np.flatnonzero(todo)
+            text = _text(values.iloc[pos])
+            for fmt in [ISO, DMY4, DMY2]:
+                m = _matches(fmt, text).to_numpy() & todo[pos]
+                if m.any(): _ghi(fmt, pos[m], _parse(fmt, text[m]))
+
+        # Ô chỉ có khoảng trắng coi như trống
+        if todo.any(): todo[np.flatnonzero(todo)[(values[todo].astype(str).str.strip() == '').to_numpy()]] = False
+        bad = np.flatnonzero(todo)
+        issues = pd.DataFrame({
+            "Sheet": sheet or "", "Cột": column or "",
+            "Dòng sheet": bad + HEADER_ROWS + 1, "Giá trị": values.iloc[bad].astype(str).to_numpy(),
+        }, columns=ISSUE_COLUMNS)
+        if sheet is not None:
+            with self._lock:
+                if counts: self._formats[(sheet, column)] = sorted(counts, key=counts.get, reverse=True)
+                self._counts[(sheet, column)] = counts
+                self._issues[(sheet, column)] = issues
+        return out
+
+    def issues(self, sheets=None):
+        # Ô ngày không đọc được ở lần đọc gần nhất của các sheet (None = mọi sheet)
+        with self._lock:
+            parts = [v for (s, _), v in self._issues.items() if not v.empty and (sheets is None or s in sheets)]
+        if not parts: return pd.DataFrame(columns=ISSUE_COLUMNS)
+        return pd.concat(parts, ignore_index=True)
+
+    def summary(self, sheets=None):
+        # Số ô đọc được theo từng định dạng của mỗi (sheet, cột)
+        with self._lock:
+            rows = [{"Sheet": s, "Cột": c, **{FORMAT_LABELS[f]: n for f, n in cnt.items()}}
+                    for (s, c), cnt in self._counts.items() if sheets is None or s in sheets]
+        cols = ["Sheet", "Cột"] + [FORMAT_LABELS[f] for f in FORMATS]
+        if not rows: return pd.DataFrame(columns=cols)
+        out = pd.DataFrame(rows).reindex(columns=cols)
+        out[cols[2:]] = out[cols[2:]].fillna(0).astype(int)
+        return out
+
+
+PARSER = DateParser()
+
+
+def to_datetime(values, sheet=None, column=None):
+    return PARSER.parse(values, sheet, column)
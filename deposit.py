@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+
+import quality
+
+# ==============================================================================
+# SỔ TIỀN CỌC
+# Mỗi khoản cọc sinh 2 sự kiện: nhận / đặt cọc và trả lại.
+#   Cọc khách (KH cọc)            : nhận ngày khách vào (không có thì Ngày ký), trả ngày khách ra
+#   Cọc chủ nhà (Cọc cho chủ nhà) : đặt ngày ký, nhận lại khi chuỗi HĐ chủ liền mạch của phòng
+#                                    kết thúc hoặc khi có khoản cọc chủ nhà mới thay thế
+# Số dư chạy theo phòng / Tòa / tổng = cumsum trên bảng sự kiện đã sắp xếp theo ngày.
+# Số dư tại một ngày = tổng các sự kiện có ngày <= ngày đó.
+# ==============================================================================
+
+KHACH = "Cọc khách"
+CHU_NHA = "Cọc chủ nhà"
+NHAN, TRA = "Nhận cọc", "Trả cọc"
+DAT, THU_VE = "Đặt cọc", "Nhận lại cọc"
+
+ITEM_COLUMNS = ["Loại cọc", "Toà", "Mã căn", "Đối tác", "Tiền", "Ngày nhận", "Ngày trả", "Dòng sheet"]
+EVENT_COLUMNS = ["Ngày", "Loại cọc", "Sự kiện", "Toà", "Mã căn", "Đối tác", "Tiền",
+                 "Số dư phòng", "Số dư Tòa", "Số dư tổng"]
+BALANCE_COLUMNS = [KHACH, CHU_NHA]
+
+
+def _prepare(df_main):
+    df = df_main.reset_index(drop=True).reindex(
+        columns=['Toà', 'Mã căn', 'Chủ nhà - sale', 'Tên khách thuê', 'Ngày ký', 'Ngày hết HĐ',
+                 'Ngày in', 'Ngày out', 'Cọc cho chủ nhà', 'KH cọc'])
+    df['Toà'] = df['Toà'].fillna('').astype(str).str.strip()
+    df['Mã căn'] = df['Mã căn'].fillna('').astype(str)
+    for c in ['Ngày ký', 'Ngày hết HĐ', 'Ngày in', 'Ngày out']: df[c] = pd.to_datetime(df[c], errors='coerce')
+    for c in ['Cọc cho chủ nhà', 'KH cọc']: df[c] = pd.to_numeric(df[c], errors='coerce').fillna(0)
+    df['Dòng sheet'] = quality.sheet_rows(df_main, range(len(df_main)))
+    return df[df['Toà'] != '']
+
+
+def _tenant_items(df):
+    sub = df[df['KH cọc'] > 0].assign(**{'Ngày nhận': lambda d: d['Ngày in'].fillna(d['Ngày ký'])})
+    sub = sub.dropna(subset=['Ngày nhận'])
+    # Cùng một lượt thuê ghi ở nhiều dòng -> chỉ tính một khoản cọc (lấy số lớn nhất)
+    sub = sub.sort_values('KH cọc', ascending=False, kind='stable')
+    sub = sub.drop_duplicates(subset=quality.interval_key('Ngày in', 'Ngày out') + ['Tên khách thuê'], keep='first')
+    return pd.DataFrame({
+        'Loại cọc': KHACH, 'Toà': sub['Toà'], 'Mã căn': sub['Mã căn'], 'Đối tác': sub['Tên khách thuê'].fillna(''),
+        'Tiền': sub['KH cọc'], 'Ngày nhận': sub['Ngày nhận'], 'Ngày trả': sub['Ngày out'], 'Dòng sheet': sub['Dòng sheet'],
+    })
+
+
+def _owner_items(df):
+    own = df.dropna(subset=['Ngày ký']).sort_values(['Toà', 'Mã căn', 'Ngày ký'], kind='stable')
+    if own.empty: return pd.DataFrame(columns=ITEM_COLUMNS)
+    keys = [own['Toà'], own['Mã căn']]
+    # Chuỗi HĐ liền mạch (các giai đoạn GĐ1/GĐ2/GĐ3, gia hạn nối tiếp): HĐ mới bắt đầu sau ngày hết xa nhất + 1
+    end_max_truoc = own['Ngày hết HĐ'].groupby(keys, sort=False).cummax().groupby(keys, sort=False).shift(1)
+    first = ~own.duplicated(subset=['Toà', 'Mã căn'])
+    new_chain = first | (own['Ngày ký'] > end_max_truoc + pd.Timedelta(days=1))
+    chain = new_chain.cumsum()
+    chain_end = own['Ngày hết HĐ'].groupby(chain).transform('max')
+
+    dep = own[own['Cọc cho chủ nhà'] > 0]
+    dep_chain = chain[dep.index]
+    next_dep = dep['Ngày ký'].groupby(dep_chain).shift(-1)
+    tra = next_dep.where(next_dep.notna() & (next_dep < chain_end[dep.index]), chain_end[dep.index])
+    return pd.DataFrame({
+        'Loại cọc': CHU_NHA, 'Toà': dep['Toà'], 'Mã căn': dep['Mã căn'], 'Đối tác': dep['Chủ nhà - sale'].fillna(''),
+        'Tiền': dep['Cọc cho chủ nhà'], 'Ngày nhận': dep['Ngày ký'], 'Ngày trả': tra, 'Dòng sheet': dep['Dòng sheet'],
+    })
+
+
+def deposit_items(df_main):
+    # Một dòng cho mỗi khoản cọc (Ngày trả trống = chưa xác định ngày trả)
+    if df_main.empty: return pd.DataFrame(columns=ITEM_COLUMNS)
+    df = _prepare(df_main)
+    parts = [p for p in [_tenant_items(df), _owner_items(df)] if not p.empty]
+    if not parts: return pd.DataFrame(columns=ITEM_COLUMNS)
+    return pd.concat(parts, ignore_index=True)[ITEM_COLUMNS]
+
+
+def build_events(items):
+    # Sổ sự kiện + số dư chạy (tính riêng từng loại cọc)
+    if items.empty: return pd.DataFrame(columns=EVENT_COLUMNS)
+    base = items[['Loại cọc', 'Toà', 'Mã căn', 'Đối tác']]
+    vao = base.assign(Ngày=items['Ngày nhận'].to_numpy(), Tiền=items['Tiền'].to_numpy(),
+                      **{'Sự kiện': np.where(items['Loại cọc'] == KHACH, NHAN, DAT)})
+    co_tra = items['Ngày trả'].notna().to_numpy()
+    ra = base[co_tra].assign(Ngày=items['Ngày trả'][co_tra].to_numpy(), Tiền=-items['Tiền'][co_tra].to_numpy(),
+                             **{'Sự kiện': np.where(items['Loại cọc'][co_tra] == KHACH, TRA, THU_VE)})
+    ev = pd.concat([vao, ra], ignore_index=True)
+    # Cùng ngày: ghi khoản vào trước khoản ra (sắp xếp ổn định theo dấu tiền)
+    ev = ev.assign(_ra=ev['Tiền'] < 0).sort_values(['Ngày', '_ra'], kind='stable').drop(columns='_ra').reset_index(drop=True)
+    ev['Số dư phòng'] = ev.groupby(['Loại cọc', 'Toà', 'Mã căn'], sort=False)['Tiền'].cumsum()
+    ev['Số dư Tòa'] = ev.groupby(['Loại cọc', 'Toà'], sort=False)['Tiền'].cumsum()
+    ev['Số dư tổng'] = ev.groupby('Loại cọc', sort=False)['Tiền'].cumsum()
+    return ev[EVENT_COLUMNS]
+
+
+def _as_of(events, as_of):
+    return events[events['Ngày'] <= pd.Timestamp(as_of)] if not events.empty else events
+
+
+def balances(events, as_of, by=('Toà', 'Mã căn')):
+    # Số dư tại ngày as_of theo nhóm: cột Cọc khách (đang giữ của khách) / Cọc chủ nhà (đang đặt ở chủ nhà)
+    by = list(by)
+    ev = _as_of(events, as_of)
+    if ev.empty: return pd.DataFrame(columns=by + BALANCE_COLUMNS + ['Chênh lệch'])
+    out = ev.pivot_table(index=by, columns='Loại cọc', values='Tiền', aggfunc='sum', fill_value=0)
+    out = out.reindex(columns=BALANCE_COLUMNS, fill_value=0)
+    out = out[(out != 0).any(axis=1)]
+    # Chênh lệch > 0: đang giữ tiền cọc của khách nhiều hơn số đã đặt cho chủ nhà
+    out['Chênh lệch'] = out[KHACH] - out[CHU_NHA]
+    out.columns.name = None
+    return out.reset_index()
+
+
+def totals(events, as_of):
+    ev = _as_of(events, as_of)
+    s = ev.groupby('Loại cọc')['Tiền'].sum() if not ev.empty else pd.Series(dtype=float)
+    return {c: float(s.get(c, 0)) for c in BALANCE_COLUMNS}
+
+
+def open_items(items, as_of):
+    # Các khoản cọc còn hiệu lực tại as_of (đã nhận, chưa tới ngày trả)
+    as_of = pd.Timestamp(as_of)
+    if items.empty: return items
+    mask = (items['Ngày nhận'] <= as_of) & (items['Ngày trả'].isna() | (items['Ngày trả'] > as_of))
+    return items[mask].sort_values(['Loại cọc', 'Toà', 'Mã căn', 'Ngày nhận']).reset_index(drop=True)
+
+
+def balance_series(events, until):
+    # Số dư tổng cuối mỗi tháng (cho biểu đồ), tới tháng của ngày until
+    ev = _as_of(events, until)
+    if ev.empty: return pd.DataFrame(columns=['Tháng'] + BALANCE_COLUMNS)
+    thang = ev['Ngày'].dt.to_period('M')
+    g = ev.groupby([thang, 'Loại cọc'])['Tiền'].sum().unstack(fill_value=0).reindex(columns=BALANCE_COLUMNS, fill_value=0)
+    g = g.reindex(pd.period_range(g.index.min(), pd.Timestamp(until).to_period('M'), freq='M'), fill_value=0).cumsum()
+    g.index = g.index.to_timestamp()
+    g.index.name = 'Tháng'
+    g.columns.name = None
+    return g.reset_index()
@@ -0,0 +1,128 @@
+import numpy as np
+import pandas as pd
+
+import quality
+from core import COLS_DATE, COLS_MONEY, ROW_ID, SHEET_ROW, clean_macan, clean_money
+
+# ==============================================================================
+# BẢNG SỬA DỮ LIỆU GỐC THEO TRANG
+# - Lọc / sắp xếp / cắt trang trên server, trình duyệt chỉ nhận các dòng của trang đang xem
+# - Mỗi dòng mang ID cố định lưu trong sheet (cột core.ROW_ID, ẩn trên bảng sửa)
+#   -> không phụ thuộc vị trí hay nội dung: sửa dòng, dòng giống hệt nhau, đổi thứ tự đều không làm lệch ID
+# - Khi lưu: ánh xạ ID của trang về bảng đầy đủ của Snapshot hiện tại, dòng có nội dung khác bản hiện tại -> sửa,
+#   rồi ghi lại cả bảng; ID không còn (dòng đã bị người khác xóa / chuyển lưu trữ) -> bỏ qua và báo lại
+# ==============================================================================
+
+ID_COL = ROW_ID
+PAGE_SIZES = [50, 100, 200, 500]
+DEFAULT_PAGE_SIZE = 100
+SORT_NONE = "Thứ tự sheet"
+
+
+def row_ids(df):
+    # ID theo vị trí dòng của df (Index mới 0..n-1); df đã chuẩn hóa nên dòng nào cũng có ID, không trùng
+    if df.empty or ID_COL not in df.columns: return pd.Index([], dtype=object)
+    return pd.Index(df[ID_COL].astype(str).to_numpy(), dtype=object)
+
+
+def _content_columns(df):
+    return [c for c in df.columns if c not in (ID_COL, SHEET_ROW)]
+
+
+def filter_rows(df, toa=None, ma_can="", khach="", tu=None, den=None):
+    # Trả về vị trí (numpy) các dòng thỏa điều kiện, theo thứ tự sheet
+    mask = np.ones(len(df), dtype=bool)
+    if df.empty: return np.flatnonzero(mask)
+    if toa: mask &= df['Toà'].fillna('').astype(str).str.strip().isin(toa).to_numpy()
+    if ma_can:
+        mask &= df['Mã căn'].fillna('').astype(str).str.contains(ma_can.strip().upper(), regex=False).to_numpy()
+    if khach:
+        mask &= df['Tên khách thuê'].fillna('').astype(str).str.contains(khach.strip(), case=False, regex=False).to_numpy()
+    if tu is not None or den is not None:
+        # Dòng có khoảng [ngày sớm nhất, ngày muộn nhất] giao với khoảng lọc
+        dates = df.reindex(columns=COLS_DATE).apply(pd.to_datetime, errors='coerce')
+        bd, kt = dates.min(axis=1), dates.max(axis=1)
+        if tu is not None: mask &= (kt >= pd.Timestamp(tu)).to_numpy()
+        if den is not None: mask &= (bd <= pd.Timestamp(den)).to_numpy()
+    return np.flatnonzero(mask)
+
+
+def sort_rows(df, pos, by=SORT_NONE, ascending=True):
+    if by == SORT_NONE or by not in df.columns or len(pos) == 0:
+        return pos if ascending else pos[::-1]
+    col = df[by].iloc[pos].reset_index(drop=True)
+    order = col.sort_values(ascending=ascending, kind='stable', na_position='last').index.to_numpy()
+    return pos[order]
+
+
+def page_count(n, page_size):
+    return max(1, -(-n // page_size))
+
+
+def page_slice(pos, page, page_size):
+    page = min(max(1, page), page_count(len(pos), page_size))
+    return pos[(page - 1) * page_size: page * page_size]
+
+
+def to_editor(df, pos, ids):
+    # Bảng của một trang để hiển thị: tiền dạng chuỗi số nguyên, cột ID (ẩn) ở đầu
+    out = df.iloc[pos].reset_index(drop=True).drop(columns=[ID_COL, SHEET_ROW], errors='ignore')
+    for c in COLS_MONEY:
+        if c in out.columns:
+            out[c] = pd.to_numeric(out[c], errors='coerce').fillna(0).astype('int64').astype(str)
+    out.insert(0, ID_COL, ids[pos])
+    return out
+
+
+def _from_editor(edited, columns):
+    # Bảng trang đã sửa -> cùng dạng chuẩn hóa với df_main
+    out = edited.reindex(columns=columns).reset_index(drop=True)
+    if "Mã căn" in out.columns: out["Mã căn"] = clean_macan(out["Mã căn"].fillna(''))
+    for c in COLS_DATE:
+        if c in out.columns: out[c] = pd.to_datetime(out[c], errors='coerce')
+    for c in COLS_MONEY:
+        if c in out.columns: out[c] = out[c].apply(clean_money)
+    return out
+
+
+def apply_page(df, ids, page_ids, edited):
+    # Áp thay đổi của một trang vào bảng đầy đủ. Trả về (bảng mới, thống kê)
+    stats = {"sửa": 0, "thêm": 0, "xóa": 0, "bỏ qua": 0}
+    edited = edited.reset_index(drop=True)
+    rows = _from_editor(edited, df.columns)
+    eid = edited[ID_COL] if ID_COL in edited.columns else pd.Series([None] * len(edited))
+    moi = eid.isna().to_numpy() | (eid.astype(str) == '').to_numpy()
+    # Dòng thêm mới hoàn toàn trống -> bỏ
+    vals = edited.drop(columns=[ID_COL], errors='ignore')
+    moi_that = moi & (vals.notna() & vals.astype(str).ne('')).any(axis=1).to_numpy()
+
+    con_lai = set(eid[~moi].astype(str))
+    xoa = [i for i in page_ids if i not in con_lai]
+    # Dòng giữ lại (tìm theo ID) có nội dung khác dòng hiện tại -> đã sửa
+    cu = rows[~moi].reset_index(drop=True)
+    cu[ID_COL] = eid[~moi].astype(str).to_numpy()
+    pos_cu = ids.get_indexer(pd.Index(cu[ID_COL], dtype=object))
+    cols = _content_columns(df)
+    out = df.reset_index(drop=True).copy()
+    sua_mask = np.zeros(len(cu), dtype=bool)
+    thay = pos_cu >= 0
+    if thay.any():
+        h = quality.row_hashes(cu[thay], columns=cols).to_numpy()
+        hien_tai = quality.row_hashes(out.iloc[pos_cu[thay]], columns=cols).to_numpy()
+        sua_mask[np.flatnonzero(thay)] = h != hien_tai
+
+    pos_sua = pos_cu[sua_mask]
+    pos_xoa = ids.get_indexer(pd.Index(xoa, dtype=object))
+    stats["bỏ qua"] = int((pos_cu < 0).sum() + (pos_xoa < 0).sum())
+
+    if sua_mask.any():
+        src = cu[sua_mask]
+        for c in out.columns: out.loc[pos_sua, c] = src[c].to_numpy()
+        stats["sửa"] = int(sua_mask.sum())
+    if (pos_xoa >= 0).any():
+        out = out.drop(index=pos_xoa[pos_xoa >= 0])
+        stats["xóa"] = int((pos_xoa >= 0).sum())
+    if moi_that.any():
+        out = pd.concat([out, rows[moi_that]], ignore_index=True)
+        stats["thêm"] = int(moi_that.sum())
+    return out.reset_index(drop=True), stats
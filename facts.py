@@ -0,0 +1,230 @@
+import os
+import threading
+
+import numpy as np
+import pandas as pd
+
+from core import COLUMNS_GD, COLUMNS_HH
+
+# ==============================================================================
+# BẢNG SỰ KIỆN PHÒNG - THÁNG (FACT TABLE)
+# Một dòng cho mỗi (Toà, Mã căn, Tháng):
+#   Có HĐ chủ / Có khách       : có HĐ chủ / có khách ở ít nhất 1 ngày trong tháng
+#   Giá HĐ / Giá thuê          : đủ giá tháng (giống các tab tháng: HĐ trùng khoảng chỉ tính 1 lần;
+#                                HĐ có giá theo giai đoạn trong sổ GIA_HD tính theo từng giai đoạn)
+#   Giá HĐ dồn tích / Giá thuê dồn tích : theo số ngày thực tế trong tháng (Số ngày HĐ / Số ngày thuê)
+#   TT / Cọc cho chủ nhà       : ghi vào tháng Ngày ký
+#   KH thanh toán / KH cọc / Hoa hồng : ghi vào tháng Ngày in (không có thì Ngày ký); Hoa hồng lấy từ sổ HOA_HONG
+# FactStore giữ bảng này, lưu xuống file và chỉ tính lại các phòng có dòng HOP_DONG / HOA_HONG / GIA_HD thay đổi.
+# ==============================================================================
+
+ROOM_KEYS = ['Toà', 'Mã căn']
+FACT_KEYS = ROOM_KEYS + ['Tháng']
+FACT_COLUMNS = FACT_KEYS + [
+    'Có HĐ chủ', 'Có khách', 'Chủ nhà - sale', 'Tên khách thuê',
+    'Số ngày HĐ', 'Số ngày thuê', 'Giá HĐ', 'Giá thuê', 'Giá HĐ dồn tích', 'Giá thuê dồn tích',
+    'TT cho chủ nhà', 'Cọc cho chủ nhà', 'KH thanh toán', 'KH cọc', 'Hoa hồng'
+]
+SUM_COLUMNS = [
+    'Số ngày HĐ', 'Số ngày thuê', 'Giá HĐ', 'Giá thuê', 'Giá HĐ dồn tích', 'Giá thuê dồn tích',
+    'TT cho chủ nhà', 'Cọc cho chủ nhà', 'KH thanh toán', 'KH cọc', 'Hoa hồng'
+]
+SOURCE_COLUMNS = ROOM_KEYS + [
+    'Chủ nhà - sale', 'Ngày ký', 'Ngày hết HĐ', 'Giá HĐ', 'TT cho chủ nhà', 'Cọc cho chủ nhà',
+    'Tên khách thuê', 'Ngày in', 'Ngày out', 'Giá', 'KH thanh toán', 'KH cọc'
+]
+
+DEFAULT_PATH = "mt60_facts.pkl"
+
+
+def empty_facts():
+    return pd.DataFrame(columns=FACT_COLUMNS)
+
+
+def _month_number(col):
+    return col.dt.year.to_numpy() * 12 + col.dt.month.to_numpy() - 1
+
+
+def _expand_months(df, col_s, col_e):
+    # Trải mỗi khoảng [col_s, col_e] thành các tháng nó đi qua (vector hóa) kèm số ngày phủ
+    if df.empty:
+        return np.array([], dtype=np.int64), pd.DatetimeIndex([]), np.array([]), np.array([])
+    m_s, m_e = _month_number(df[col_s]), _month_number(df[col_e])
+    lengths = m_e - m_s + 1
+    pos = np.repeat(np.arange(len(df)), lengths)
+    month_no = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths) + np.repeat(m_s, lengths)
+    month = pd.to_datetime({'year': month_no // 12, 'month': month_no % 12 + 1, 'day': 1})
+    month_end = month + pd.offsets.MonthEnd(0)
+
+    s = df[col_s].to_numpy()[pos]
+    e = df[col_e].to_numpy()[pos]
+    lo = np.maximum(s, month.to_numpy())
+    hi = np.minimum(e, month_end.to_numpy())
+    days = (hi - lo).astype('timedelta64[D]').astype(np.int64) + 1
+    return pos, pd.DatetimeIndex(month), days, month_end.dt.days_in_month.to_numpy()
+
+
+def _side(df, col_s, col_e, col_price, col_name, prefix):
+    # Một phía hợp đồng (chủ nhà / khách): cờ hoạt động + tiền đủ tháng + tiền dồn tích
+    valid = df[df[col_s].notna() & df[col_e].notna() & (df[col_s] <= df[col_e])]
+    valid = valid.sort_values(col_price, ascending=False, kind='stable')
+    valid = valid.drop_duplicates(subset=ROOM_KEYS + [col_s, col_e], keep='first')
+
+    pos, month, days, dim = _expand_months(valid, col_s, col_e)
+    exp = valid.iloc[pos][ROOM_KEYS + [col_price, col_name, col_s]].reset_index(drop=True)
+    exp['Tháng'] = month
+    price = exp[col_price].to_numpy(dtype=float)
+    paid = price > 0
+    exp[f'Số ngày {prefix}'] = np.where(paid, days, 0)
+    exp[f'Giá {prefix}'] = np.where(paid, price, 0.0)
+    exp[f'Giá {prefix} dồn tích'] = np.where(paid, price * days / dim, 0.0)
+    exp = exp.sort_values(col_s, kind='stable')
+    return exp.groupby(FACT_KEYS, sort=False).agg(**{
+        f'Có {prefix}': (col_price, 'size'),
+        f'Số ngày {prefix}': (f'Số ngày {prefix}', 'sum'),
+        f'Giá {prefix}': (f'Giá {prefix}', 'sum'),
+        f'Giá {prefix} dồn tích': (f'Giá {prefix} dồn tích', 'sum'),
+        col_name: (col_name, 'last'),
+    })
+
+
+def _payments(df, col_date, cols):
+    sub = df[df[col_date].notna()]
+    if sub.empty: return None
+    tmp = sub[ROOM_KEYS].copy()
+    tmp['Tháng'] = sub[col_date].dt.to_period('M').dt.to_timestamp()
+    for name, src in cols.items():
+        tmp[name] = sub[src].sum(axis=1) if isinstance(src, list) else sub[src]
+    return tmp.groupby(FACT_KEYS, sort=False)[list(cols)].sum()
+
+
+def _clean_rooms(df):
+    df[ROOM_KEYS] = df[ROOM_KEYS].fillna('').astype(str)
+    df['Toà'] = df['Toà'].str.strip()
+    return df[df['Toà'] != '']
+
+
+def build_facts(df_main, df_hh=None, stages=None):
+    # stages: schedule.StageIndex của sổ GIA_HD (None = mọi HĐ một giá)
+    if df_main.empty or not all(c in df_main.columns for c in ROOM_KEYS): return empty_facts()
+    df = _clean_rooms(df_main.reindex(columns=SOURCE_COLUMNS).copy())
+    for c in ['Giá HĐ', 'Giá', 'TT cho chủ nhà', 'Cọc cho chủ nhà', 'KH thanh toán', 'KH cọc']:
+        df[c] = pd.to_numeric(df[c], errors='coerce').fillna(0.0)
+    if df.empty: return empty_facts()
+    hh = _clean_rooms(df_hh.reindex(columns=COLUMNS_HH).copy()) if df_hh is not None and not df_hh.empty else None
+
+    own = stages.expand(df) if stages is not None and len(stages) else df
+    owner = _side(own, 'Ngày ký', 'Ngày hết HĐ', 'Giá HĐ', 'Chủ nhà - sale', 'HĐ')
+    tenant = _side(df, 'Ngày in', 'Ngày out', 'Giá', 'Tên khách thuê', 'thuê')
+    owner = owner.rename(columns={'Có HĐ': 'Có HĐ chủ'})
+    tenant = tenant.rename(columns={'Có thuê': 'Có khách'})
+
+    df['_ngay_ghi_khach'] = df['Ngày in'].fillna(df['Ngày ký'])
+    parts = [owner, tenant,
+             _payments(df, 'Ngày ký', {'TT cho chủ nhà': 'TT cho chủ nhà', 'Cọc cho chủ nhà': 'Cọc cho chủ nhà'}),
+             _payments(df, '_ngay_ghi_khach', {'KH thanh toán': 'KH thanh toán', 'KH cọc': 'KH cọc'})]
+    if hh is not None and not hh.empty:
+        hh['_ngay_ghi_khach'] = hh['Ngày in'].fillna(hh['Ngày ký'])
+        hh['Tiền'] = pd.to_numeric(hh['Tiền'], errors='coerce').fillna(0.0)
+        # Hoa hồng của phòng không còn dòng HOP_DONG nào thì bỏ qua
+        hh = hh[_room_labels(hh).isin(set(_room_labels(df)))]
+        parts.append(_payments(hh, '_ngay_ghi_khach', {'Hoa hồng': 'Tiền'}))
+    facts = pd.concat([p for p in parts if p is not None], axis=1).reset_index()
+
+    facts['Có HĐ chủ'] = facts['Có HĐ chủ'].fillna(0) > 0
+    facts['Có khách'] = facts['Có khách'].fillna(0) > 0
+    for c in SUM_COLUMNS: facts[c] = facts[c].fillna(0.0) if c in facts.columns else 0.0
+    for c in ['Chủ nhà - sale', 'Tên khách thuê']: facts[c] = facts[c].fillna('')
+    return facts[FACT_COLUMNS].sort_values(FACT_KEYS).reset_index(drop=True)
+
+
+def merge_facts(*parts):
+    # Gộp bảng phòng - tháng tính từ các phần dòng rời nhau (ví dụ mảnh lạnh + mảnh nóng):
+    # cộng các cột tiền / ngày, cờ là "có ở ít nhất một phần", tên lấy của phần sau cùng có tên
+    parts = [p for p in parts if p is not None and not p.empty]
+    if not parts: return empty_facts()
+    if len(parts) == 1: return parts[0]
+    df = pd.concat(parts, ignore_index=True)
+    names = ['Chủ nhà - sale', 'Tên khách thuê']
+    df[names] = df[names].replace('', np.nan)
+    agg = {c: 'sum' for c in SUM_COLUMNS}
+    agg.update({'Có HĐ chủ': 'max', 'Có khách': 'max', 'Chủ nhà - sale': 'last', 'Tên khách thuê': 'last'})
+    out = df.groupby(FACT_KEYS, sort=False).agg(agg).reset_index()
+    out[names] = out[names].fillna('')
+    return out[FACT_COLUMNS].sort_values(FACT_KEYS).reset_index(drop=True)
+
+
+def _signatures(df, columns):
+    df = df.reindex(columns=columns)
+    h = pd.util.hash_pandas_object(df.astype(str), index=False)
+    return h.groupby(_room_labels(df).to_numpy()).sum()
+
+
+def room_signatures(df_main, df_hh=None, df_gd=None):
+    # Chữ ký nội dung từng phòng: phòng nào có dòng HĐ / hoa hồng / giai đoạn giá thêm / sửa / xóa thì chữ ký đổi
+    if df_main.empty or not all(c in df_main.columns for c in ROOM_KEYS): return pd.Series(dtype='uint64')
+    # Cộng trên uint64 (tràn thì quay vòng): phòng không có dòng sổ cộng 0, không qua float64 (làm tròn mất bit)
+    sigs = _signatures(df_main, SOURCE_COLUMNS)
+    for extra, cols in [(df_hh, COLUMNS_HH), (df_gd, COLUMNS_GD)]:
+        if extra is not None and not extra.empty:
+            sigs = sigs + _signatures(extra, cols).reindex(sigs.index, fill_value=0).astype('uint64')
+    return sigs
+
+
+def _room_labels(df):
+    return df['Toà'].fillna('').astype(str).str.strip() + '\x1f' + df['Mã căn'].fillna('').astype(str)
+
+
+def rows_in_rooms(df_main, df_facts):
+    # Lọc nhanh: chỉ giữ các dòng HOP_DONG thuộc những phòng có trong df_facts
+    return _room_labels(df_main).isin(set(_room_labels(df_facts))).to_numpy()
+
+
+class FactStore:
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+        self.facts = empty_facts()
+        self._sigs = pd.Series(dtype='uint64')
+        self._load()
+
+    def _load(self):
+        if not self.path or not os.path.exists(self.path): return
+        try:
+            saved = pd.read_pickle(self.path)
+            if list(saved['facts'].columns) != FACT_COLUMNS: return     # file cũ khác cấu trúc -> tính lại
+            self.facts, self._sigs = saved['facts'], saved['sigs']
+        except Exception:
+            self.facts, self._sigs = empty_facts(), pd.Series(dtype='uint64')
+
+    def _save(self):
+        if not self.path: return
+        tmp = f"{self.path}.tmp"
+        pd.to_pickle({'facts': self.facts, 'sigs': self._sigs}, tmp)
+        os.replace(tmp, self.path)
+
+    def sync(self, df_main, df_hh=None, stages=None):
+        # Trả về số phòng phải tính lại (0 = dữ liệu không đổi)
+        with self._lock:
+            sigs = room_signatures(df_main, df_hh, stages.frame if stages is not None else None)
+            # So trên uint64: phòng mới nhận dạng bằng isin, không qua NaN của reindex (ép sang float64)
+            old = self._sigs.reindex(sigs.index, fill_value=0).astype('uint64')
+            changed = sigs.index[~sigs.index.isin(self._sigs.index) | (old.to_numpy() != sigs.to_numpy())]
+            removed = self._sigs.index.difference(sigs.index)
+            if len(changed) == 0 and len(removed) == 0: return 0
+
+            touched = changed.union(removed)
+            keep = ~_room_labels(self.facts).isin(touched).to_numpy() if not self.facts.empty else np.array([], dtype=bool)
+            rows = df_main[_room_labels(df_main).isin(changed).to_numpy()] if len(changed) else df_main.iloc[0:0]
+            rows_hh = df_hh[_room_labels(df_hh).isin(changed).to_numpy()] if df_hh is not None and not df_hh.empty else None
+            parts = [p for p in [self.facts[keep], build_facts(rows, rows_hh, stages)] if not p.empty]
+            self.facts = pd.concat(parts, ignore_index=True).sort_values(FACT_KEYS).reset_index(drop=True) if parts else empty_facts()
+            self._sigs = sigs
+            self._save()
+            return len(touched)
+
+    def month(self, year, month):
+        return self.facts[self.facts['Tháng'] == pd.Timestamp(year, month, 1)]
+
+    def year(self, year):
+        return self.facts[self.facts['Tháng'].dt.year == year] if not self.facts.empty else self.facts
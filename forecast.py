@@ -0,0 +1,197 @@
+import numpy as np
+import pandas as pd
+
+import accrual
+import deposit
+import quality
+
+# ==============================================================================
+# DỰ BÁO DÒNG TIỀN N THÁNG TỚI
+# - Cam kết: HĐ chủ còn hiệu lực (mỗi giai đoạn giá trong sổ GIA_HD là một khoảng giá riêng) và các lượt thuê
+#   hiện tại / đã đặt trước, tính theo ngày phủ trong tháng như accrual.py (giá tháng x ngày / số ngày tháng)
+# - Giả định (what-if): gia hạn HĐ chủ hết hạn trong kỳ theo giá giai đoạn cuối (+ % tăng),
+#   cho thuê lại phòng sau khi khách ra: trống thêm N ngày rồi có khách mới theo giá thuê gần nhất (+ % đổi),
+#   chỉ trong thời gian còn HĐ chủ (thật hoặc giả định gia hạn)
+# - Tiền cọc: khoản cọc khách phải trả / cọc chủ nhà nhận lại rơi vào kỳ dự báo (theo deposit.py)
+# Chuẩn bị (prepare) làm một lần cho mỗi phiên bản dữ liệu; đổi kịch bản chỉ chạy lại project()
+# trên vài nghìn khoảng x N tháng bằng broadcasting NumPy.
+# ==============================================================================
+
+HORIZON_MONTHS = 12
+DEFAULT_VACANCY_DAYS = 30
+
+OWNER = "Chi chủ nhà"
+OWNER_ASSUMED = "Chi chủ nhà (gia hạn giả định)"
+RENT = "Thu khách"
+RENT_ASSUMED = "Thu khách (cho thuê lại giả định)"
+DEPOSIT_OUT = "Trả cọc khách"
+DEPOSIT_BACK = "Nhận lại cọc chủ"
+FLOW_COLUMNS = [RENT, RENT_ASSUMED, OWNER, OWNER_ASSUMED, DEPOSIT_OUT, DEPOSIT_BACK]
+DAY_COLUMNS = ["Ngày có HĐ chủ", "Ngày có khách", "Ngày trống"]
+ROOM_KEYS = ['Toà', 'Mã căn']
+PROJ_COLUMNS = ROOM_KEYS + ['Tháng'] + FLOW_COLUMNS + DAY_COLUMNS + ['Dòng tiền ròng']
+
+
+def _prepare_rows(df_main):
+    df = df_main.reset_index(drop=True).reindex(
+        columns=ROOM_KEYS + ['Tên khách thuê', 'Ngày ký', 'Ngày hết HĐ', 'Giá HĐ', 'Ngày in', 'Ngày out', 'Giá'])
+    df['Toà'] = df['Toà'].fillna('').astype(str).str.strip()
+    df['Mã căn'] = df['Mã căn'].fillna('').astype(str)
+    for c in ['Ngày ký', 'Ngày hết HĐ', 'Ngày in', 'Ngày out']: df[c] = pd.to_datetime(df[c], errors='coerce')
+    for c in ['Giá HĐ', 'Giá']: df[c] = pd.to_numeric(df[c], errors='coerce').fillna(0.0)
+    return df[df['Toà'] != '']
+
+
+def _last_by_room(df, col_order, cols):
+    # Dòng có col_order lớn nhất của mỗi phòng
+    sub = df.dropna(subset=[col_order]).sort_values(col_order, kind='stable')
+    return sub.drop_duplicates(subset=ROOM_KEYS, keep='last').set_index(ROOM_KEYS)[cols]
+
+
+def prepare(df_main, today, stages=None):
+    # Các khoảng HĐ chủ / lượt thuê còn chạm tới từ hôm nay + dòng cuối của mỗi phòng (để gia hạn / cho thuê lại).
+    # stages (schedule.StageIndex): HĐ có giá theo giai đoạn -> mỗi giai đoạn một khoảng, gia hạn theo giá giai đoạn cuối
+    today = pd.Timestamp(today).normalize()
+    df = _prepare_rows(df_main)
+    own = stages.expand(df) if stages is not None and len(stages) else df
+    own = quality.dedupe_intervals(own.dropna(subset=['Ngày ký', 'Ngày hết HĐ']), 'Ngày ký', 'Ngày hết HĐ')
+    ten = df.dropna(subset=['Ngày in'])
+    ten = ten.drop_duplicates(subset=quality.interval_key('Ngày in', 'Ngày out') + ['Tên khách thuê'])
+
+    last_own = _last_by_room(own, 'Ngày hết HĐ', ['Ngày hết HĐ', 'Giá HĐ'])
+    last_ten = _last_by_room(ten.assign(_end=ten['Ngày out'].fillna(pd.Timestamp.max.normalize())), '_end',
+                             ['Ngày out', 'Giá'])
+    rooms = last_own.rename(columns={'Ngày hết HĐ': 'Hết HĐ chủ', 'Giá HĐ': 'Giá HĐ cuối'}).join(
+        last_ten.rename(columns={'Ngày out': 'Khách ra', 'Giá': 'Giá thuê cuối'}), how='outer')
+    rooms['Đang có HĐ chủ'] = rooms['Hết HĐ chủ'] >= today
+
+    return {
+        'today': today,
+        'owner': own[own['Ngày hết HĐ'] >= today][ROOM_KEYS + ['Ngày ký', 'Ngày hết HĐ', 'Giá HĐ']],
+        'tenant': ten[ten['Ngày out'].isna() | (ten['Ngày out'] >= today)][ROOM_KEYS + ['Ngày in', 'Ngày out', 'Giá']],
+        'rooms': rooms.reset_index(),
+        'deposits': deposit.deposit_items(df_main),
+    }
+
+
+def horizon(today, months=HORIZON_MONTHS):
+    # Kỳ dự báo: tháng hiện tại (từ hôm nay) tới hết tháng thứ months
+    starts = pd.date_range(pd.Timestamp(today).normalize().replace(day=1), periods=months, freq='MS')
+    return starts, starts + pd.offsets.MonthEnd(0)
+
+
+def _intervals(keys, start, end, price, kind):
+    return pd.DataFrame({'Toà': keys['Toà'].to_numpy(), 'Mã căn': keys['Mã căn'].to_numpy(),
+                         's': pd.to_datetime(start).to_numpy(), 'e': pd.to_datetime(end).to_numpy(),
+                         'p': np.asarray(price, dtype=float), 'kind': kind})
+
+
+def _room_month(rows, col, starts, ends, today):
+    # Khoảng -> (tiền, ngày) theo phòng x tháng; phần trước hôm nay không tính
+    if rows.empty: return None, None
+    rows = rows.assign(s=rows['s'].where(rows['s'] >= today, today))
+    amount, days = accrual.accrue(rows, 's', 'e', 'p', starts, ends)
+    keys = [rows['Toà'].to_numpy(), rows['Mã căn'].to_numpy()]
+    amount = amount.groupby(keys).sum().stack().rename(col)
+    days = days.groupby(keys).sum().stack()
+    return amount, days
+
+
+def project(base, months=HORIZON_MONTHS, renew_owner=True, owner_increase=0.0,
+            relet=True, vacancy_days=DEFAULT_VACANCY_DAYS, rent_change=0.0):
+    # Bảng phòng x tháng của kịch bản; tiền chi là số dương, Dòng tiền ròng = thu - chi
+    today = base['today']
+    starts, ends = horizon(today, months)
+    end_all = ends[-1]
+    rooms, own, ten = base['rooms'], base['owner'], base['tenant']
+    active = rooms[rooms['Đang có HĐ chủ'].fillna(False)]
+
+    # Gia hạn giả định: từ ngày sau HĐ cuối tới hết kỳ, giá giai đoạn cuối (+ %)
+    if renew_owner:
+        need = active[active['Hết HĐ chủ'] < end_all]
+        own_gia_han = _intervals(need, need['Hết HĐ chủ'] + pd.Timedelta(days=1), end_all,
+                                 need['Giá HĐ cuối'] * (1 + owner_increase), OWNER_ASSUMED)
+        phu_het = pd.Series(end_all, index=active.index)
+    else:
+        own_gia_han = _intervals(active.iloc[:0], [], [], [], OWNER_ASSUMED)
+        phu_het = active['Hết HĐ chủ']
+    cover = pd.Series(phu_het.to_numpy(), index=pd.MultiIndex.from_frame(active[ROOM_KEYS]))
+
+    # Lượt thuê chưa có ngày ra: coi như ở tới hết thời gian còn HĐ chủ (hoặc hết kỳ)
+    ten_key = pd.MultiIndex.from_frame(ten[ROOM_KEYS])
+    ten_end = ten['Ngày out'].fillna(pd.Series(cover.reindex(ten_key).to_numpy(), index=ten.index)).fillna(end_all)
+    rows = [_intervals(own, own['Ngày ký'], own['Ngày hết HĐ'], own['Giá HĐ'], OWNER), own_gia_han,
+            _intervals(ten, ten['Ngày in'], ten_end, ten['Giá'], RENT)]
+
+    # Cho thuê lại giả định: sau khách cuối (đã ra hoặc sẽ ra) + N ngày trống, tới hết thời gian còn HĐ chủ;
+    # phòng chưa từng có khách thì không có giá tham chiếu -> để trống
+    if relet:
+        r = active[(active['Giá thuê cuối'].fillna(0) > 0) & active['Khách ra'].notna()]
+        tu = r['Khách ra'].where(r['Khách ra'] >= today, today - pd.Timedelta(days=1)) + pd.Timedelta(days=1 + vacancy_days)
+        den = cover.reindex(pd.MultiIndex.from_frame(r[ROOM_KEYS])).to_numpy()
+        ok = tu.to_numpy() <= den
+        r = r[ok]
+        rows.append(_intervals(r, tu[ok], den[ok], r['Giá thuê cuối'] * (1 + rent_change), RENT_ASSUMED))
+
+    rows = [x for x in rows if not x.empty]
+    if not rows: return pd.DataFrame(columns=PROJ_COLUMNS)
+    rows = pd.concat(rows, ignore_index=True)
+    parts, days = [], {}
+    for kind in [OWNER, OWNER_ASSUMED, RENT, RENT_ASSUMED]:
+        a, d = _room_month(rows[rows['kind'] == kind], kind, starts, ends, today)
+        if a is None: continue
+        parts.append(a)
+        side = "Ngày có HĐ chủ" if kind in (OWNER, OWNER_ASSUMED) else "Ngày có khách"
+        days[side] = d if side not in days else days[side].add(d, fill_value=0)
+    parts += [v.rename(k) for k, v in days.items()]
+    if not parts: return pd.DataFrame(columns=PROJ_COLUMNS)
+    out = pd.concat(parts, axis=1).fillna(0.0)
+    out.index.names = ROOM_KEYS + ['Tháng']
+    out = out.reset_index().reindex(columns=PROJ_COLUMNS, fill_value=0.0)
+
+    # Ngày: giai đoạn / lượt thuê chồng nhau không đếm quá số ngày của tháng
+    month_len = out['Tháng'].dt.days_in_month
+    for c in ["Ngày có HĐ chủ", "Ngày có khách"]: out[c] = np.minimum(out[c], month_len)
+    out["Ngày trống"] = (out["Ngày có HĐ chủ"] - out["Ngày có khách"]).clip(lower=0)
+
+    out = _add_deposits(out, base['deposits'], today, end_all, renew_owner)
+    out["Dòng tiền ròng"] = (out[RENT] + out[RENT_ASSUMED] + out[DEPOSIT_BACK]
+                             - out[OWNER] - out[OWNER_ASSUMED] - out[DEPOSIT_OUT])
+    return out.sort_values(ROOM_KEYS + ['Tháng']).reset_index(drop=True)
+
+
+def _add_deposits(out, items, today, end_all, renew_owner):
+    if items.empty: return out
+    tra = items[(items['Ngày trả'] >= today) & (items['Ngày trả'] <= end_all)]
+    # Gia hạn HĐ chủ giả định -> cọc chủ nhà chuyển sang HĐ gia hạn, không nhận lại
+    if renew_owner: tra = tra[tra['Loại cọc'] != deposit.CHU_NHA]
+    if tra.empty: return out
+    g = tra.assign(Tháng=tra['Ngày trả'].dt.to_period('M').dt.to_timestamp()).pivot_table(
+        index=ROOM_KEYS + ['Tháng'], columns='Loại cọc', values='Tiền', aggfunc='sum', fill_value=0)
+    g = g.reindex(columns=[deposit.KHACH, deposit.CHU_NHA], fill_value=0)
+    g.columns = [DEPOSIT_OUT, DEPOSIT_BACK]
+    out = out.set_index(ROOM_KEYS + ['Tháng']).drop(columns=[DEPOSIT_OUT, DEPOSIT_BACK])
+    out = out.join(g, how='outer').fillna(0.0).reset_index()
+    return out[PROJ_COLUMNS]
+
+
+def monthly(proj):
+    # Tổng theo tháng + lũy kế dòng tiền ròng + số phòng còn ngày trống
+    cols = FLOW_COLUMNS + ["Ngày trống", "Dòng tiền ròng"]
+    if proj.empty: return pd.DataFrame(columns=['Tháng'] + cols + ['Lũy kế', 'Phòng có ngày trống'])
+    g = proj.groupby('Tháng')[cols].sum()
+    g['Lũy kế'] = g['Dòng tiền ròng'].cumsum()
+    g['Phòng có ngày trống'] = proj[proj['Ngày trống'] > 0].groupby('Tháng').size().reindex(g.index, fill_value=0)
+    return g.reset_index()
+
+
+def by_building(proj):
+    cols = FLOW_COLUMNS + ["Ngày trống", "Dòng tiền ròng"]
+    if proj.empty: return pd.DataFrame(columns=['Toà'] + cols)
+    return proj.groupby('Toà')[cols].sum().sort_values('Dòng tiền ròng').reset_index()
+
+
+def by_room(proj):
+    cols = FLOW_COLUMNS + ["Ngày trống", "Dòng tiền ròng"]
+    if proj.empty: return pd.DataFrame(columns=ROOM_KEYS + cols)
+    return proj.groupby(ROOM_KEYS)[cols].sum().sort_values('Dòng tiền ròng').reset_index()
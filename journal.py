@@ -0,0 +1,378 @@
+import hashlib
+import json
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+import pandas as pd
+
+import commission
+import schedule
+import storage
+from core import normalize_chi_phi, normalize_gia_hd, normalize_hoa_hong, normalize_hop_dong
+
+# ==============================================================================
+# NHẬT KÝ THAY ĐỔI (SHEET NHAT_KY) + DỮ LIỆU TẠI MỘT THỜI ĐIỂM
+# - save_data ghi đè cả sheet; mỗi lần ghi, nhật ký chỉ NỐI THÊM phần chênh lệch so với bản trước:
+#     thêm / xóa : cả dòng (dạng JSON gọn, bỏ ô trống)
+#     sửa        : mỗi ô đổi một dòng (cột, giá trị cũ, giá trị mới)
+#   kèm người sửa, thời điểm, phòng. Mã dòng = hash nội dung dòng (bỏ ô trống, không phụ thuộc thứ tự cột)
+#   + số thứ tự lần lặp, như editor.py; dòng sửa ghi cả mã mới
+# - Mốc (checkpoint): bản đầy đủ của sheet, tạo ở lần ghi đầu tiên và sau mỗi CHECKPOINT_EVERY thay đổi.
+#   Mỗi sheet chỉ có CHECKPOINT_SLOTS worksheet mốc NK_MOC_<sheet>_<ô>, ghi đè xoay vòng -> kho không phình mãi.
+#   Dòng đầu worksheet mốc ghi lần ghi của mốc đó; mốc đã bị ghi đè thì dòng nhật ký của nó không dùng nữa
+# - Dựng lại "tại thời điểm T" từ mốc còn dùng được gần T nhất: phát tiếp các thay đổi sau mốc (mốc trước T)
+#   hoặc phát ngược (mốc sau T: thêm <-> xóa, sửa trả giá trị cũ)
+# - Thời điểm lưu theo UTC kèm múi giờ (+00:00); thời điểm người dùng chọn được đổi sang UTC trước khi so
+# - Ghi nhật ký chạy ở một luồng nền riêng (giữ thứ tự); lỗi nhật ký không chặn việc lưu dữ liệu
+# ==============================================================================
+
+JOURNAL_SHEET = "NHAT_KY"
+JOURNAL_COLUMNS = ["Lần ghi", "Thời điểm", "Người sửa", "Sheet", "Thao tác", "Phòng", "Mã dòng", "Mã mới", "Cột", "Cũ", "Mới"]
+TRACKED_SHEETS = ["HOP_DONG", "CHI_PHI", "HOA_HONG", "GIA_HD"]
+
+OP_ADD = "thêm"
+OP_DELETE = "xóa"
+OP_EDIT = "sửa"
+OP_CHECKPOINT = "mốc"
+
+CHECKPOINT_PREFIX = "NK_MOC_"
+CHECKPOINT_EVERY = 2000    # số thay đổi (dòng nhật ký) giữa hai mốc của một sheet
+CHECKPOINT_SLOTS = 3       # số worksheet mốc của mỗi sheet (ghi đè xoay vòng)
+CHECKPOINT_MARK = "#MỐC"   # ô đầu dòng đánh dấu của worksheet mốc, ô sau là lần ghi của mốc
+CACHE_SECONDS = 60         # đọc lại nhật ký từ kho sau chừng này giây (thấy lần ghi của tiến trình khác)
+TIME_FORMAT = "%Y-%m-%d %H:%M:%S"    # hiển thị; lưu trữ dùng isoformat UTC có múi giờ
+DEFAULT_TZ = "Asia/Ho_Chi_Minh"      # múi giờ của người dùng khi trình duyệt không cho biết
+UNKNOWN_USER = "(không rõ)"
+
+_ROOM_COLUMNS = ["Toà", "Mã căn"]
+
+
+def checkpoint_name(sheet, slot):
+    return f"{CHECKPOINT_PREFIX}{sheet}_{slot}"
+
+
+def stamp(at):
+    # Thời điểm lưu vào nhật ký: UTC, có múi giờ -> so được giữa các máy chủ khác múi giờ
+    return at.astimezone(timezone.utc).isoformat(sep=" ", timespec="seconds")
+
+
+def to_utc(at, tz=None):
+    # Thời điểm người dùng chọn (không kèm múi giờ = giờ tại tz) -> Timestamp UTC
+    at = pd.Timestamp(at)
+    if at.tzinfo is None: at = at.tz_localize(tz or "UTC")
+    return at.tz_convert("UTC")
+
+
+def parse_times(values):
+    # Cột Thời điểm -> Timestamp UTC. Dòng ghi trước khi có múi giờ (giờ máy chủ) coi là giờ địa phương của máy chủ
+    s = pd.Series(values, dtype=object).fillna("").astype(str)
+    out = pd.Series(pd.NaT, index=s.index, dtype="datetime64[ns, UTC]")
+    co_mui = s.str.contains(r"(?:[+-]\d{2}:\d{2}|Z)$", regex=True)
+    if co_mui.any(): out[co_mui] = pd.to_datetime(s[co_mui], utc=True, errors="coerce")
+    cu = ~co_mui & (s != "")
+    if cu.any():
+        local = datetime.now().astimezone().tzinfo
+        out[cu] = pd.to_datetime(s[cu], errors="coerce").dt.tz_localize(local).dt.tz_convert("UTC")
+    return out
+
+
+def local_times(values, tz):
+    # Cột Thời điểm -> chuỗi giờ địa phương của người xem
+    return parse_times(values).dt.tz_convert(tz).dt.strftime(TIME_FORMAT).fillna("")
+
+
+def sheet_rows(values):
+    # Giá trị dạng sheet (dòng đầu là tiêu đề) -> (tiêu đề, [dict cột -> ô khác rỗng])
+    if not values: return [], []
+    header = [str(h).strip() for h in values[0]]
+    out = []
+    for row in values[1:]:
+        out.append({h: str(v) for h, v in zip(header, row) if h and str(v) != ""})
+    return header, out
+
+
+def row_hash(row):
+    text = "\x1e".join(f"{k}\x1f{row[k]}" for k in sorted(row))
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=8).hexdigest()
+
+
+def row_ids(rows):
+    seen = {}
+    ids = []
+    for r in rows:
+        h = row_hash(r)
+        k = seen.get(h, 0)
+        seen[h] = k + 1
+        ids.append(f"{h}-{k}")
+    return ids
+
+
+def room_of(row):
+    return "/".join(row.get(c, "") for c in _ROOM_COLUMNS if c in row) or ""
+
+
+def diff(old_values, new_values):
+    # Chênh lệch giữa hai bản của một sheet -> các dòng nhật ký (chưa có lần ghi / thời điểm / người sửa).
+    # Dòng mất và dòng mới cùng phòng được ghép theo thứ tự thành "sửa" nếu đổi không quá nửa số cột
+    _, old = sheet_rows(old_values)
+    header, new = sheet_rows(new_values)
+    old_ids, new_ids = row_ids(old), row_ids(new)
+    new_set, old_set = set(new_ids), set(old_ids)
+    removed = [(i, r) for i, r in zip(old_ids, old) if i not in new_set]
+    added = [(i, r) for i, r in zip(new_ids, new) if i not in old_set]
+    n_cols = max(len(header), 1)
+
+    by_room = {}
+    for i, r in added: by_room.setdefault(room_of(r), []).append((i, r))
+    out = []
+    for i, r in removed:
+        cands = by_room.get(room_of(r))
+        if cands:
+            j, nr = cands[0]
+            cols = [c for c in dict.fromkeys(list(r) + list(nr)) if r.get(c, "") != nr.get(c, "")]
+            if len(cols) <= max(1, n_cols // 2):
+                cands.pop(0)
+                out += [(OP_EDIT, room_of(nr), i, j, c, r.get(c, ""), nr.get(c, "")) for c in cols]
+                continue
+        out.append((OP_DELETE, room_of(r), i, "", "", json.dumps(r, ensure_ascii=False), ""))
+    for rest in by_room.values():
+        out += [(OP_ADD, room_of(r), "", j, "", "", json.dumps(r, ensure_ascii=False)) for j, r in rest]
+    return out
+
+
+def replay(state, entries):
+    # Áp các dòng nhật ký (theo thứ tự) lên state: dict mã dòng -> dict cột -> ô
+    for op, ma, moi, cot, cu, gia_tri in entries:
+        if op == OP_ADD:
+            state[moi] = json.loads(gia_tri)
+        elif op == OP_DELETE:
+            state.pop(ma, None)
+        elif op == OP_EDIT:
+            # Nhiều ô của cùng một dòng: lần đầu chuyển dòng sang mã mới, các lần sau sửa tiếp trên mã mới
+            row = state.pop(ma, None)
+            if row is None: row = state.get(moi)
+            if row is None: continue
+            if gia_tri == "": row.pop(cot, None)
+            else: row[cot] = gia_tri
+            state[moi] = row
+    return state
+
+
+def unreplay(state, entries):
+    # Ngược của replay: bỏ các dòng nhật ký (thứ tự như khi ghi) khỏi state, đi từ dòng cuối lên
+    for op, ma, moi, cot, cu, gia_tri in reversed(list(entries)):
+        if op == OP_ADD:
+            state.pop(moi, None)
+        elif op == OP_DELETE:
+            state[ma] = json.loads(cu)
+        elif op == OP_EDIT:
+            row = state.pop(moi, None)
+            if row is None: row = state.get(ma)
+            if row is None: continue
+            if cu == "": row.pop(cot, None)
+            else: row[cot] = cu
+            state[ma] = row
+    return state
+
+
+def state_frame(state, columns=None):
+    # state -> bảng chuỗi như đọc từ sheet (ô trống = "")
+    rows = list(state.values())
+    cols = list(columns or [])
+    for r in rows:
+        for c in r:
+            if c not in cols: cols.append(c)
+    if not rows: return pd.DataFrame(columns=cols)
+    return pd.DataFrame(rows, columns=cols).fillna("")
+
+
+class Journal:
+    def __init__(self, backend, checkpoint_every=CHECKPOINT_EVERY):
+        self.backend = backend
+        self.checkpoint_every = checkpoint_every
+        self._lock = threading.Lock()
+        self._entries = None        # bảng nhật ký đã đọc (chuỗi)
+        self._read_at = 0.0
+        self._checkpoints = {}      # (tên worksheet mốc, lần ghi) -> (tiêu đề, state) - nội dung của một mốc không đổi
+        self._pool = ThreadPoolExecutor(max_workers=1, thread_name_prefix="mt60-journal")
+        self.last_error = None
+
+    # --- ghi ---
+    def record(self, sheet, old_df, new_df, user=None):
+        # Gọi sau khi ghi sheet thành công; chạy nền, trả về Future
+        if sheet not in TRACKED_SHEETS: return None
+        old_values = storage.frame_to_values(old_df) if old_df is not None else []
+        new_values = storage.frame_to_values(new_df)
+        return self._pool.submit(self._record, sheet, old_values, new_values, user or UNKNOWN_USER, datetime.now(timezone.utc))
+
+    def _record(self, sheet, old_values, new_values, user, at):
+        try:
+            changes = diff(old_values, new_values)
+            if not changes: return 0
+            # Chưa thấy nhật ký nào -> đọc lại kho trước khi tạo sheet (tránh ghi đè nhật ký của tiến trình khác)
+            ent = self.entries(refresh=self._entries is None or self._entries.empty)
+            thoi_diem = stamp(at)
+            lan = f"{int(at.timestamp() * 1000):x}"
+            rows = []
+            # Sheet chưa có mốc nào -> bản trước lần ghi này là mốc gốc
+            if not self._has_checkpoint(ent, sheet):
+                rows.append(self._write_checkpoint(sheet, old_values, lan, thoi_diem, user))
+            rows += [[lan, thoi_diem, user, sheet, op, phong, ma, moi, cot, cu, gia_tri]
+                     for op, phong, ma, moi, cot, cu, gia_tri in changes]
+            self._append(rows)
+            # Đủ số thay đổi -> bản vừa ghi làm mốc mới (chính là nội dung đã lưu, không cần phát lại)
+            if self._since_checkpoint(sheet) >= self.checkpoint_every:
+                self._append([self._write_checkpoint(sheet, new_values, lan, thoi_diem, user)])
+            self.last_error = None
+            return len(changes)
+        except Exception as e:
+            self.last_error = e
+            return None
+
+    def _write_checkpoint(self, sheet, values, lan, thoi_diem, user):
+        # Ô kế tiếp trong vòng xoay của sheet (ghi đè mốc cũ nhất); dòng đầu đánh dấu lần ghi của mốc
+        ent = self.entries()
+        slot = int(((ent['Sheet'] == sheet) & (ent['Thao tác'] == OP_CHECKPOINT)).sum()) % CHECKPOINT_SLOTS
+        name = checkpoint_name(sheet, slot)
+        self.backend.update(name, [[CHECKPOINT_MARK, lan]] + list(values))
+        with self._lock:
+            self._checkpoints[(name, lan)] = self._parse_checkpoint(values)
+        return [lan, thoi_diem, user, sheet, OP_CHECKPOINT, "", name, "", "", "", str(max(len(values) - 1, 0))]
+
+    def _append(self, rows):
+        if not rows: return
+        with self._lock:
+            if self._entries is None or self._entries.empty:
+                self.backend.update(JOURNAL_SHEET, [JOURNAL_COLUMNS] + rows)
+            else:
+                self.backend.append_rows(JOURNAL_SHEET, rows)
+            add = pd.DataFrame(rows, columns=JOURNAL_COLUMNS)
+            self._entries = add if self._entries is None or self._entries.empty else pd.concat([self._entries, add], ignore_index=True)
+
+    # --- đọc ---
+    def entries(self, refresh=False):
+        # Toàn bộ nhật ký (chuỗi, theo thứ tự nối thêm)
+        with self._lock:
+            if refresh or self._entries is None or time.time() - self._read_at > CACHE_SECONDS:
+                try:
+                    values = self.backend.get_all_values(JOURNAL_SHEET)
+                except Exception:
+                    values = []
+                if len(values) > 1:
+                    header = [str(h).strip() for h in values[0]]
+                    df = pd.DataFrame([list(r) + [""] * (len(header) - len(r)) for r in values[1:]], columns=header)
+                    self._entries = df.reindex(columns=JOURNAL_COLUMNS).fillna("")
+                else:
+                    self._entries = pd.DataFrame(columns=JOURNAL_COLUMNS)
+                self._read_at = time.time()
+            return self._entries
+
+    def _has_checkpoint(self, ent, sheet):
+        return bool(((ent['Sheet'] == sheet) & (ent['Thao tác'] == OP_CHECKPOINT)).any())
+
+    def _since_checkpoint(self, sheet):
+        ent = self.entries()
+        sub = ent[ent['Sheet'] == sheet]
+        moc = (sub['Thao tác'] == OP_CHECKPOINT).to_numpy()
+        if not moc.any(): return len(sub)
+        return int(len(sub) - 1 - moc.nonzero()[0][-1])
+
+    def _parse_checkpoint(self, values):
+        header, rows = sheet_rows(values)
+        return header, dict(zip(row_ids(rows), rows))
+
+    def _checkpoint(self, name, lan):
+        # (tiêu đề, state) của mốc; None nếu worksheet đã bị ghi đè bằng mốc khác / không đọc được
+        with self._lock:
+            if (name, lan) in self._checkpoints: return self._checkpoints[(name, lan)]
+        try:
+            values = self.backend.get_all_values(name)
+        except Exception:
+            return None
+        if values and values[0] and values[0][0] == CHECKPOINT_MARK:
+            if len(values[0]) < 2 or values[0][1] != lan: return None
+            values = values[1:]
+        elif is_checkpoint_slot(name):
+            return None
+        parsed = self._parse_checkpoint(values)
+        with self._lock:
+            self._checkpoints[(name, lan)] = parsed
+        return parsed
+
+    def _state_as_of(self, sheet, at):
+        # (tiêu đề, state) của sheet tại thời điểm at (None = mới nhất, có múi giờ hoặc UTC);
+        # sheet chưa từng ghi qua nhật ký / không còn mốc nào đọc được -> (None, None)
+        ent = self.entries()
+        sub = ent[ent['Sheet'] == sheet].reset_index(drop=True)
+        moc_all = (sub['Thao tác'] == OP_CHECKPOINT).to_numpy().nonzero()[0]
+        if len(moc_all) == 0: return None, None
+        n = len(sub)
+        if at is not None:
+            # Nhật ký nối thêm theo thứ tự ghi -> cắt tại dòng cuối cùng không muộn hơn at
+            hit = (parse_times(sub['Thời điểm']) <= to_utc(at)).to_numpy().nonzero()[0]
+            n = int(hit[-1]) + 1 if len(hit) else 0
+        # Mốc còn dùng được: worksheet chưa bị mốc sau ghi đè; thử từ mốc gần điểm cắt nhất
+        names = sub['Mã dòng'].to_numpy()
+        valid = [i for i in moc_all if not (names[moc_all[moc_all > i]] == names[i]).any()]
+        ops = sub[['Thao tác', 'Mã dòng', 'Mã mới', 'Cột', 'Cũ', 'Mới']]
+        for i in sorted(valid, key=lambda i: (0, n - i) if i < n else (1, i - n)):
+            moc = self._checkpoint(names[i], sub['Lần ghi'].iloc[i])
+            if moc is None: continue
+            header, base = moc
+            state = dict((k, dict(v)) for k, v in base.items())
+            # Mốc ở vị trí i = trạng thái sau mọi dòng nhật ký đứng trước nó
+            if i < n: return header, replay(state, ops.iloc[i + 1:n].itertuples(index=False, name=None))
+            return header, unreplay(state, ops.iloc[n:i].itertuples(index=False, name=None))
+        return None, None
+
+    def as_of(self, sheet, at):
+        # Bảng chuỗi của sheet tại thời điểm at (như đọc từ kho); None nếu sheet chưa từng ghi qua nhật ký
+        header, state = self._state_as_of(sheet, at)
+        if state is None: return None
+        df = state_frame(state, header)
+        return pd.DataFrame(storage.values_to_records(storage.frame_to_values(df)), columns=df.columns)
+
+    def started_at(self, sheet=None):
+        # Thời điểm (UTC) của dòng nhật ký đầu tiên - sớm nhất có thể dựng lại
+        ent = self.entries()
+        sub = ent[(ent['Sheet'] == sheet) if sheet else ent['Sheet'].ne('')]
+        return parse_times(sub['Thời điểm']).min() if not sub.empty else None
+
+    def history(self, sheet=None, room="", column=None, user=None, limit=500):
+        # Các thay đổi gần nhất trước (bỏ dòng mốc), lọc theo sheet / phòng / cột / người sửa
+        ent = self.entries()
+        df = ent[ent['Thao tác'] != OP_CHECKPOINT]
+        if sheet: df = df[df['Sheet'] == sheet]
+        if room: df = df[df['Phòng'].str.contains(room.strip(), case=False, regex=False)]
+        if column: df = df[df['Cột'] == column]
+        if user: df = df[df['Người sửa'] == user]
+        return df.iloc[::-1].head(limit)
+
+
+def frames_as_of(journal, at, current):
+    # Các bảng đã chuẩn hóa tại thời điểm at, như Snapshot: (HOP_DONG, CHI_PHI, HOA_HONG, StageIndex).
+    # current: sheet -> bảng hiện tại, dùng cho sheet chưa từng ghi qua nhật ký (chưa đổi từ khi bắt đầu).
+    # Chuẩn hóa với sheet=None -> không đụng thống kê định dạng ngày của dữ liệu hiện tại
+    raw = {}
+    for sheet in TRACKED_SHEETS:
+        df = journal.as_of(sheet, at)
+        raw[sheet] = df if df is not None else current.get(sheet, pd.DataFrame()).copy()
+    df_main = normalize_hop_dong(raw["HOP_DONG"], None)
+    df_cp = normalize_chi_phi(raw["CHI_PHI"], None)
+    df_hh = normalize_hoa_hong(raw["HOA_HONG"], None)
+    df_gd = normalize_gia_hd(raw["GIA_HD"], None)
+    df_main, df_hh, _ = commission.split_legacy(df_main, df_hh)
+    df_main, df_gd, _ = schedule.split_legacy(df_main, df_gd)
+    return df_main, df_cp, df_hh, schedule.StageIndex(df_gd)
+
+
+def is_checkpoint_sheet(name):
+    return bool(re.match(rf"^{CHECKPOINT_PREFIX}", str(name)))
+
+
+def is_checkpoint_slot(name):
+    # Worksheet mốc xoay vòng (NK_MOC_<sheet>_<ô>); mốc kiểu cũ mang thời điểm trong tên, không bị ghi đè
+    return bool(re.match(rf"^{CHECKPOINT_PREFIX}.+_\d{{1,2}}$", str(name)))
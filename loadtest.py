@@ -0,0 +1,326 @@
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import date, timedelta
+
+import pandas as pd
+
+import archive
+import facts
+import journal
+import quality
+import recompute
+import revisions
+import schedule
+import storage
+from core import (COLUMNS, COLUMNS_CP, COLUMNS_GD, COLUMNS_HH, assign_row_ids, normalize_gia_hd, normalize_hoa_hong,
+                  normalize_hop_dong)
+
+# ==============================================================================
+# ĐO TẢI TRÊN KHO CỤC BỘ
+# Mô phỏng N phiên làm việc đồng thời (lưu form, xem tab, upload Excel) trên
+# SQLite / bộ nhớ - không đụng dữ liệu thật và không tốn quota Google Sheets.
+# Các phiên đi đúng đường của quanly.py: đọc Snapshot của một RecomputeWorker dùng chung,
+# lưu bằng revisions.save (ghi có điều kiện, gộp khi có người lưu trước) rồi ghi nhật ký + báo luồng nền.
+#   python loadtest.py --sessions 20 --ops 30 --rows 5000
+# Đo khởi động lạnh (mỗi lần một tiến trình Python mới, như khi app vừa thức dậy):
+#   python loadtest.py --startup --rows 5000 --repeat 3
+# Kiểm tra bảng phòng - tháng tính lại đúng phòng vừa sửa (có / không có dòng HOA_HONG, GIA_HD):
+#   python loadtest.py --check-facts
+# ==============================================================================
+
+TOA_NHA = ["MT60", "MT61", "OC1A", "OC1B", "OC2A", "OC2B", "OC3"]
+PAYEES = ["Công ty", "Cá Nhân", "SALE THẢO", "SALE NGA", "SALE LINH"]
+
+# Tỉ lệ các thao tác của một nhân viên trong ngày
+OP_WEIGHTS = {"tab_view": 6, "form_save": 3, "upload": 1}
+
+
+def make_hop_dong(n_rows, seed=0):
+    rng = random.Random(seed)
+    base = pd.Timestamp("2020-01-01")
+    rows = []
+    for _ in range(n_rows):
+        toa = rng.choice(TOA_NHA)
+        ngay_ky = base + timedelta(days=rng.randint(0, 365 * 6))
+        ngay_in = ngay_ky + timedelta(days=rng.randint(0, 60))
+        gia_hd = rng.randrange(4_000_000, 12_000_000, 100_000)
+        rows.append({
+            "Tòa nhà": toa, "Mã căn": str(rng.randint(101, 2520)), "Toà": toa,
+            "Chủ nhà - sale": f"Chủ {rng.randint(1, 400)}",
+            "Ngày ký": ngay_ky, "Ngày hết HĐ": ngay_ky + timedelta(days=365),
+            "Giá HĐ": gia_hd, "TT cho chủ nhà": gia_hd, "Cọc cho chủ nhà": gia_hd,
+            "Tên khách thuê": f"Khách {rng.randint(1, 5000)}",
+            "Ngày in": ngay_in, "Ngày out": ngay_in + timedelta(days=rng.choice([30, 90, 180, 365])),
+            "Giá": gia_hd + rng.randrange(500_000, 3_000_000, 100_000),
+            "KH thanh toán": 0, "KH cọc": gia_hd,
+            "Hết hạn khách hàng": "", "Ráp khách khi hết hạn": ""
+        })
+    return pd.DataFrame(rows, columns=COLUMNS)
+
+
+def make_hoa_hong(df_hd, seed=0):
+    # Khoảng 1/3 dòng HĐ có hoa hồng, chia cho 1-2 người nhận
+    rng = random.Random(seed)
+    rows = []
+    for toa, can, ky, vao in zip(df_hd["Toà"], df_hd["Mã căn"], df_hd["Ngày ký"], df_hd["Ngày in"]):
+        if rng.random() > 0.33: continue
+        for nguoi in rng.sample(PAYEES, rng.choice([1, 2])):
+            rows.append({"Toà": toa, "Mã căn": can, "Ngày ký": ky, "Ngày in": vao,
+                         "Người nhận": nguoi, "Tiền": rng.choice([300_000, 500_000, 1_000_000])})
+    return pd.DataFrame(rows, columns=COLUMNS_HH)
+
+
+def make_gia_hd(df_hd, seed=0):
+    # Khoảng 1/10 HĐ đổi giá giữa kỳ: GĐ1 nửa năm đầu, GĐ2 nửa năm sau giá cao hơn
+    rng = random.Random(seed)
+    rows = []
+    for toa, can, ky, het, gia in zip(df_hd["Toà"], df_hd["Mã căn"], df_hd["Ngày ký"], df_hd["Ngày hết HĐ"], df_hd["Giá HĐ"]):
+        if rng.random() > 0.1: continue
+        giua = ky + timedelta(days=182)
+        rows.append({"Toà": toa, "Mã căn": can, "Ngày ký": ky, "Từ ngày": ky, "Đến ngày": giua, "Giá HĐ": gia})
+        rows.append({"Toà": toa, "Mã căn": can, "Ngày ký": ky, "Từ ngày": giua + timedelta(days=1), "Đến ngày": het,
+                     "Giá HĐ": gia + rng.choice([200_000, 500_000])})
+    return pd.DataFrame(rows, columns=COLUMNS_GD)
+
+
+def make_chi_phi(n_rows, seed=0):
+    rng = random.Random(seed)
+    base = pd.Timestamp("2020-01-01")
+    return pd.DataFrame([{
+        "Ngày": base + timedelta(days=rng.randint(0, 365 * 6)),
+        "Mã căn": str(rng.randint(101, 2520)),
+        "Loại": rng.choice(["Điện", "Nước", "Net", "Dọn dẹp", "Khác"]),
+        "Tiền": rng.randrange(50_000, 1_500_000, 10_000),
+        "Chỉ số đồng hồ": str(rng.randint(0, 99999)),
+    } for _ in range(n_rows)], columns=COLUMNS_CP)
+
+
+def seed_backend(backend, n_rows, seed=0):
+    df_hd = make_hop_dong(n_rows, seed)
+    backend.update("HOP_DONG", storage.frame_to_values(df_hd))
+    backend.update("HOA_HONG", storage.frame_to_values(make_hoa_hong(df_hd, seed)))
+    backend.update("GIA_HD", storage.frame_to_values(make_gia_hd(df_hd, seed)))
+    backend.update("CHI_PHI", storage.frame_to_values(make_chi_phi(max(n_rows // 2, 1), seed)))
+
+
+# --- CÁC THAO TÁC CỦA MỘT PHIÊN (giống luồng trong quanly.py) ---
+class App:
+    # Phần dùng chung cả tiến trình như các st.cache_resource của quanly.py: luồng nền + nhật ký
+    def __init__(self, backend, facts_path):
+        def fetch(tab_name):
+            return revisions.frame_of(backend.get_all_values(tab_name))
+        self.backend = backend
+        self.journal = journal.Journal(backend)
+        kho_lanh = archive.Archive(backend, archive.get_horizon_days(), journal=self.journal)
+        self.worker = recompute.RecomputeWorker(fetch, facts.FactStore(facts_path), archive=kho_lanh)
+
+    def save(self, snap, tab_name, df, user):
+        # Như save_data + da_ghi: ghi có điều kiện theo phiên bản của Snapshot đang xem, rồi nhật ký + báo luồng nền.
+        # Trả về (số xung đột, có gộp không); hết lượt ghi -> lỗi (trang báo "bấm lưu lại")
+        normalize = not ((snap.so_hh_chuyen or snap.so_gd_chuyen) and tab_name in ("HOP_DONG", "GIA_HD"))
+        out, before, conflicts, merged = revisions.save(
+            self.backend, tab_name, df, snap.raw.get(tab_name), snap.sheet_versions.get(tab_name), normalize)
+        if out is None: raise RuntimeError("Nhiều người đang lưu cùng lúc")
+        self.journal.record(tab_name, before, out, user)
+        self.worker.wait(self.worker.submit_write(tab_name, out), recompute.SAVE_WAIT)
+        return len(conflicts), merged
+
+
+def op_tab_view(app, rng):
+    # Mở trang: Snapshot mới nhất + các bảng dẫn xuất dùng chung (tính một lần cho mỗi phiên bản dữ liệu)
+    snap = app.worker.current()
+    snap.shared('chat_luong', lambda: quality.scan(snap.df_main, snap.date_issues))
+    snap.year(date.today().year)
+    return 0, False
+
+def op_form_save(app, rng, user):
+    snap = app.worker.current()
+    new_row = make_hop_dong(1, seed=rng.random())
+    return app.save(snap, "HOP_DONG", assign_row_ids(pd.concat([snap.df_main, new_row], ignore_index=True)), user)
+
+def op_upload(app, rng, n_rows, user):
+    snap = app.worker.current()
+    return app.save(snap, "HOP_DONG", assign_row_ids(make_hop_dong(n_rows, seed=rng.random())), user)
+
+
+def run_session(app, n_ops, n_rows, seed, results, lock):
+    rng = random.Random(seed)
+    user = f"phiên {seed}"
+    ops, weights = list(OP_WEIGHTS), list(OP_WEIGHTS.values())
+    for _ in range(n_ops):
+        op = rng.choices(ops, weights)[0]
+        t0 = time.perf_counter()
+        try:
+            if op == "tab_view": conflicts, merged = op_tab_view(app, rng)
+            elif op == "form_save": conflicts, merged = op_form_save(app, rng, user)
+            else: conflicts, merged = op_upload(app, rng, n_rows, user)
+            ok = True
+        except Exception:
+            conflicts, merged, ok = 0, False, False
+        with lock:
+            results.append((op, time.perf_counter() - t0, ok, merged, conflicts))
+
+
+def run_load_test(backend, sessions, ops_per_session, n_rows, facts_path):
+    results, lock = [], threading.Lock()
+    app = App(backend, facts_path)
+    app.worker.current()    # app đã chạy sẵn: đo các phiên, không đo lần tải đầu
+    threads = [
+        threading.Thread(target=run_session, args=(app, ops_per_session, n_rows, i, results, lock))
+        for i in range(sessions)
+    ]
+    t0 = time.perf_counter()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    wall = time.perf_counter() - t0
+
+    df = pd.DataFrame(results, columns=["op", "latency", "ok", "merged", "conflicts"])
+    summary = df.groupby("op").agg(
+        count=("latency", "size"),
+        errors=("ok", lambda s: int((~s).sum())),
+        merged=("merged", "sum"),
+        conflicts=("conflicts", "sum"),
+        p50_ms=("latency", lambda s: s.quantile(0.50) * 1000),
+        p95_ms=("latency", lambda s: s.quantile(0.95) * 1000),
+        max_ms=("latency", lambda s: s.max() * 1000),
+    )
+    return summary, len(df) / wall if wall > 0 else 0.0, wall
+
+
+# --- KIỂM TRA BẢNG PHÒNG - THÁNG TÍNH LẠI THEO PHÒNG ---
+def check_fact_sync(n_rows=300, edits=100, seed=0):
+    # Sửa lần lượt từng giá trên một phòng: FactStore.sync phải báo phòng đó đổi và bảng phòng - tháng
+    # phải khớp với tính lại từ đầu. Trả về {tình huống: số lần sync bỏ sót}
+    df_main = normalize_hop_dong(_as_read(make_hop_dong(n_rows, seed)), None)
+    df_hh = normalize_hoa_hong(_as_read(make_hoa_hong(df_main, seed)), None)
+    df_gd = normalize_gia_hd(_as_read(make_gia_hd(df_main, seed)), None)
+    rooms = lambda df: set(zip(df['Toà'], df['Mã căn']))
+    co_hh, co_gd = rooms(df_hh), rooms(df_gd)
+    cases = {
+        "không có sổ": next(r for r in rooms(df_main) if r not in co_hh and r not in co_gd),
+        "có HOA_HONG": next(r for r in sorted(co_hh) if r not in co_gd),
+        "có GIA_HD": sorted(co_gd)[0],
+    }
+    missed = {}
+    for name, (toa, can) in cases.items():
+        store = facts.FactStore(None)
+        main, hh, gd = df_main.copy(), df_hh.copy(), df_gd.copy()
+        store.sync(main, hh, schedule.StageIndex(gd))
+        row = main.index[(main['Toà'] == toa) & (main['Mã căn'] == can)][0]
+        missed[name] = 0
+        for k in range(edits):
+            # Lần chẵn sửa Giá HĐ của dòng HĐ, lần lẻ sửa dòng sổ của phòng (nếu có)
+            if k % 2 and name == "có HOA_HONG":
+                hh.loc[hh.index[(hh['Toà'] == toa) & (hh['Mã căn'] == can)][0], 'Tiền'] += 100_000
+            elif k % 2 and name == "có GIA_HD":
+                gd.loc[gd.index[(gd['Toà'] == toa) & (gd['Mã căn'] == can)][-1], 'Giá HĐ'] += 100_000
+            else:
+                main.loc[row, 'Giá HĐ'] += 100_000
+            stages = schedule.StageIndex(gd)
+            if store.sync(main, hh, stages) == 0: missed[name] += 1
+        full = facts.build_facts(main, hh, stages)
+        cols = ['Giá HĐ dồn tích', 'Hoa hồng']
+        assert store.facts[cols].sum().round().equals(full[cols].sum().round()), f"{name}: bảng phòng - tháng lệch tính lại"
+    return missed
+
+
+def _as_read(df):
+    # Bảng như vừa đọc từ kho (mọi ô là chuỗi)
+    return pd.DataFrame(storage.values_to_records(storage.frame_to_values(df)), columns=df.columns)
+
+
+# --- KHỞI ĐỘNG LẠNH ---
+# Mỗi lần đo là một tiến trình Python mới (như khi app vừa thức dậy), đo lần lượt:
+#   import_s : import đúng các module quanly.py import ở đầu file (đọc bằng ast)
+#   connect_s: mở kho dữ liệu
+#   data_s   : Snapshot đầu tiên của luồng nền (đọc song song các sheet + dựng bảng dẫn xuất)
+# và liệt kê các module nặng đã bị import tới lúc đó (genai / xlsxwriter chỉ nên có khi dùng tới)
+HEAVY_MODULES = ["gspread", "google.genai", "plotly", "xlsxwriter"]
+
+_STARTUP_SCRIPT = """
+import ast, importlib, json, sys, time
+app, kind, db, facts_path = sys.argv[1:5]
+t0 = time.perf_counter()
+for node in ast.parse(open(app, encoding="utf-8").read()).body:
+    if isinstance(node, ast.Import):
+        for a in node.names: importlib.import_module(a.name)
+    elif isinstance(node, ast.ImportFrom) and node.module:
+        importlib.import_module(node.module)
+t_import = time.perf_counter() - t0
+import archive, facts, recompute, revisions, storage
+import pandas as pd
+backend = storage.open_local_backend(kind, db)
+t_connect = time.perf_counter() - t0
+def fetch(tab_name):
+    return revisions.frame_of(backend.get_all_values(tab_name))
+worker = recompute.RecomputeWorker(fetch, facts.FactStore(facts_path),
+                                   archive=archive.Archive(backend, archive.get_horizon_days()))
+snap = worker.current()
+t_data = time.perf_counter() - t0
+print(json.dumps({"import_s": t_import, "connect_s": t_connect, "data_s": t_data,
+                  "rows": len(snap.df_main) if snap is not None else 0,
+                  "heavy": [m for m in sys.argv[5:] if m in sys.modules]}))
+"""
+
+
+def measure_startup(n_rows, repeat=3):
+    app = os.path.join(os.path.dirname(os.path.abspath(__file__)), "quanly.py")
+    runs = []
+    with tempfile.TemporaryDirectory() as tmp:
+        db = os.path.join(tmp, "startup.db")
+        seed_backend(storage.SQLiteBackend(db), n_rows)
+        for i in range(repeat):
+            # Mỗi lần một file facts mới: không có sẵn bảng tổng hợp từ lần trước
+            args = [app, storage.BACKEND_SQLITE, db, os.path.join(tmp, f"facts_{i}.pkl")] + HEAVY_MODULES
+            out = subprocess.run([sys.executable, "-c", _STARTUP_SCRIPT] + args, cwd=os.path.dirname(app),
+                                 capture_output=True, text=True, check=True)
+            runs.append(json.loads(out.stdout.strip().splitlines()[-1]))
+    return pd.DataFrame(runs)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Đo tải MT60 trên kho cục bộ")
+    parser.add_argument("--sessions", type=int, default=10, help="Số phiên đồng thời")
+    parser.add_argument("--ops", type=int, default=20, help="Số thao tác mỗi phiên")
+    parser.add_argument("--rows", type=int, default=2000, help="Số dòng HOP_DONG ban đầu")
+    parser.add_argument("--backend", choices=[storage.BACKEND_MEMORY, storage.BACKEND_SQLITE], default=storage.BACKEND_MEMORY)
+    parser.add_argument("--db", default="mt60_loadtest.db", help="File SQLite khi --backend sqlite")
+    parser.add_argument("--startup", action="store_true", help="Đo khởi động lạnh của app thay vì đo tải")
+    parser.add_argument("--repeat", type=int, default=3, help="Số lần đo khi --startup")
+    parser.add_argument("--check-facts", action="store_true", help="Kiểm tra bảng phòng - tháng tính lại đúng phòng vừa sửa")
+    args = parser.parse_args()
+
+    if args.check_facts:
+        missed = check_fact_sync()
+        for name, n in missed.items(): print(f"{name}: {n} lần sửa không được tính lại")
+        if any(missed.values()): sys.exit(1)
+        print("Bảng phòng - tháng: OK")
+        return
+
+    if args.startup:
+        df = measure_startup(args.rows, args.repeat)
+        print(f"Khởi động lạnh | {args.rows} dòng | {args.repeat} lần")
+        print(df[["import_s", "connect_s", "data_s", "rows"]].round(2).to_string())
+        print(f"Trung vị: import {df['import_s'].median():.2f}s | có dữ liệu {df['data_s'].median():.2f}s")
+        print("Module nặng đã import: " + (", ".join(sorted(set(sum(df['heavy'], [])))) or "(không)"))
+        return
+
+    backend = storage.open_local_backend(args.backend, args.db)
+    seed_backend(backend, args.rows)
+    with tempfile.TemporaryDirectory() as tmp:
+        summary, throughput, wall = run_load_test(backend, args.sessions, args.ops, args.rows, os.path.join(tmp, "facts.pkl"))
+
+    print(f"Kho: {backend.name} | {args.sessions} phiên x {args.ops} thao tác | {args.rows} dòng")
+    print(summary.round(1).to_string())
+    print(f"Tổng thời gian: {wall:.2f}s | Thông lượng: {throughput:.1f} thao tác/giây")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+import threading
+from collections import deque
+
+import numpy as np
+import pandas as pd
+
+# ==============================================================================
+# ĐỐI SOÁT ĐỒNG HỒ ĐIỆN / NƯỚC (CHI_PHI - cột "Chỉ số đồng hồ")
+# - Mỗi đồng hồ = (Mã căn, Loại). Sắp xếp theo ngày, diff trong từng nhóm -> tiêu thụ
+# - Đơn giá = Tiền / Tiêu thụ
+# - Cảnh báo: không đọc được chỉ số, chỉ số giảm, tiêu thụ tăng đột biến
+#   (gấp SPIKE_FACTOR lần trung vị của BASELINE_WINDOW lần đọc trước, cần ít nhất BASELINE_MIN lần)
+# MeterLedger giữ trạng thái cuối của từng đồng hồ để khi CHI_PHI chỉ được nối thêm
+# dòng mới thì chỉ tính các dòng đó, không quét lại cả bảng.
+# ==============================================================================
+
+METER_TYPES = ["Điện", "Nước"]
+SPIKE_FACTOR = 3.0
+BASELINE_WINDOW = 6
+BASELINE_MIN = 3
+
+FLAG_UNREADABLE = "Không đọc được chỉ số"
+FLAG_NEGATIVE = "Chỉ số giảm"
+FLAG_SPIKE = "Tăng đột biến"
+
+RESULT_COLUMNS = ["Ngày", "Mã căn", "Loại", "Chỉ số", "Chỉ số trước", "Tiêu thụ", "Tiền", "Đơn giá", "Cảnh báo"]
+METER_KEYS = ["Mã căn", "Loại"]
+
+
+def parse_readings(col):
+    # Lấy số cuối cùng trong ô ("1.234", "1234,5", "cũ 1200 mới 1350" -> 1350)
+    token = col.astype(str).str.strip().str.extract(r'(\d[\d.,]*)\D*$', expand=False).fillna("")
+    token = token.str.rstrip('.,')
+    both = token.str.contains(',') & token.str.contains(r'\.')
+    only_comma = token.str.contains(',') & ~both
+    only_dot = token.str.contains(r'\.') & ~both
+
+    out = token.copy()
+    out[both] = token[both].str.replace('.', '', regex=False).str.replace(',', '.', regex=False)
+    # "1,234" là phân tách nghìn, "12,5" là thập phân
+    comma_thousands = only_comma & token.str.match(r'^\d{1,3}(,\d{3})+$')
+    out[only_comma & comma_thousands] = token[only_comma & comma_thousands].str.replace(',', '', regex=False)
+    out[only_comma & ~comma_thousands] = token[only_comma & ~comma_thousands].str.replace(',', '.', regex=False)
+    dot_thousands = only_dot & token.str.match(r'^\d{1,3}(\.\d{3})+$')
+    out[dot_thousands] = token[dot_thousands].str.replace('.', '', regex=False)
+    return pd.to_numeric(out, errors='coerce')
+
+
+def _meter_rows(df_cp):
+    if df_cp.empty or not all(c in df_cp.columns for c in ["Ngày", "Mã căn", "Loại", "Chỉ số đồng hồ"]):
+        return pd.DataFrame(columns=["Ngày", "Mã căn", "Loại", "Tiền", "Chỉ số"])
+    df = df_cp[df_cp["Loại"].isin(METER_TYPES)].copy()
+    df["Chỉ số"] = parse_readings(df["Chỉ số đồng hồ"])
+    if "Tiền" not in df.columns: df["Tiền"] = 0.0
+    return df[["Ngày", "Mã căn", "Loại", "Tiền", "Chỉ số"]]
+
+
+def _flags(reading, delta, baseline):
+    flag = np.full(len(reading), "", dtype=object)
+    flag[np.isnan(reading)] = FLAG_UNREADABLE
+    flag[delta < 0] = FLAG_NEGATIVE
+    spike = (delta > 0) & ~np.isnan(baseline) & (delta > SPIKE_FACTOR * baseline)
+    flag[spike] = FLAG_SPIKE
+    return flag
+
+
+def compute_consumption(df_cp):
+    # Tính toàn bộ: một lần sort + groupby diff (vector hóa)
+    df = _meter_rows(df_cp)
+    if df.empty: return pd.DataFrame(columns=RESULT_COLUMNS)
+    df = df.sort_values(METER_KEYS + ["Ngày"], kind="stable")
+
+    # Dòng không đọc được chỉ số không làm gãy chuỗi: so với lần đọc hợp lệ gần nhất
+    keys = [df[k] for k in METER_KEYS]
+    df["Chỉ số trước"] = df["Chỉ số"].groupby(keys, sort=False).ffill().groupby(keys, sort=False).shift(1)
+    df["Tiêu thụ"] = df["Chỉ số"] - df["Chỉ số trước"]
+
+    positive = df["Tiêu thụ"].where(df["Tiêu thụ"] > 0)
+    prev = positive.groupby(keys, sort=False).shift(1)
+    baseline = prev.groupby(keys, sort=False).rolling(BASELINE_WINDOW, min_periods=BASELINE_MIN).median()
+    df["_baseline"] = baseline.reset_index(level=list(range(len(METER_KEYS))), drop=True)
+
+    df["Đơn giá"] = (df["Tiền"] / df["Tiêu thụ"].where(df["Tiêu thụ"] > 0)).round(0)
+    df["Cảnh báo"] = _flags(df["Chỉ số"].to_numpy(dtype=float), df["Tiêu thụ"].to_numpy(dtype=float), df["_baseline"].to_numpy(dtype=float))
+    return df[RESULT_COLUMNS]
+
+
+def summarize_consumption(df_result, freq="M"):
+    if df_result.empty:
+        return pd.DataFrame(columns=["Kỳ", "Mã căn", "Loại", "Tiêu thụ", "Tiền", "Đơn giá TB", "Số cảnh báo"])
+    df = df_result.copy()
+    df["Kỳ"] = df["Ngày"].dt.to_period(freq).astype(str)
+    df["_canh_bao"] = df["Cảnh báo"] != ""
+    out = df.groupby(["Kỳ", "Mã căn", "Loại"], as_index=False).agg(
+        **{"Tiêu thụ": ("Tiêu thụ", lambda s: s.clip(lower=0).sum()), "Tiền": ("Tiền", "sum"), "Số cảnh báo": ("_canh_bao", "sum")}
+    )
+    out["Đơn giá TB"] = (out["Tiền"] / out["Tiêu thụ"].where(out["Tiêu thụ"] > 0)).round(0)
+    return out[["Kỳ", "Mã căn", "Loại", "Tiêu thụ", "Tiền", "Đơn giá TB", "Số cảnh báo"]]
+
+
+class MeterLedger:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._result = pd.DataFrame(columns=RESULT_COLUMNS)
+        self._n_rows = 0
+        self._last_key = None
+        self._state = {}        # (Mã căn, Loại) -> [ngày cuối, chỉ số hợp lệ cuối, deque tiêu thụ gần nhất]
+        self._sorted = None
+
+    @staticmethod
+    def _row_key(df_cp, i):
+        row = df_cp.iloc[i]
+        return tuple(str(row.get(c, "")) for c in ["Ngày", "Mã căn", "Loại", "Tiền", "Chỉ số đồng hồ"])
+
+    def _rebuild(self, df_cp):
+        self._result = compute_consumption(df_cp)
+        self._state = {}
+        for key, grp in self._result.groupby(METER_KEYS, sort=False):
+            valid = grp["Chỉ số"].dropna()
+            deltas = grp["Tiêu thụ"].where(grp["Tiêu thụ"] > 0)
+            self._state[key] = [grp["Ngày"].iloc[-1], valid.iloc[-1] if not valid.empty else np.nan,
+                                deque(deltas.to_numpy(dtype=float)[-BASELINE_WINDOW:], maxlen=BASELINE_WINDOW)]
+
+    def _append(self, df_new):
+        rows = _meter_rows(df_new)
+        if rows.empty: return True
+        rows = rows.sort_values("Ngày", kind="stable")
+        out = []
+        for ngay, can, loai, tien, chi_so in rows.itertuples(index=False):
+            st_ = self._state.get((can, loai))
+            if st_ is not None and pd.notna(ngay) and pd.notna(st_[0]) and ngay < st_[0]:
+                return False    # nhập lùi ngày -> phải tính lại
+            last_date, last_val, hist = st_ if st_ is not None else [None, np.nan, deque(maxlen=BASELINE_WINDOW)]
+            delta = chi_so - last_val if pd.notna(chi_so) and pd.notna(last_val) else np.nan
+            valid_hist = [d for d in hist if not np.isnan(d)]
+            baseline = float(np.median(valid_hist)) if len(valid_hist) >= BASELINE_MIN else np.nan
+            flag = _flags(np.array([chi_so], dtype=float), np.array([delta], dtype=float), np.array([baseline]))[0]
+            don_gia = round(tien / delta) if pd.notna(delta) and delta > 0 else np.nan
+            out.append([ngay, can, loai, chi_so, last_val, delta, tien, don_gia, flag])
+            hist.append(delta if pd.notna(delta) and delta > 0 else np.nan)
+            self._state[(can, loai)] = [ngay, chi_so if pd.notna(chi_so) else last_val, hist]
+        if out:
+            df_out = pd.DataFrame(out, columns=RESULT_COLUMNS)
+            self._result = df_out if self._result.empty else pd.concat([self._result, df_out], ignore_index=True)
+        return True
+
+    def sync(self, df_cp):
+        # CHI_PHI chỉ nối thêm dòng ở cuối -> tính phần đuôi; mọi thay đổi khác -> tính lại toàn bộ
+        with self._lock:
+            n = len(df_cp)
+            prefix_ok = (
+                0 < self._n_rows <= n
+                and self._last_key == self._row_key(df_cp, self._n_rows - 1)
+            )
+            if prefix_ok and n == self._n_rows and self._sorted is not None:
+                return self._sorted
+            if not (prefix_ok and self._append(df_cp.iloc[self._n_rows:])):
+                self._rebuild(df_cp)
+            self._n_rows = n
+            self._last_key = self._row_key(df_cp, n - 1) if n else None
+            self._sorted = self._result.sort_values(METER_KEYS + ["Ngày"], kind="stable").reset_index(drop=True)
+            return self._sorted
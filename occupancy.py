@@ -0,0 +1,170 @@
+import numpy as np
+import pandas as pd
+
+# ==============================================================================
+# MA TRẬN CÔNG SUẤT PHÒNG (PHÒNG x NGÀY)
+# contract[r, d]: chỉ số HĐ chủ nhà có hiệu lực ngày d ở phòng r (-1 = không có), int16/int32 theo số HĐ
+# owner[r, d]   : ngày d phòng r đang có HĐ chủ nhà (đang phải trả tiền chủ)
+# tenant[r, d]  : ngày d phòng r đang có khách ở
+# prices[i]     : Giá HĐ của HĐ i; chi phí 1 ngày = Giá HĐ / số ngày trong tháng, tính theo từng kỳ khi gộp
+# Toàn bộ khoảng HĐ được trải thành ma trận bằng NumPy (không lặp từng dòng). Ma trận chỉ giữ bool + chỉ số HĐ
+# (3-5 byte / phòng-ngày), không giữ ma trận chi phí float theo ngày.
+# ==============================================================================
+
+ROOM_KEYS = ['Toà', 'Mã căn']
+
+
+class OccupancyMatrix:
+    def __init__(self, rooms, days, contract, tenant, prices):
+        self.rooms = rooms      # DataFrame ['Toà', 'Mã căn'], thứ tự khớp trục 0
+        self.days = days        # DatetimeIndex, thứ tự khớp trục 1
+        self.contract = contract
+        self.owner = contract >= 0
+        self.tenant = tenant
+        self.prices = prices
+
+    @property
+    def vacant_paid(self):
+        return self.owner & ~self.tenant
+
+    @property
+    def occupied(self):
+        return self.owner & self.tenant
+
+
+def _room_index(df, rooms):
+    keys = pd.MultiIndex.from_frame(df[ROOM_KEYS].astype(str))
+    return pd.MultiIndex.from_frame(rooms).get_indexer(keys)
+
+
+def _interval_days(df, col_start, col_end, start, end):
+    # Cắt khoảng [bắt đầu, kết thúc] về trong [start, end] và đổi ra chỉ số ngày
+    s = df[col_start].to_numpy(dtype='datetime64[D]')
+    e = df[col_end].to_numpy(dtype='datetime64[D]')
+    s_idx = (np.maximum(s, start) - start).astype(np.int64)
+    e_idx = (np.minimum(e, end) - start).astype(np.int64)
+    return s_idx, e_idx
+
+
+def _expand(r, s_idx, e_idx):
+    # Trải mỗi khoảng thành các cặp (phòng, ngày) - vector hóa bằng repeat/cumsum, chỉ số int32
+    lengths = e_idx - s_idx + 1
+    total = int(lengths.sum())
+    offsets = np.repeat((np.cumsum(lengths) - lengths).astype(np.int32), lengths)
+    d = np.arange(total, dtype=np.int32) - offsets + np.repeat(s_idx.astype(np.int32), lengths)
+    return np.repeat(r.astype(np.int32), lengths), d, lengths
+
+
+def _index_dtype(n):
+    # Kiểu nhỏ nhất chứa được chỉ số HĐ 0..n-1 và -1
+    return np.int16 if n < np.iinfo(np.int16).max else np.int32
+
+
+def _covered(r, s_idx, e_idx, n_rooms, n_days):
+    # Ma trận bool: ngày nào của phòng nằm trong ít nhất một khoảng. Gộp các khoảng chồng nhau của cùng phòng
+    # trước -> mảng hiệu chỉ gồm +1/-1 của các khoảng rời nhau, cộng dồn trên int8 không tràn
+    out = np.zeros((n_rooms, n_days), dtype=bool)
+    if len(r) == 0: return out
+    order = np.lexsort((s_idx, r))
+    r, s_idx, e_idx = r[order], s_idx[order], e_idx[order]
+    reach = pd.Series(e_idx).groupby(r).cummax().groupby(r).shift().to_numpy()
+    head = ~(s_idx <= reach)                         # phòng mới (reach NaN) hoặc hở với các khoảng trước
+    ends = np.maximum.reduceat(e_idx, np.flatnonzero(head))
+    diff = np.zeros((n_rooms, n_days + 1), dtype=np.int8)
+    diff[r[head], s_idx[head]] += 1
+    diff[r[head], ends + 1] -= 1
+    np.cumsum(diff[:, :n_days], axis=1, dtype=np.int8, out=diff[:, :n_days])
+    np.greater(diff[:, :n_days], 0, out=out)
+    return out
+
+
+def build_occupancy(df_main, start, end, stages=None):
+    # stages (schedule.StageIndex): HĐ có giá theo giai đoạn được trải thành từng khoảng giá
+    start = np.datetime64(pd.Timestamp(start).date(), 'D')
+    end = np.datetime64(pd.Timestamp(end).date(), 'D')
+    days = pd.date_range(pd.Timestamp(start), pd.Timestamp(end), freq='D')
+    n_days = len(days)
+
+    if df_main.empty or not all(c in df_main.columns for c in ROOM_KEYS) or n_days == 0:
+        return OccupancyMatrix(pd.DataFrame(columns=ROOM_KEYS), days, np.full((0, n_days), -1, dtype=np.int16),
+                               np.zeros((0, n_days), dtype=bool), np.zeros(0))
+
+    df = df_main[ROOM_KEYS + ['Ngày ký', 'Ngày hết HĐ', 'Giá HĐ', 'Ngày in', 'Ngày out']].copy()
+    df[ROOM_KEYS] = df[ROOM_KEYS].astype(str)
+    df = df[df['Toà'].str.strip() != ""]
+    rooms = df[ROOM_KEYS].drop_duplicates().sort_values(ROOM_KEYS).reset_index(drop=True)
+    n_rooms = len(rooms)
+
+    # --- HĐ chủ nhà: khoảng bắt đầu muộn hơn đè lên khoảng trước (giá theo giai đoạn, HĐ gia hạn chồng ngày) ---
+    own = stages.expand(df) if stages is not None and len(stages) else df
+    own = own[own['Ngày ký'].notna() & own['Ngày hết HĐ'].notna() & (own['Ngày ký'] <= own['Ngày hết HĐ'])]
+    own = own[(own['Ngày ký'] <= pd.Timestamp(end)) & (own['Ngày hết HĐ'] >= pd.Timestamp(start))]
+    own = own.sort_values('Ngày ký', kind='stable')
+    contract = np.full((n_rooms, n_days), -1, dtype=_index_dtype(len(own)))
+    if not own.empty:
+        s_idx, e_idx = _interval_days(own, 'Ngày ký', 'Ngày hết HĐ', start, end)
+        r_rep, d_rep, lengths = _expand(_room_index(own, rooms), s_idx, e_idx)
+        np.maximum.at(contract, (r_rep, d_rep), np.repeat(np.arange(len(own), dtype=contract.dtype), lengths))
+    prices = own['Giá HĐ'].to_numpy(dtype=float)
+
+    # --- Khách thuê: chỉ cần biết có khách hay không ---
+    ten = df[df['Ngày in'].notna() & df['Ngày out'].notna() & (df['Ngày in'] <= df['Ngày out'])]
+    ten = ten[(ten['Ngày in'] <= pd.Timestamp(end)) & (ten['Ngày out'] >= pd.Timestamp(start))]
+    if ten.empty: tenant = np.zeros((n_rooms, n_days), dtype=bool)
+    else:
+        s_idx, e_idx = _interval_days(ten, 'Ngày in', 'Ngày out', start, end)
+        tenant = _covered(_room_index(ten, rooms), s_idx, e_idx, n_rooms, n_days)
+
+    return OccupancyMatrix(rooms, days, contract, tenant, prices)
+
+
+def _vacant_cost(occ, bounds):
+    # Chi phí chủ nhà của các ngày trống gánh phí, gộp theo kỳ -> (phòng x kỳ). Tính từng kỳ một:
+    # chỉ cần ma trận tạm (phòng x số ngày của kỳ), không dựng ma trận chi phí float cho cả khoảng
+    prices = np.append(occ.prices, 0.0)          # chỉ số -1 -> giá 0 (phần tử cuối)
+    days_in_month = occ.days.days_in_month.to_numpy(dtype=float)
+    edges = np.r_[bounds, len(occ.days)]
+    out = np.zeros((len(occ.rooms), len(bounds)))
+    for k in range(len(bounds)):
+        a, b = edges[k], edges[k + 1]
+        paid = occ.owner[:, a:b] & ~occ.tenant[:, a:b]
+        out[:, k] = (np.where(paid, prices[occ.contract[:, a:b]], 0.0) / days_in_month[a:b]).sum(axis=1)
+    return out
+
+
+def summarize_occupancy(occ, freq='M', by='Toà'):
+    # Gộp ma trận theo kỳ (D = ngày, M = tháng) và theo tòa (by=None: toàn hệ thống)
+    cols = ['Kỳ', 'Ngày có HĐ chủ', 'Ngày có khách', 'Ngày trống gánh phí', 'Chi phí mất (trống)', 'Tỉ lệ lấp đầy (%)']
+    if by: cols = [by] + cols
+    if occ.owner.size == 0: return pd.DataFrame(columns=cols)
+
+    periods = occ.days.to_period(freq)
+    bounds = np.flatnonzero(np.r_[True, periods[1:] != periods[:-1]])
+
+    def by_period(mat):
+        return np.add.reduceat(mat, bounds, axis=1)
+
+    measures = {
+        'Ngày có HĐ chủ': by_period(occ.owner.astype(np.int32)),
+        'Ngày có khách': by_period(occ.occupied.astype(np.int32)),
+        'Ngày trống gánh phí': by_period(occ.vacant_paid.astype(np.int32)),
+        'Chi phí mất (trống)': _vacant_cost(occ, bounds),
+    }
+
+    if by:
+        groups, group_idx = np.unique(occ.rooms[by].to_numpy(), return_inverse=True)
+    else:
+        groups, group_idx = np.array(['Tất cả']), np.zeros(len(occ.rooms), dtype=np.int64)
+
+    out = {}
+    for name, mat in measures.items():
+        agg = np.zeros((len(groups), mat.shape[1]), dtype=mat.dtype)
+        np.add.at(agg, group_idx, mat)
+        out[name] = agg.ravel()
+
+    df = pd.DataFrame(out)
+    df.insert(0, 'Kỳ', np.tile(periods[bounds].astype(str), len(groups)))
+    if by: df.insert(0, by, np.repeat(groups, len(bounds)))
+    owner_days = df['Ngày có HĐ chủ'].to_numpy(dtype=float)
+    df['Tỉ lệ lấp đầy (%)'] = np.where(owner_days > 0, df['Ngày có khách'] / np.where(owner_days > 0, owner_days, 1) * 100, 0.0).round(1)
+    return df[cols]
@@ -0,0 +1,144 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+import dashboard
+import occupancy
+from core import COLUMNS_TN
+
+# ==============================================================================
+# DANH MỤC TÒA / PHÒNG (SHEET TOA_NHA) + TỔNG HỢP THEO TỪNG TÒA
+# - Tòa và phòng là dữ liệu: mỗi dòng TOA_NHA là một (Toà, Mã căn); thêm tòa mới không cần sửa code.
+#   Tòa có trong HOP_DONG mà chưa khai báo vẫn hiện (sau các tòa đã khai báo), không bị ẩn dữ liệu
+# - Báo cáo chia dữ liệu theo Tòa, mỗi phần tổng hợp ở một luồng riêng (numpy / pandas nhả GIL khi
+#   gom nhóm) -> dùng được nhiều lõi mà không phải chép dữ liệu sang tiến trình khác
+# - Tổng toàn hệ thống = cộng các bảng tổng hợp từng Tòa (chỉ vài chục dòng mỗi Tòa),
+#   không tính lại từ dòng gốc; xem một nhóm Tòa = cộng riêng các Tòa đó
+# ==============================================================================
+
+ROOMS_SHEET = "TOA_NHA"
+# Danh sách cũ, chỉ dùng khi chưa có TOA_NHA và HOP_DONG cũng chưa có Tòa nào
+DEFAULT_BUILDINGS = ["MT60", "MT61", "OC1A", "OC1B", "OC2A", "OC2B", "OC3"]
+PARTITION_WORKERS = max(1, min(8, os.cpu_count() or 1))
+CHUA_RO = dashboard.CHUA_RO
+
+PNL_COLUMNS = ['Doanh thu', 'Chi phí HĐ', 'Chi phí VH', 'DT treo', 'Lợi nhuận']
+OCC_SUM_COLUMNS = ['Ngày có HĐ chủ', 'Ngày có khách', 'Ngày trống gánh phí', 'Chi phí mất (trống)']
+
+
+def _data_buildings(df):
+    if df is None or df.empty or 'Toà' not in df.columns: return []
+    return [t for t in df['Toà'].dropna().astype(str).str.strip().unique() if t]
+
+
+def buildings(df_rooms, df_main=None):
+    # Tòa theo thứ tự khai báo trong TOA_NHA, rồi các Tòa chỉ có trong HOP_DONG (xếp theo tên)
+    ds = list(dict.fromkeys(df_rooms['Toà'])) if not df_rooms.empty else []
+    ds += sorted(set(_data_buildings(df_main)) - set(ds))
+    return ds or list(DEFAULT_BUILDINGS)
+
+
+def rooms(df_rooms, toa):
+    if df_rooms.empty: return []
+    ma = df_rooms.loc[df_rooms['Toà'] == toa, 'Mã căn']
+    return [m for m in ma if m]
+
+
+def missing_rooms(df_rooms, df_main):
+    # Phòng có trong HOP_DONG mà chưa có trong danh mục -> các dòng để thêm vào TOA_NHA
+    if df_main.empty or not {'Toà', 'Mã căn'} <= set(df_main.columns): return pd.DataFrame(columns=COLUMNS_TN)
+    seen = df_main[['Toà', 'Mã căn']].astype(str).apply(lambda c: c.str.strip())
+    seen = seen[(seen['Toà'] != '') & (seen['Mã căn'] != '')].drop_duplicates()
+    if not df_rooms.empty:
+        known = pd.MultiIndex.from_frame(df_rooms[['Toà', 'Mã căn']])
+        seen = seen[~pd.MultiIndex.from_frame(seen).isin(known)]
+    return seen.sort_values(['Toà', 'Mã căn']).assign(**{'Ghi chú': ''}).reset_index(drop=True)[COLUMNS_TN]
+
+
+def select(df, toa_list, col='Toà'):
+    # Chỉ giữ các Tòa đang xem; danh sách rỗng = mọi Tòa
+    if not toa_list or df.empty or col not in df.columns: return df
+    return df[df[col].isin(toa_list)]
+
+
+def partition(df, col='Toà'):
+    # Tòa -> phần dữ liệu của Tòa đó (một lần gom nhóm, không lọc lại cho từng Tòa)
+    if df.empty or col not in df.columns: return {}
+    return {k: df.iloc[idx] for k, idx in df.groupby(col, sort=False, dropna=False).indices.items()}
+
+
+def map_parallel(parts, fn, max_workers=PARTITION_WORKERS):
+    # Áp fn lên từng phần song song; giữ thứ tự Tòa như đầu vào
+    if len(parts) <= 1 or max_workers <= 1:
+        return {k: fn(v) for k, v in parts.items()}
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(parts)), thread_name_prefix="mt60-toa") as pool:
+        futures = {k: pool.submit(fn, v) for k, v in parts.items()}
+        return {k: f.result() for k, f in futures.items()}
+
+
+def _pick(partials, toa_list):
+    return [v for k, v in partials.items() if not toa_list or k in toa_list]
+
+
+# --- Thu - chi theo tháng ---
+def room_building(df_rooms, df_facts):
+    # Mã căn -> Toà (danh mục + phòng có trong bảng sự kiện); Mã căn trùng ở nhiều Tòa -> không gán được
+    parts = [d[['Toà', 'Mã căn']] for d in (df_rooms, df_facts) if not d.empty]
+    if not parts: return pd.Series(dtype=object)
+    pairs = pd.concat(parts, ignore_index=True).astype(str).drop_duplicates()
+    pairs = pairs[pairs['Mã căn'] != '']
+    return pairs.drop_duplicates('Mã căn', keep=False).set_index('Mã căn')['Toà']
+
+
+def cp_buildings(df_cp, df_rooms, df_facts):
+    # Tòa của từng dòng CHI_PHI (gán qua Mã căn); không gán được -> "Chưa rõ"
+    return df_cp['Mã căn'].astype(str).map(room_building(df_rooms, df_facts)).fillna(CHUA_RO)
+
+
+def month_partials(df_facts_year, df_cp, year, max_month, accrual_mode, df_rooms):
+    # Tòa -> bảng thu - chi - lợi nhuận theo tháng của riêng Tòa đó (cùng cách tính với dashboard.monthly_pnl)
+    cp = df_cp
+    if not cp.empty: cp = cp.assign(Toà=cp_buildings(cp, df_rooms, df_facts_year).to_numpy())
+    parts_f, parts_cp = partition(df_facts_year), partition(cp)
+    empty_f, empty_cp = df_facts_year.iloc[0:0], cp.iloc[0:0]
+    parts = {t: (parts_f.get(t, empty_f), parts_cp.get(t, empty_cp)) for t in dict.fromkeys(list(parts_f) + list(parts_cp))}
+    return map_parallel(parts, lambda p: dashboard.monthly_pnl(p[0], p[1], year, max_month, accrual_mode, rounded=False))
+
+
+def merge_months(partials, toa_list=None, max_month=12):
+    # Cộng các bảng theo tháng của các Tòa đang xem -> bảng toàn hệ thống (cùng dạng monthly_pnl)
+    picked = _pick(partials, toa_list)
+    if not picked:
+        return pd.DataFrame(0.0, index=pd.Index(range(1, max_month + 1), name='Tháng'), columns=PNL_COLUMNS).reset_index()
+    return pd.concat(picked, ignore_index=True).groupby('Tháng', as_index=False).sum().round(0)
+
+
+def building_totals(partials, toa_list=None):
+    # Một dòng mỗi Tòa: cộng dồn các tháng của bảng từng Tòa
+    rows = {k: v.drop(columns='Tháng').sum() for k, v in partials.items() if not toa_list or k in toa_list}
+    if not rows: return pd.DataFrame(columns=['Toà'] + PNL_COLUMNS)
+    out = pd.DataFrame.from_dict(rows, orient='index')
+    out.index.name = 'Toà'
+    return out.round(0).sort_values('Lợi nhuận', ascending=False).reset_index()
+
+
+# --- Công suất phòng ---
+def occupancy_partials(df_main, start, end, freq, stages=None):
+    # Tòa -> bảng lấp đầy theo kỳ của Tòa đó (mỗi Tòa dựng ma trận ngày - phòng riêng, song song)
+    def _one(df):
+        return occupancy.summarize_occupancy(occupancy.build_occupancy(df, start, end, stages), freq, 'Toà')
+    return map_parallel(partition(df_main), _one)
+
+
+def merge_occupancy(partials, toa_list=None):
+    # (bảng theo Tòa, bảng toàn hệ thống) từ các bảng từng Tòa; tỉ lệ tính lại từ tổng ngày-phòng
+    picked = [p for p in _pick(partials, toa_list) if not p.empty]
+    cols = ['Kỳ'] + OCC_SUM_COLUMNS + ['Tỉ lệ lấp đầy (%)']
+    if not picked: return pd.DataFrame(columns=['Toà'] + cols), pd.DataFrame(columns=cols)
+    by_toa = pd.concat(picked, ignore_index=True)
+    total = by_toa.groupby('Kỳ', as_index=False, sort=False)[OCC_SUM_COLUMNS].sum()
+    owner_days = total['Ngày có HĐ chủ'].to_numpy(dtype=float)
+    total['Tỉ lệ lấp đầy (%)'] = np.where(owner_days > 0, total['Ngày có khách'] / np.where(owner_days > 0, owner_days, 1) * 100, 0.0).round(1)
+    return by_toa, total[cols]
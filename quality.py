@@ -0,0 +1,195 @@
+import re
+
+import numpy as np
+import pandas as pd
+
+from core import COLUMNS, SHEET_ROW
+
+# ==============================================================================
+# KIỂM TRA CHẤT LƯỢNG DỮ LIỆU HOP_DONG
+# - Hash ổn định cho từng dòng (trên giá trị gốc: ngày giờ, số tiền, chuỗi đã strip)
+# - Khóa khoảng thời gian trên ngày giờ gốc, không qua chuỗi "dd/mm/yy" (trùng ở năm 2 chữ số)
+# - Một lần sắp xếp theo (Toà, Mã căn, ngày bắt đầu), mọi phép so với dòng trước
+#   đều là groupby cummax / shift vector hóa
+# ==============================================================================
+
+ISSUE_DUPLICATE = "Dòng trùng hoàn toàn"
+ISSUE_TENANT_OVERLAP = "Chồng lấn khách thuê"
+ISSUE_OWNER_GAP = "HĐ chủ bị hở"
+ISSUE_MISSING_TOA = "Thiếu Toà"
+ISSUE_MACAN_COLLISION = "Mã căn viết khác nhau"
+ISSUE_BAD_DATE = "Ngày không đọc được"
+ISSUE_TYPES = [ISSUE_DUPLICATE, ISSUE_TENANT_OVERLAP, ISSUE_OWNER_GAP, ISSUE_MISSING_TOA, ISSUE_MACAN_COLLISION,
+               ISSUE_BAD_DATE]
+
+SEVERITY = {
+    ISSUE_DUPLICATE: "Cao", ISSUE_TENANT_OVERLAP: "Cao", ISSUE_OWNER_GAP: "Trung bình",
+    ISSUE_MISSING_TOA: "Cao", ISSUE_MACAN_COLLISION: "Trung bình", ISSUE_BAD_DATE: "Cao",
+}
+
+FINDING_COLUMNS = ["Loại", "Mức độ", "Toà", "Mã căn", "Dòng sheet", "Chi tiết"]
+HEADER_ROWS = 1    # dòng tiêu đề của sheet -> số dòng sheet = vị trí + 2
+
+_NON_ALNUM = re.compile(r'[^0-9A-Z]')
+
+
+def sheet_rows(df, pos):
+    # Số dòng trên sheet của các dòng ở vị trí pos: theo cột SHEET_ROW (còn đúng sau khi bỏ dòng GĐ cũ), không có thì theo vị trí
+    if SHEET_ROW in df.columns: return df[SHEET_ROW].to_numpy()[np.asarray(pos, dtype='int64')]
+    return np.asarray(pos) + HEADER_ROWS + 1
+
+
+def _canonical(df, columns=None):
+    # Dạng chuẩn để hash: ngày -> int64 ns (NaT cố định), số -> float, chuỗi -> strip
+    cols = [c for c in (columns or COLUMNS) if c in df.columns]
+    out = pd.DataFrame(index=df.index)
+    for c in cols:
+        col = df[c]
+        if pd.api.types.is_datetime64_any_dtype(col):
+            out[c] = col.to_numpy(dtype='datetime64[ns]').astype(np.int64)
+        elif pd.api.types.is_numeric_dtype(col):
+            out[c] = col.astype(float).fillna(0.0)
+        else:
+            out[c] = col.fillna('').astype(str).str.strip()
+    return out
+
+
+def row_hashes(df, columns=None):
+    if df.empty: return pd.Series(dtype='uint64')
+    return pd.util.hash_pandas_object(_canonical(df, columns), index=False)
+
+
+def interval_key(col_start, col_end):
+    # Khóa (Toà, Mã căn, ngày bắt đầu, ngày kết thúc) trên ngày giờ gốc
+    return ['Toà', 'Mã căn', col_start, col_end]
+
+
+def dedupe_intervals(df, col_start, col_end):
+    # Một dòng cho mỗi khoảng HĐ / khoảng thuê của phòng, giữ dòng đầu theo thứ tự hiện tại
+    return df.drop_duplicates(subset=interval_key(col_start, col_end), keep='first')
+
+
+def macan_key(col):
+    # "P.0101", "101 ", "A-101" ~ "A101": bỏ ký tự không phải chữ / số, bỏ tiền tố P, bỏ số 0 ở đầu
+    key = col.fillna('').astype(str).str.upper().str.replace(_NON_ALNUM, '', regex=True)
+    key = key.str.replace(r'^P(?=\d)', '', regex=True)
+    return key.str.replace(r'^0+(?=\d)', '', regex=True)
+
+
+def _finding(kind, toa, can, rows, detail):
+    return pd.DataFrame({
+        "Loại": kind, "Mức độ": SEVERITY[kind], "Toà": toa, "Mã căn": can,
+        "Dòng sheet": rows, "Chi tiết": detail,
+    }, columns=FINDING_COLUMNS)
+
+
+def _fmt(col):
+    return col.dt.strftime('%d/%m/%Y').fillna('?')
+
+
+def find_duplicates(df, hashes):
+    dup = hashes.duplicated(keep=False)
+    if not dup.any(): return _finding(ISSUE_DUPLICATE, [], [], [], [])
+    sub = df[dup.to_numpy()]
+    grp = pd.DataFrame({'h': hashes[dup].to_numpy(), 'row': sheet_rows(df, np.flatnonzero(dup.to_numpy())),
+                        'Toà': sub['Toà'].to_numpy(), 'Mã căn': sub['Mã căn'].to_numpy()})
+    g = grp.groupby('h', sort=False).agg(Toà=('Toà', 'first'), can=('Mã căn', 'first'), rows=('row', list))
+    return _finding(ISSUE_DUPLICATE, g['Toà'], g['can'], g['rows'].map(lambda r: ", ".join(map(str, r))),
+                    g['rows'].map(lambda r: f"{len(r)} dòng giống hệt nhau, giữ 1 dòng đầu"))
+
+
+def _sweep(df, col_s, col_e):
+    # Sắp xếp một lần theo phòng + ngày bắt đầu; end_max_truoc = ngày kết thúc xa nhất của các khoảng trước đó
+    mask = (df[col_s].notna() & df[col_e].notna() & (df['Toà'] != '')).to_numpy()
+    valid = df[mask].assign(_row=sheet_rows(df, np.flatnonzero(mask)))
+    valid = valid.sort_values(['Toà', 'Mã căn', col_s, col_e], kind='stable')
+    keys = [valid['Toà'], valid['Mã căn']]
+    end_max = valid[col_e].groupby(keys, sort=False).cummax()
+    valid['_end_max_truoc'] = end_max.groupby(keys, sort=False).shift(1)
+    valid['_row_truoc'] = valid['_row'].groupby(keys, sort=False).shift(1)
+    return valid
+
+
+def find_tenant_overlaps(df):
+    s = _sweep(df, 'Ngày in', 'Ngày out')
+    same = s[['Tên khách thuê', 'Ngày in', 'Ngày out']].eq(
+        s.groupby(['Toà', 'Mã căn'], sort=False)[['Tên khách thuê', 'Ngày in', 'Ngày out']].shift(1)).all(axis=1)
+    # Cùng khách, cùng khoảng ở nhiều dòng (ví dụ dòng tách giai đoạn HĐ chủ) không tính là chồng lấn
+    hit = s[(s['Ngày in'] <= s['_end_max_truoc']) & ~same]
+    detail = ("Khách " + hit['Tên khách thuê'].fillna('').astype(str) + " vào " + _fmt(hit['Ngày in'])
+              + " khi khách trước chưa ra (tới " + _fmt(hit['_end_max_truoc']) + ")")
+    rows = hit['_row_truoc'].astype('Int64').astype(str) + ", " + hit['_row'].astype(str)
+    return _finding(ISSUE_TENANT_OVERLAP, hit['Toà'], hit['Mã căn'], rows, detail)
+
+
+def find_owner_gaps(df):
+    s = _sweep(df, 'Ngày ký', 'Ngày hết HĐ')
+    hit = s[s['Ngày ký'] > s['_end_max_truoc'] + pd.Timedelta(days=1)]
+    gap_days = (hit['Ngày ký'] - hit['_end_max_truoc']).dt.days - 1
+    detail = ("Hở " + gap_days.astype(str) + " ngày: HĐ trước hết " + _fmt(hit['_end_max_truoc'])
+              + ", HĐ sau ký " + _fmt(hit['Ngày ký']))
+    rows = hit['_row_truoc'].astype('Int64').astype(str) + ", " + hit['_row'].astype(str)
+    return _finding(ISSUE_OWNER_GAP, hit['Toà'], hit['Mã căn'], rows, detail)
+
+
+def find_missing_toa(df):
+    miss = df['Toà'] == ''
+    sub = df[miss]
+    rows = sheet_rows(df, np.flatnonzero(miss.to_numpy())).astype(str)
+    return _finding(ISSUE_MISSING_TOA, sub['Toà'], sub['Mã căn'], rows, "Dòng không có Toà - bị bỏ qua trong mọi báo cáo theo phòng")
+
+
+def find_macan_collisions(df):
+    mask = (df['Toà'] != '').to_numpy()
+    sub = df.loc[mask, ['Toà', 'Mã căn']].assign(_row=sheet_rows(df, np.flatnonzero(mask)))
+    sub['_key'] = macan_key(sub['Mã căn'])
+    spellings = sub.groupby(['Toà', '_key'], sort=False)['Mã căn'].agg(lambda s: sorted(set(s)))
+    spellings = spellings[spellings.map(len) > 1]
+    if spellings.empty: return _finding(ISSUE_MACAN_COLLISION, [], [], [], [])
+    rows = sub.set_index(['Toà', '_key'])['_row'].groupby(level=[0, 1]).agg(lambda r: ", ".join(map(str, sorted(r))))
+    idx = spellings.index
+    detail = spellings.map(lambda v: "Cùng một căn nhưng ghi: " + " / ".join(v))
+    return _finding(ISSUE_MACAN_COLLISION, idx.get_level_values(0), spellings.map(lambda v: v[0]).to_numpy(),
+                    rows.reindex(idx).to_numpy(), detail.to_numpy())
+
+
+def find_bad_dates(df, date_issues):
+    # Ô ngày có nội dung nhưng không đọc được (dates.DateParser.issues) -> mất khỏi mọi báo cáo theo ngày
+    if date_issues is None or date_issues.empty: return _finding(ISSUE_BAD_DATE, [], [], [], [])
+    # Dòng của HOP_DONG: lấy Toà / Mã căn theo số dòng sheet (dòng GĐ cũ đã chuyển sang sổ thì không còn phòng)
+    pos = pd.Index(sheet_rows(df, np.arange(len(df)))).get_indexer(date_issues['Dòng sheet'].to_numpy())
+    is_hd = (date_issues['Sheet'] == 'HOP_DONG').to_numpy() & (pos >= 0)
+    toa = np.where(is_hd, df['Toà'].to_numpy()[np.where(is_hd, pos, 0)], '') if len(df) else ''
+    can = np.where(is_hd, df['Mã căn'].to_numpy()[np.where(is_hd, pos, 0)], '') if len(df) else ''
+    detail = (date_issues['Sheet'] + " / " + date_issues['Cột'] + ': "' + date_issues['Giá trị']
+              + '" không phải dd/mm/yyyy, dd/mm/yy, yyyy-mm-dd hay số serial')
+    return _finding(ISSUE_BAD_DATE, toa, can, date_issues['Dòng sheet'].astype(str).to_numpy(), detail.to_numpy())
+
+
+def scan(df_main, date_issues=None):
+    # Trả về (bảng phát hiện, hash từng dòng); date_issues: ô ngày lỗi lúc đọc sheet
+    if df_main.empty or not all(c in df_main.columns for c in ['Toà', 'Mã căn']):
+        return pd.DataFrame(columns=FINDING_COLUMNS), pd.Series(dtype='uint64')
+    df = df_main.reset_index(drop=True).reindex(columns=list(dict.fromkeys(list(df_main.columns) + COLUMNS)))
+    df['Toà'] = df['Toà'].fillna('').astype(str).str.strip()
+    df['Mã căn'] = df['Mã căn'].fillna('').astype(str)
+    for c in ['Ngày ký', 'Ngày hết HĐ', 'Ngày in', 'Ngày out']: df[c] = pd.to_datetime(df[c], errors='coerce')
+
+    hashes = row_hashes(df_main.reset_index(drop=True))
+    parts = [find_duplicates(df, hashes), find_tenant_overlaps(df), find_owner_gaps(df),
+             find_missing_toa(df), find_macan_collisions(df), find_bad_dates(df, date_issues)]
+    parts = [p for p in parts if not p.empty]
+    findings = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame(columns=FINDING_COLUMNS)
+    return findings, hashes
+
+
+def summarize(findings):
+    counts = findings['Loại'].value_counts() if not findings.empty else pd.Series(dtype=int)
+    return pd.DataFrame({'Loại': ISSUE_TYPES, 'Mức độ': [SEVERITY[t] for t in ISSUE_TYPES],
+                         'Số lỗi': [int(counts.get(t, 0)) for t in ISSUE_TYPES]})
+
+
+def drop_exact_duplicates(df_main, hashes):
+    # Giữ dòng đầu tiên của mỗi nhóm dòng giống hệt nhau
+    if df_main.empty: return df_main
+    return df_main[~hashes.duplicated(keep='first').to_numpy()]
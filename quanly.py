@@ -1,15 +1,37 @@
 import streamlit as st
 import pandas as pd
 from datetime import date, datetime, timedelta
+from zoneinfo import ZoneInfo
 import os
 import json
-import re
-import time
 import io
 
-# --- THƯ VIỆN KẾT NỐI GOOGLE SHEETS ---
-import gspread
-from oauth2client.service_account import ServiceAccountCredentials
+import storage
+import accrual
+import meters
+import search
+import facts
+import dashboard
+import assistant
+import commission
+import quality
+import editor
+import deposit
+import forecast
+import recompute
+import schedule
+import portfolio
+import statements
+import archive
+import journal
+import revisions
+from core import (
+    COLUMNS, COLUMNS_CP, COLS_MONEY, ROW_ID, SHEET_ROW, assign_row_ids, clean_money, fmt_vnd, fmt_date, clean_macan
+)
+
+# Bảng dữ liệu được dùng chung giữa các phiên (Snapshot của luồng nền): bật Copy-on-Write để
+# mọi bảng suy ra từ đó trong một phiên không bao giờ ghi ngược vào bản dùng chung
+pd.set_option("mode.copy_on_write", True)
 
 # ==============================================================================
 # 1. CẤU HÌNH HỆ THỐNG VÀ GIAO DIỆN
@@ -41,29 +63,8 @@ st.markdown("""
     </style>
 """, unsafe_allow_html=True)
 
-try:
-    from google import genai
-    AI_AVAILABLE = True
-except ImportError:
-    AI_AVAILABLE = False
-
 SHEET_NAME = "MT60_DATABASE"
 
-COLUMNS = [
-    "Tòa nhà", "Mã căn", "Toà", "Chủ nhà - sale", "Ngày ký", "Ngày hết HĐ", 
-    "Giá HĐ", "TT cho chủ nhà", "Cọc cho chủ nhà", "Tên khách thuê", 
-    "Ngày in", "Ngày out", "Giá", "KH thanh toán", "KH cọc", 
-    "Công ty", "Cá Nhân", "SALE THẢO", "SALE NGA", "SALE LINH", 
-    "Hết hạn khách hàng", "Ráp khách khi hết hạn"
-]
-
-COLUMNS_CP = ["Ngày", "Mã căn", "Loại", "Tiền", "Chỉ số đồng hồ"]
-
-COLS_MONEY = [
-    "Giá", "Giá HĐ", "SALE THẢO", "SALE NGA", "SALE LINH", "Công ty", 
-    "Cá Nhân", "TT cho chủ nhà", "Cọc cho chủ nhà", "KH thanh toán", "KH cọc"
-]
-
 # ==============================================================================
 # 2. KẾT NỐI DỮ LIỆU THÔNG MINH
 # ==============================================================================
@@ -73,41 +74,40 @@ st.markdown("---")
 
 st.sidebar.header("🔐 Trạng thái hệ thống")
 
+# Client Google (google-auth + HTTP keep-alive) được giữ chung cho cả tiến trình,
+# mỗi chuỗi JSON credentials chỉ được parse một lần.
 @st.cache_resource
-def connect_google_sheet(uploaded_file=None):
-    scope = ["https://spreadsheets.google.com/feeds", "https://www.googleapis.com/auth/drive"]
+def connect_google_sheet(creds_json):
     try:
-        creds_dict = None
-        if "google_credentials" in st.secrets:
-            creds_dict = json.loads(st.secrets["google_credentials"])
-        elif os.path.exists("key.json"):
-            with open("key.json", "r", encoding="utf-8") as f:
-                creds_dict = json.load(f)
-        elif uploaded_file is not None:
-            file_content = uploaded_file.read().decode("utf-8")
-            creds_dict = json.loads(file_content)
-            
-        if creds_dict:
-            if 'private_key' in creds_dict:
-                creds_dict['private_key'] = creds_dict['private_key'].replace('\\\\n', '\n').replace('\\n', '\n')
-            creds = ServiceAccountCredentials.from_json_keyfile_dict(creds_dict, scope)
-            client = gspread.authorize(creds)
-            return client.open(SHEET_NAME)
-        return None
+        creds_dict = json.loads(creds_json)
+        return storage.get_client_manager().open(creds_dict, spreadsheet_key=SPREADSHEET_KEY, spreadsheet_name=SHEET_NAME)
     except Exception as e:
         st.error(f"❌ Lỗi kết nối. Vui lòng kiểm tra lại file JSON hoặc Streamlit Secrets.")
         return None
 
+@st.cache_resource
+def connect_local_storage(kind, path):
+    return storage.open_local_backend(kind, path)
+
+STORAGE_KIND, STORAGE_PATH = storage.get_backend_config(st.secrets)
+SPREADSHEET_KEY = storage.get_spreadsheet_key(st.secrets)
+
 sh = None
-if "google_credentials" in st.secrets or os.path.exists("key.json"):
+if STORAGE_KIND != storage.BACKEND_GSHEET:
+    sh = connect_local_storage(STORAGE_KIND, STORAGE_PATH)
+elif "google_credentials" in st.secrets:
+    with st.spinner("Đang tự động kết nối hệ thống..."):
+        sh = connect_google_sheet(st.secrets["google_credentials"])
+elif os.path.exists("key.json"):
+    with open("key.json", "r", encoding="utf-8") as f:
+        key_json = f.read()
     with st.spinner("Đang tự động kết nối hệ thống..."):
-        sh = connect_google_sheet()
+        sh = connect_google_sheet(key_json)
 else:
     uploaded_key = st.sidebar.file_uploader("Vui lòng Upload file JSON gốc:", type=['json'])
     if uploaded_key:
-        uploaded_key.seek(0)
         with st.spinner("Đang kết nối..."):
-            sh = connect_google_sheet(uploaded_key)
+            sh = connect_google_sheet(uploaded_key.getvalue().decode("utf-8"))
 
 # ==============================================================================
 # 3. XỬ LÝ LOGIC CHÍNH
@@ -116,50 +116,46 @@ else:
 if sh:
     st.sidebar.success("✅ Đã kết nối dữ liệu!")
     
-    def load_data(tab_name):
-        try:
-            wks = sh.worksheet(tab_name)
-            data = wks.get_all_records()
-            if not data: return pd.DataFrame()
-            return pd.DataFrame(data)
-        except: return pd.DataFrame()
+    if sh.name != storage.BACKEND_GSHEET:
+        st.sidebar.warning(f"🧪 Đang dùng kho cục bộ ({sh.name}) - không phải Google Sheets")
+
+    def nguoi_sua():
+        # Email đăng nhập (nếu app bật đăng nhập), không thì tên tự nhập ở sidebar
+        try: email = st.user.get("email")
+        except Exception: email = None
+        return email or st.session_state.get('nguoi_sua', '').strip() or journal.UNKNOWN_USER
+
+    def chuan_hoa_khi_gop(tab_name):
+        # HOP_DONG / GIA_HD còn dạng cũ chờ chuyển sổ: bản gốc là bảng thô -> bản trên kho cũng giữ thô để so
+        return not ((so_hh_chuyen or so_gd_chuyen) and tab_name in ("HOP_DONG", "GIA_HD"))
+
+    def da_ghi(tab_name, truoc, moi):
+        # Nhật ký: chỉ nối phần chênh lệch so với bản trên kho ngay trước lần ghi (chạy nền, lỗi nhật ký không chặn việc lưu)
+        nhat_ky.record(tab_name, truoc, moi, nguoi_sua())
+        # Báo luồng nền tính lại; không chờ ở đây
+        st.session_state['ve_ghi'] = data_worker.submit_write(tab_name, moi)
 
     def save_data(df, tab_name):
         try:
-            wks = sh.worksheet(tab_name)
-            df_save = df.fillna("") 
-            df_save = df_save.astype(str)
-            wks.clear()
-            wks.update([df_save.columns.values.tolist()] + df_save.values.tolist())
+            # Chỉ ghi đè khi kho vẫn là bản đang xem; có người lưu trước -> gộp các dòng khác nhau, cùng dòng -> xung đột
+            moi, truoc, xung_dot, da_gop = revisions.save(
+                sh, tab_name, df, snap.raw.get(tab_name), snap.sheet_versions.get(tab_name), chuan_hoa_khi_gop(tab_name))
+            if moi is None:
+                st.error("❌ Nhiều người đang lưu cùng lúc, chưa ghi được. Vui lòng bấm lưu lại.")
+                return
+            da_ghi(tab_name, truoc, moi)
+            if xung_dot: st.session_state.setdefault('xung_dot', []).extend(xung_dot)
+            if da_gop: st.toast("🔀 Đã gộp với thay đổi người khác vừa lưu", icon="👥")
             st.toast("✅ Đã lưu thành công!", icon="☁️")
         except Exception as e: st.error(f"❌ Lỗi: {e}")
 
-    def clean_money(val):
-        if pd.isna(val) or val == "": return 0.0
-        if isinstance(val, (int, float)): return float(val)
-        s = str(val).strip()
-        if s.endswith('.0'): s = s[:-2]
-        if s.endswith(',0'): s = s[:-2]
-        s = s.replace('.', '').replace(',', '')
-        s = re.sub(r'[^\d-]', '', s)
-        try: return float(s)
-        except: return 0.0
-
-    def fmt_vnd(val):
-        try:
-            val = float(val)
-            if pd.isna(val) or val == 0: return "0"
-            if val < 0: return "({:,.0f})".format(abs(val)).replace(",", ".")
-            return "{:,.0f}".format(val).replace(",", ".")
-        except: return "0"
+    def cho_du_lieu_moi():
+        # Chờ ngắn cho phiên bản mới; quá hạn thì trang hiển thị bản cũ và tự làm mới khi xong
+        data_worker.wait(st.session_state.get('ve_ghi', 0), recompute.SAVE_WAIT)
 
-    def fmt_date(val):
-        try:
-            if pd.isna(val) or val == "": return ""
-            if isinstance(val, str): val = pd.to_datetime(val, errors='coerce')
-            if pd.isna(val): return ""
-            return val.strftime('%d/%m/%y')
-        except: return ""
+    def excel_khi_bam(df):
+        # Nút tải chỉ dựng file (và import xlsxwriter) khi người dùng bấm, không dựng lại mỗi lần rerun
+        return lambda: convert_df_to_excel(df)
 
     def convert_df_to_excel(df):
         output = io.BytesIO()
@@ -170,107 +166,121 @@ if sh:
                     df_export[col] = df_export[col].dt.strftime('%d/%m/%y')
             df_export.to_excel(writer, index=False, sheet_name='Sheet1')
         return output.getvalue()
-    
-    def clean_macan(col):
-        return col.astype(str).str.replace(r'\.0$', '', regex=True).str.strip().str.upper()
-
-    def gop_du_lieu_phong(df_input):
-        if df_input.empty: return df_input
-        df = df_input.copy()
-        df.columns = df.columns.str.strip()
-        df['Mã căn'] = clean_macan(df['Mã căn'])
-
-        def tao_mo_ta_dong(row):
-            details = []
-            k, h = fmt_date(row.get('Ngày ký')), fmt_date(row.get('Ngày hết HĐ'))
-            i, o = fmt_date(row.get('Ngày in')), fmt_date(row.get('Ngày out'))
-            if k or h: details.append(f"HĐ({k}-{h})")
-            if row.get('Giá HĐ', 0) > 0: details.append(f"GiáHĐ:{fmt_vnd(row['Giá HĐ'])}")
-            if i or o: details.append(f"Khách({i}-{o})")
-            if row.get('Giá', 0) > 0: details.append(f"GiáThuê:{fmt_vnd(row['Giá'])}")
-            
-            thu = row.get('KH thanh toán', 0) + row.get('KH cọc', 0)
-            if thu > 0: details.append(f"Thu:{fmt_vnd(thu)}")
-            chi = row.get('TT cho chủ nhà', 0) + row.get('Cọc cho chủ nhà', 0)
-            if chi > 0: details.append(f"Chi:{fmt_vnd(chi)}")
-            
-            if not details: return "Trống"
-            return ", ".join(details)
-
-        df['_chi_tiet_nhap'] = df.apply(tao_mo_ta_dong, axis=1)
-
-        agg_rules = {
-            'Ngày ký': 'min', 'Ngày hết HĐ': 'max',
-            'Ngày in': 'min', 'Ngày out': 'max',
-            'Giá HĐ': 'max', 'Giá': 'max', 
-            'TT cho chủ nhà': 'sum', 'Cọc cho chủ nhà': 'sum',
-            'KH thanh toán': 'sum', 'KH cọc': 'sum',
-            'Công ty': 'sum', 'Cá Nhân': 'sum',
-            'SALE THẢO': 'sum', 'SALE NGA': 'sum', 'SALE LINH': 'sum',
-            'Tên khách thuê': 'first',
-            'Chủ nhà - sale': 'first',
-            '_chi_tiet_nhap': lambda x: '\n'.join([f"• Lần {i+1}: {v}" for i, v in enumerate(x) if v != "Trống"])
-        }
-        
-        final_agg = {k: v for k, v in agg_rules.items() if k in df.columns}
-        cols_group = ['Toà', 'Mã căn']
-        if not all(col in df.columns for col in cols_group): return df
-
-        df_grouped = df.groupby(cols_group, as_index=False).agg(final_agg)
-        df_grouped = df_grouped.rename(columns={'_chi_tiet_nhap': 'Ghi chú'})
-        return df_grouped
 
     # ==============================================================================
     # 4. TẢI VÀ CHUẨN HÓA DỮ LIỆU ĐẦU VÀO
     # ==============================================================================
-    df_main = load_data("HOP_DONG")
-    df_cp = load_data("CHI_PHI")
-
-    if df_cp.empty:
-        df_cp = pd.DataFrame(columns=COLUMNS_CP)
-    else:
-        df_cp.columns = df_cp.columns.str.strip()
-        if "Mã căn" in df_cp.columns: df_cp["Mã căn"] = clean_macan(df_cp["Mã căn"])
-        if "Ngày" in df_cp.columns: df_cp["Ngày"] = pd.to_datetime(df_cp["Ngày"], errors='coerce')
-        if "Tiền" in df_cp.columns: df_cp["Tiền"] = df_cp["Tiền"].apply(clean_money)
-
-    if not df_main.empty:
-        df_main.columns = df_main.columns.str.strip()
-        if "Mã căn" in df_main.columns: df_main["Mã căn"] = clean_macan(df_main["Mã căn"])
-        for c in ["Ngày ký", "Ngày hết HĐ", "Ngày in", "Ngày out"]:
-            if c in df_main.columns: df_main[c] = pd.to_datetime(df_main[c], errors='coerce')
-        for c in COLS_MONEY:
-            if c in df_main.columns: df_main[c] = df_main[c].apply(clean_money)
+    # Dữ liệu + bảng dẫn xuất do luồng nền tính sẵn (dùng chung mọi phiên); phiên chỉ lấy Snapshot mới nhất.
+    # HOP_DONG còn cột hoa hồng cũ -> được tách sang sổ dạng dài ngay trong bộ nhớ;
+    # lần lưu HOP_DONG kế tiếp sẽ ghi luôn sổ HOA_HONG. Dòng GĐ2/GĐ3 kiểu cũ cũng vậy với sổ GIA_HD
+    @st.cache_resource
+    def get_journal(backend_id, _sh):
+        return journal.Journal(_sh)
+
+    @st.cache_resource
+    def get_recompute_worker(backend_id, _sh):
+        def fetch(tab_name):
+            # Bảng kèm phiên bản của đúng giá trị vừa đọc -> lần lưu sau ghi có điều kiện theo đó
+            return revisions.frame_of(_sh.get_all_values(tab_name))
+        fact_store = facts.FactStore(os.environ.get("MT60_FACTS_PATH", facts.DEFAULT_PATH))
+        # Lần chuyển dòng sang kho lạnh cũng vào nhật ký như một lần lưu
+        kho_lanh = archive.Archive(_sh, archive.get_horizon_days(st.secrets), journal=get_journal(backend_id, _sh))
+        return recompute.RecomputeWorker(fetch, fact_store, archive=kho_lanh)
+
+    data_worker = get_recompute_worker(f"{sh.name}:{id(sh)}", sh)
+    nhat_ky = get_journal(f"{sh.name}:{id(sh)}", sh)
+    # Lần tải đầu của tiến trình (app vừa thức dậy): vẽ khung trang ngay, dữ liệu hiện khi luồng nền tải xong
+    snap = data_worker.current(recompute.STARTUP_WAIT)
+    if snap is None:
+        if data_worker.loading():
+            st.info("⏳ Đang tải dữ liệu lần đầu, trang sẽ tự hiện khi xong...")
+
+            @st.fragment(run_every=0.5)
+            def cho_tai_lan_dau():
+                if not data_worker.loading(): st.rerun(scope="app")
+            cho_tai_lan_dau()
+        else:
+            st.error(f"❌ Không tải được dữ liệu: {data_worker.last_error}")
+        st.stop()
+    df_main, df_cp, df_hh, so_hh_chuyen = snap.df_main, snap.df_cp, snap.df_hh, snap.so_hh_chuyen
+    df_gd, so_gd_chuyen, stages = snap.df_gd, snap.so_gd_chuyen, snap.stages
+    data_version = snap.version
+
+    def save_hop_dong(df_new, hh_moi=None, gd_moi=None):
+        # Dòng mới (form, bảng sửa) chưa có mã dòng -> gán trước khi ghi
+        df_new = assign_row_ids(df_new)
+        # Dòng HĐ bị sửa khóa / bị xóa -> khoản hoa hồng, giai đoạn giá HĐ đi theo
+        hh_theo, so_hh_theo = commission.follow_contracts(df_hh, df_main, df_new)
+        gd_theo, so_gd_theo = schedule.follow_contracts(df_gd, df_main, df_new)
+        if so_hh_chuyen or so_hh_theo or (hh_moi is not None and not hh_moi.empty):
+            parts = [p for p in [hh_theo, hh_moi] if p is not None and not p.empty]
+            save_data(pd.concat(parts, ignore_index=True) if parts else commission.empty_ledger(), "HOA_HONG")
+        if so_gd_chuyen or so_gd_theo or (gd_moi is not None and not gd_moi.empty):
+            parts = [p for p in [gd_theo, gd_moi] if p is not None and not p.empty]
+            save_data(pd.concat(parts, ignore_index=True) if parts else schedule.empty_schedule(), "GIA_HD")
+        save_data(df_new, "HOP_DONG")
+
+    # Xung đột từ các lần lưu gộp: bản trên kho đang được giữ, người dùng chọn bản của mình nếu muốn
+    if st.session_state.get('xung_dot'):
+        with st.expander(f"⚠️ {len(st.session_state['xung_dot'])} xung đột khi lưu - cùng dòng vừa được người khác sửa", expanded=True):
+            for n, xd in enumerate(list(st.session_state['xung_dot'])):
+                st.markdown(f"**{xd['Sheet']} · {xd['Phòng'] or '(không rõ phòng)'}** - đang giữ bản của người khác")
+                cua_toi, nguoi_khac = revisions.conflict_frames(xd)
+                c1, c2 = st.columns(2)
+                c1.caption("Bản của tôi" + (" (đã xóa)" if cua_toi.empty else ""))
+                c1.dataframe(cua_toi, hide_index=True, use_container_width=True)
+                c2.caption("Bản người khác (đang lưu)" + (" (đã xóa)" if nguoi_khac.empty else ""))
+                c2.dataframe(nguoi_khac, hide_index=True, use_container_width=True)
+                b1, b2 = st.columns(2)
+                if b1.button("Giữ bản của tôi", key=f"xd_toi_{n}"):
+                    try:
+                        moi, truoc = revisions.resolve(sh, xd, chuan_hoa_khi_gop(xd['Sheet']))
+                        if moi is None:
+                            st.error("❌ Nhiều người đang lưu cùng lúc, chưa ghi được. Vui lòng bấm lại.")
+                        else:
+                            da_ghi(xd['Sheet'], truoc, moi)
+                            st.session_state['xung_dot'].pop(n)
+                            st.toast("✅ Đã lưu bản của bạn!", icon="☁️")
+                            cho_du_lieu_moi(); st.rerun()
+                    except Exception as e: st.error(f"❌ Lỗi: {e}")
+                if b2.button("Giữ bản người khác", key=f"xd_ho_{n}"):
+                    st.session_state['xung_dot'].pop(n); st.rerun()
+
+    def nhap_hoa_hong(key):
+        # Mỗi dòng một người nhận; người nhận mới chỉ cần thêm dòng, không cần thêm cột
+        ds = commission.payees(df_hh)
+        return st.data_editor(
+            pd.DataFrame({"Người nhận": ds, "Tiền": [0] * len(ds)}), key=key, num_rows="dynamic",
+            hide_index=True, use_container_width=True,
+            column_config={"Tiền": st.column_config.NumberColumn("Tiền", step=50000, format="%d")}
+        )
+
+    def nhap_giai_doan(key):
+        # Các giai đoạn giá sau GĐ1 của HĐ chủ, mỗi dòng một giai đoạn, không giới hạn số giai đoạn
+        return st.data_editor(
+            schedule.empty_input(), key=key, num_rows="dynamic", hide_index=True, use_container_width=True,
+            column_config={
+                "Từ ngày": st.column_config.DateColumn("Từ ngày", format="DD/MM/YYYY"),
+                "Đến ngày": st.column_config.DateColumn("Đến ngày", format="DD/MM/YYYY"),
+                "Giá HĐ": st.column_config.NumberColumn("Giá HĐ", step=100000, format="%d"),
+            }
+        )
 
     # ==============================================================================
     # 5. SIDEBAR: THÔNG BÁO TÓM TẮT
     # ==============================================================================
     with st.sidebar:
         st.divider()
+        # Tòa đang xem: cảnh báo và các báo cáo chỉ lấy các Tòa này (bỏ trống = tất cả)
+        toa_xem = st.multiselect("🏢 Tòa đang xem", snap.buildings, key='toa_xem', placeholder="Tất cả các Tòa")
         st.header("🔔 Tóm tắt Thông Báo")
         today = pd.Timestamp(date.today())
         
         if not df_main.empty:
-            df_alert_base = gop_du_lieu_phong(df_main)
-            
-            df_hd = df_alert_base[(df_alert_base['Ngày hết HĐ'].notna()) & ((df_alert_base['Ngày hết HĐ'] - today).dt.days.between(-999, 30))]
-            df_kh = df_alert_base[(df_alert_base['Ngày out'].notna()) & ((df_alert_base['Ngày out'] - today).dt.days.between(0, 7))]
-
-            def check_tenant_active(row):
-                if pd.notna(row['Ngày in']) and pd.notna(row['Ngày out']):
-                    return row['Ngày in'] <= today <= row['Ngày out']
-                return False
-
-            def check_owner_active(row):
-                if pd.notna(row['Ngày ký']) and pd.notna(row['Ngày hết HĐ']):
-                    return row['Ngày ký'] <= today <= row['Ngày hết HĐ']
-                return False
-
-            df_alert_base['has_tenant'] = df_alert_base.apply(check_tenant_active, axis=1)
-            df_alert_base['has_owner'] = df_alert_base.apply(check_owner_active, axis=1)
-
-            df_trong_co_hd = df_alert_base[(~df_alert_base['has_tenant']) & (df_alert_base['has_owner'])]
-            df_trong_khong_hd = df_alert_base[(~df_alert_base['has_tenant']) & (~df_alert_base['has_owner'])]
+            # Nhóm cảnh báo do luồng nền tính sẵn trên bảng gom theo phòng
+            df_hd, df_kh = portfolio.select(snap.alerts['hd'], toa_xem), portfolio.select(snap.alerts['kh'], toa_xem)
+            df_trong_co_hd = portfolio.select(snap.alerts['trong_co_hd'], toa_xem)
+            df_trong_khong_hd = portfolio.select(snap.alerts['trong_khong_hd'], toa_xem)
 
             if df_hd.empty and df_kh.empty and df_trong_co_hd.empty and df_trong_khong_hd.empty: 
                 st.success("✅ Ổn định. Lấp đầy 100%.")
@@ -305,10 +315,32 @@ if sh:
         st.info("👉 Vào Tab **Cảnh Báo** để xem chi tiết & Xử lý.")
         st.divider()
         if st.button("🔄 Tải lại dữ liệu", use_container_width=True): 
-            st.cache_data.clear()
+            data_worker.wait(data_worker.submit_reload())
             st.rerun()
 
-    DANH_SACH_NHA = { "MT60": [], "MT61": [], "OC1A": [], "OC1B": [], "OC2A": [], "OC2B": [], "OC3": [] }
+        try: co_email = bool(st.user.get("email"))
+        except Exception: co_email = False
+        if not co_email:
+            st.text_input("👤 Người sửa (ghi vào nhật ký)", key='nguoi_sua', placeholder="Tên của bạn")
+
+        if data_worker.pending():
+            # Đang tính phiên bản mới sau khi lưu: hiển thị bản cũ, tự làm mới khi luồng nền công bố xong
+            st.caption("⏳ Đang cập nhật dữ liệu mới...")
+
+            @st.fragment(run_every=1)
+            def theo_doi_phien_ban():
+                if data_worker.current().seq != snap.seq: st.rerun(scope="app")
+            theo_doi_phien_ban()
+        st.caption(f"Phiên bản dữ liệu #{snap.seq} - tính trong {snap.build_seconds:.2f}s")
+        if snap.archive and snap.archive.years:
+            st.caption(f"🗄 Lưu trữ HĐ đóng trước {fmt_date(snap.cutoff)}: {len(snap.archive.years)} sheet năm ({snap.archive.years[0]}-{snap.archive.years[-1]})")
+        if data_worker.archive_error is not None:
+            st.warning(f"⚠️ Chuyển HĐ đã đóng sang sheet lưu trữ bị lỗi: {data_worker.archive_error}")
+        if snap.fetch_seconds:
+            st.caption("⏱ Tải sheet (song song): " + ", ".join(f"{t} {sec:.2f}s" for t, sec in snap.fetch_seconds.items()))
+
+    # Danh mục Tòa lấy từ sheet TOA_NHA (+ Tòa chỉ có trong HOP_DONG), không cố định trong code
+    DANH_SACH_NHA = snap.buildings
 
     # ==============================================================================
     # 6. GIAO DIỆN CHÍNH (TABS)
@@ -318,7 +350,9 @@ if sh:
         "📋 Dữ Liệu Gốc", "🏠 Cảnh Báo", 
         "🏢 CP Hợp Đồng", "🏠 CP Cho Thuê",
         "💰 Quản Lý Tổng (Raw)",
-        "📈 Theo dõi HĐKD" 
+        "📈 Theo dõi HĐKD", "📊 Công Suất Phòng", "🤖 Hỏi Dữ Liệu", "🤝 Hoa Hồng",
+        "🧹 Chất Lượng Dữ Liệu", "🔐 Tiền Cọc", "🔮 Dự Báo Dòng Tiền",
+        "🕰️ Nhật Ký Thay Đổi", "🧾 Bảng Kê Tháng"
     ])
 
     # --- TAB 0: NHẬP LIỆU ---
@@ -334,15 +368,47 @@ if sh:
                 'chu_nha': '', 'ngay_ky': date.today(), 'ngay_het': date.today() + timedelta(days=365),
                 'gia_hd': 0, 'tt_chu_nha': 0, 'coc_chu_nha': 0,
                 'ten_khach': '', 'ngay_in': date.today(), 'ngay_out': date.today() + timedelta(days=30),
-                'gia_thue': 0, 'kh_coc': 0,
-                'sale_thao': 0, 'sale_nga': 0, 'sale_linh': 0, 'cong_ty': 0, 'ca_nhan': 0
+                'gia_thue': 0, 'kh_coc': 0
             }
 
+        st.markdown("### 🔎 TRA CỨU NHANH (Phòng / Khách / Chủ nhà)")
+
+        @st.cache_resource
+        def get_search_index():
+            return search.SearchIndex()
+
+        search_index = get_search_index()
+        search_index.update(df_main, data_version)
+
+        def chon_can_tra_cuu(toa, can):
+            if toa in DANH_SACH_NHA: st.session_state['search_toa'] = toa
+            st.session_state['search_can'] = can
+
+        tu_khoa = st.text_input("Nhập mã căn, tên khách, chủ nhà hoặc tòa (gõ không dấu, sai chính tả nhẹ vẫn tìm được)", key="tra_cuu")
+        if tu_khoa.strip():
+            ket_qua = search_index.search(tu_khoa, limit=10)
+            if not ket_qua:
+                st.caption("Không tìm thấy phòng nào phù hợp.")
+            for i, ((toa_tc, can_tc), diem, khop_du) in enumerate(ket_qua):
+                df_ls = search_index.room_history(df_main, (toa_tc, can_tc))
+                khach_gan_nhat = str(df_ls['Tên khách thuê'].iloc[-1]) if 'Tên khách thuê' in df_ls.columns and not df_ls.empty else ""
+                with st.expander(f"{'🏠' if khop_du else '▫️'} Tòa {toa_tc} - P.{can_tc} | {len(df_ls)} dòng lịch sử | Khách gần nhất: {khach_gan_nhat or 'N/A'}"):
+                    cols_ls = [c for c in ["Chủ nhà - sale", "Ngày ký", "Ngày hết HĐ", "Giá HĐ", "Tên khách thuê", "Ngày in", "Ngày out", "Giá"] if c in df_ls.columns]
+                    df_ls_disp = df_ls.sort_values(by=[c for c in ["Ngày ký", "Ngày in"] if c in df_ls.columns])[cols_ls].copy()
+                    for c in ["Ngày ký", "Ngày hết HĐ", "Ngày in", "Ngày out"]:
+                        if c in df_ls_disp.columns: df_ls_disp[c] = df_ls_disp[c].apply(fmt_date)
+                    for c in ["Giá HĐ", "Giá"]:
+                        if c in df_ls_disp.columns: df_ls_disp[c] = df_ls_disp[c].apply(fmt_vnd)
+                    st.dataframe(df_ls_disp, use_container_width=True)
+                    st.button("➡️ Dùng căn này cho công cụ bên dưới", key=f"tc_chon_{i}", on_click=chon_can_tra_cuu, args=(toa_tc, can_tc))
+
+        st.markdown("---")
+
         st.markdown("### 🛠 CÔNG CỤ TỰ ĐỘNG (RÁP KHÁCH / GIA HẠN)")
         st.info("💡 Điền **Tòa nhà** & **Mã căn** rồi bấm nút bên dưới để hệ thống tự động tải dữ liệu cũ lên form.")
         
         c_search1, c_search2, c_search3, c_search4 = st.columns([1.5, 1.5, 2, 2])
-        with c_search1: search_toa = st.selectbox("Tòa nhà", list(DANH_SACH_NHA.keys()), key="search_toa")
+        with c_search1: search_toa = st.selectbox("Tòa nhà", DANH_SACH_NHA, key="search_toa")
         with c_search2: search_can = st.text_input("Mã căn cần xử lý", key="search_can").strip().upper()
         
         with c_search3:
@@ -361,8 +427,7 @@ if sh:
                             'ten_khach': '',
                             'ngay_in': date.today(),
                             'ngay_out': date.today() + timedelta(days=30),
-                            'gia_thue': 0, 'kh_coc': 0,
-                            'sale_thao': 0, 'sale_nga': 0, 'sale_linh': 0, 'cong_ty': 0, 'ca_nhan': 0
+                            'gia_thue': 0, 'kh_coc': 0
                         })
                         st.success("✅ Đã tải HĐ Chủ nhà. Vui lòng điền thông tin KHÁCH MỚI bên dưới!")
                     else:
@@ -389,8 +454,7 @@ if sh:
                             'ngay_in': old_ngay_out, 
                             'ngay_out': old_ngay_out + timedelta(days=30),
                             'gia_thue': int(latest_row.get('Giá', 0)),
-                            'kh_coc': 0, 
-                            'sale_thao': 0, 'sale_nga': 0, 'sale_linh': 0, 'cong_ty': 0, 'ca_nhan': 0
+                            'kh_coc': 0
                         })
                         st.success("✅ Đã tải thông tin GIA HẠN. Ngày tháng đã được nối tiếp tự động!")
                     else:
@@ -405,8 +469,8 @@ if sh:
         with st.form("main_form"):
             st.markdown("### 🏠 1. Thông Tin Phòng")
             c1_1, c1_2 = st.columns(2)
-            idx_toa = list(DANH_SACH_NHA.keys()).index(search_toa) if search_toa in DANH_SACH_NHA else 0
-            with c1_1: chon_toa = st.selectbox("Xác nhận Tòa", list(DANH_SACH_NHA.keys()), index=idx_toa)
+            idx_toa = DANH_SACH_NHA.index(search_toa) if search_toa in DANH_SACH_NHA else 0
+            with c1_1: chon_toa = st.selectbox("Xác nhận Tòa", DANH_SACH_NHA, index=idx_toa)
             with c1_2: chon_can = text_input_can = st.text_input("Xác nhận Mã căn", value=search_can)
             
             st.divider()
@@ -422,25 +486,10 @@ if sh:
             with c2_5: tt_chu_nha = st.number_input("Thanh toán cho Chủ nhà", step=100000, value=int(fd['tt_chu_nha'])) 
             with c2_6: coc_chu_nha = st.number_input("Cọc cho Chủ nhà", step=100000, value=int(fd['coc_chu_nha']))
 
-            with st.expander("📈 [Tùy chọn] Tách HĐ Chủ nhà có giá tăng dần theo giai đoạn"):
-                st.info("Nếu hợp đồng chủ nhà đổi giá giữa chừng, hãy nhập tiếp các giai đoạn sau tại đây. Hệ thống sẽ tự động cắt thành các dòng chi phí tương ứng.")
-                st.markdown("**Giai đoạn 2**")
-                c_gd2_1, c_gd2_2, c_gd2_3, c_gd2_4 = st.columns([1, 2, 2, 2])
-                with c_gd2_1: 
-                    st.markdown("<br>", unsafe_allow_html=True)
-                    gd2_on = st.checkbox("Bật GĐ 2")
-                with c_gd2_2: gd2_tu = st.date_input("Từ ngày (GĐ 2)", date.today() + timedelta(days=180))
-                with c_gd2_3: gd2_den = st.date_input("Đến ngày (GĐ 2)", date.today() + timedelta(days=365))
-                with c_gd2_4: gd2_gia = st.number_input("Giá HĐ Gốc (GĐ 2)", step=100000)
-
-                st.markdown("**Giai đoạn 3**")
-                c_gd3_1, c_gd3_2, c_gd3_3, c_gd3_4 = st.columns([1, 2, 2, 2])
-                with c_gd3_1: 
-                    st.markdown("<br>", unsafe_allow_html=True)
-                    gd3_on = st.checkbox("Bật GĐ 3")
-                with c_gd3_2: gd3_tu = st.date_input("Từ ngày (GĐ 3)", date.today() + timedelta(days=365))
-                with c_gd3_3: gd3_den = st.date_input("Đến ngày (GĐ 3)", date.today() + timedelta(days=540))
-                with c_gd3_4: gd3_gia = st.number_input("Giá HĐ Gốc (GĐ 3)", step=100000)
+            with st.expander("📈 [Tùy chọn] HĐ Chủ nhà có giá thay đổi theo giai đoạn"):
+                st.info("Nếu hợp đồng chủ nhà đổi giá giữa chừng, thêm mỗi giai đoạn sau GĐ1 một dòng (Từ ngày, Đến ngày, Giá HĐ). "
+                        "HĐ vẫn là một dòng, Ngày hết HĐ tự kéo tới hết giai đoạn cuối; giá từng giai đoạn lưu ở sheet GIA_HD.")
+                bang_gd = nhap_giai_doan("gd_main_form")
 
             st.divider()
 
@@ -458,12 +507,7 @@ if sh:
             st.divider()
 
             st.markdown("### 💸 4. Chi Phí Sale & Hoa Hồng")
-            c4_1, c4_2, c4_3, c4_4, c4_5 = st.columns(5)
-            with c4_1: sale_thao = st.number_input("Hoa hồng Thảo", step=50000, value=int(fd['sale_thao']))
-            with c4_2: sale_nga = st.number_input("Hoa hồng Nga", step=50000, value=int(fd['sale_nga']))
-            with c4_3: sale_linh = st.number_input("Hoa hồng Linh", step=50000, value=int(fd['sale_linh']))
-            with c4_4: cong_ty = st.number_input("Công ty", step=50000, value=int(fd['cong_ty']))
-            with c4_5: ca_nhan = st.number_input("Cá Nhân", step=50000, value=int(fd['ca_nhan']))
+            bang_hh = nhap_hoa_hong("hh_main_form")
             
             st.markdown("<br>", unsafe_allow_html=True)
             
@@ -474,58 +518,44 @@ if sh:
                     "TT cho chủ nhà": tt_chu_nha, "Cọc cho chủ nhà": coc_chu_nha,
                     "Tên khách thuê": ten_khach, "Ngày in": pd.to_datetime(ngay_in), "Ngày out": pd.to_datetime(ngay_out),
                     "Giá": gia_thue, "KH cọc": kh_coc, "KH thanh toán": kh_tt, 
-                    "Công ty": cong_ty, "Cá Nhân": ca_nhan, 
-                    "SALE THẢO": sale_thao, "SALE NGA": sale_nga, "SALE LINH": sale_linh,
                     "Hết hạn khách hàng": "", "Ráp khách khi hết hạn": ""
                 }
                 
-                rows_to_add = [new_data_1]
-
-                if gd2_on:
-                    new_data_2 = new_data_1.copy()
-                    new_data_2["Ngày ký"] = pd.to_datetime(gd2_tu)
-                    new_data_2["Ngày hết HĐ"] = pd.to_datetime(gd2_den)
-                    new_data_2["Giá HĐ"] = gd2_gia
-                    new_data_2["TT cho chủ nhà"] = 0; new_data_2["Cọc cho chủ nhà"] = 0
-                    new_data_2["Tên khách thuê"] = ""; new_data_2["Ngày in"] = ""; new_data_2["Ngày out"] = ""
-                    new_data_2["Giá"] = 0; new_data_2["KH cọc"] = 0; new_data_2["KH thanh toán"] = 0
-                    for k in ["SALE THẢO", "SALE NGA", "SALE LINH", "Công ty", "Cá Nhân"]: new_data_2[k] = 0
-                    rows_to_add.append(new_data_2)
-
-                if gd3_on:
-                    new_data_3 = new_data_1.copy()
-                    new_data_3["Ngày ký"] = pd.to_datetime(gd3_tu)
-                    new_data_3["Ngày hết HĐ"] = pd.to_datetime(gd3_den)
-                    new_data_3["Giá HĐ"] = gd3_gia
-                    new_data_3["TT cho chủ nhà"] = 0; new_data_3["Cọc cho chủ nhà"] = 0
-                    new_data_3["Tên khách thuê"] = ""; new_data_3["Ngày in"] = ""; new_data_3["Ngày out"] = ""
-                    new_data_3["Giá"] = 0; new_data_3["KH cọc"] = 0; new_data_3["KH thanh toán"] = 0
-                    for k in ["SALE THẢO", "SALE NGA", "SALE LINH", "Công ty", "Cá Nhân"]: new_data_3[k] = 0
-                    rows_to_add.append(new_data_3)
-
-                df_final = pd.concat([df_main, pd.DataFrame(rows_to_add)], ignore_index=True)
-                save_data(df_final, "HOP_DONG")
+                new_data_1, gd_moi = schedule.entries_for_row(new_data_1, bang_gd)
+                df_final = pd.concat([df_main, pd.DataFrame([new_data_1])], ignore_index=True)
+                save_hop_dong(df_final, commission.entries_for_row(new_data_1, bang_hh), gd_moi)
                 
                 st.session_state['form_data'] = {
                     'chu_nha': '', 'ngay_ky': date.today(), 'ngay_het': date.today() + timedelta(days=365),
                     'gia_hd': 0, 'tt_chu_nha': 0, 'coc_chu_nha': 0,
                     'ten_khach': '', 'ngay_in': date.today(), 'ngay_out': date.today() + timedelta(days=30),
-                    'gia_thue': 0, 'kh_coc': 0,
-                    'sale_thao': 0, 'sale_nga': 0, 'sale_linh': 0, 'cong_ty': 0, 'ca_nhan': 0
+                    'gia_thue': 0, 'kh_coc': 0
                 }
-                time.sleep(1)
+                cho_du_lieu_moi()
                 st.rerun()
 
     with tabs[1]:
         st.header("📤 Quản lý File Excel")
-        st.download_button("📥 Tải File Mẫu", convert_df_to_excel(pd.DataFrame(columns=COLUMNS)), "mau_hop_dong.xlsx")
+        if so_hh_chuyen:
+            st.warning(f"⚠️ HOP_DONG còn {so_hh_chuyen} khoản hoa hồng ở các cột cũ ({', '.join(commission.LEGACY_COLUMNS)}). Lần lưu HOP_DONG kế tiếp sẽ tự chuyển sang sổ HOA_HONG.")
+            if st.button("🔁 Chuyển ngay sang sổ HOA_HONG"):
+                save_hop_dong(df_main); cho_du_lieu_moi(); st.rerun()
+        if so_gd_chuyen:
+            st.warning(f"⚠️ HOP_DONG còn {so_gd_chuyen} dòng giai đoạn giá kiểu cũ (bản sao dòng HĐ). Lần lưu HOP_DONG kế tiếp sẽ tự chuyển sang sổ GIA_HD.")
+            if st.button("🔁 Chuyển ngay sang sổ GIA_HD"):
+                save_hop_dong(df_main); cho_du_lieu_moi(); st.rerun()
+        st.download_button("📥 Tải File Mẫu", excel_khi_bam(pd.DataFrame(columns=COLUMNS)), "mau_hop_dong.xlsx")
         up = st.file_uploader("Upload Excel", type=["xlsx"], key="up_main")
         if up and st.button("🚀 ĐỒNG BỘ CLOUD"):
             try:
                 df_up = pd.read_excel(up)
                 for col in COLS_MONEY:
                     if col in df_up.columns: df_up[col] = df_up[col].apply(clean_money)
-                save_data(df_up, "HOP_DONG"); time.sleep(2); st.rerun()
+                df_up, hh_up, so_up = commission.split_legacy(df_up, df_hh)
+                if so_up: save_data(hh_up, "HOA_HONG")
+                df_up, gd_up, so_up = schedule.split_legacy(df_up, df_gd)
+                if so_up: save_data(gd_up, "GIA_HD")
+                save_data(assign_row_ids(df_up), "HOP_DONG"); cho_du_lieu_moi(); st.rerun()
             except Exception as e: st.error(f"Lỗi: {e}")
 
     with tabs[2]:
@@ -547,26 +577,86 @@ if sh:
                     "Chỉ số đồng hồ": str(chi_so).strip()
                 }])
                 save_data(pd.concat([df_cp, new], ignore_index=True), "CHI_PHI")
-                time.sleep(1)
+                cho_du_lieu_moi()
                 st.rerun()
         
         df_cp_show = df_cp.copy()
         df_cp_show["Tiền"] = df_cp_show["Tiền"].apply(fmt_vnd)
         st.dataframe(df_cp_show, use_container_width=True, column_config={"Ngày": st.column_config.DateColumn(format="DD/MM/YY")})
 
+        st.divider()
+        st.markdown("#### 🔌 Đối Soát Đồng Hồ Điện / Nước")
+
+        # Giữ chung cho mọi phiên: khi CHI_PHI chỉ thêm dòng mới thì chỉ tính phần thêm
+        @st.cache_resource
+        def get_meter_ledger():
+            return meters.MeterLedger()
+
+        df_dh = get_meter_ledger().sync(df_cp)
+        if df_dh.empty:
+            st.caption("Chưa có chỉ số đồng hồ Điện/Nước nào.")
+        else:
+            def hien_thi_dong_ho(df):
+                df = df.copy()
+                for c in ["Tiền", "Đơn giá"]:
+                    if c in df.columns: df[c] = df[c].apply(fmt_vnd)
+                return df
+
+            df_dh_canh_bao = df_dh[df_dh['Cảnh báo'] != ""]
+            d1, d2, d3 = st.columns(3)
+            d1.metric("Số lần ghi chỉ số", len(df_dh))
+            d2.metric("Số đồng hồ", len(df_dh[['Mã căn', 'Loại']].drop_duplicates()))
+            d3.metric("Cần kiểm tra", len(df_dh_canh_bao))
+
+            if not df_dh_canh_bao.empty:
+                st.warning(f"⚠️ {len(df_dh_canh_bao)} lần ghi chỉ số bất thường (giảm, tăng đột biến hoặc không đọc được)")
+                st.dataframe(hien_thi_dong_ho(df_dh_canh_bao), use_container_width=True, column_config={"Ngày": st.column_config.DateColumn(format="DD/MM/YY")})
+
+            with st.expander("📋 Tổng hợp tiêu thụ theo tháng"):
+                df_dh_thang = meters.summarize_consumption(df_dh)
+                df_dh_thang_disp = df_dh_thang.copy()
+                for c in ["Tiền", "Đơn giá TB"]: df_dh_thang_disp[c] = df_dh_thang_disp[c].apply(fmt_vnd)
+                st.dataframe(df_dh_thang_disp, use_container_width=True)
+                st.download_button("📥 Tải Excel Tiêu Thụ", excel_khi_bam(df_dh_thang), "TieuThu_DienNuoc.xlsx")
+
+            with st.expander("📋 Toàn bộ lịch sử chỉ số"):
+                st.dataframe(hien_thi_dong_ho(df_dh), use_container_width=True, column_config={"Ngày": st.column_config.DateColumn(format="DD/MM/YY")})
+
     with tabs[3]:
         st.subheader("📋 Dữ Liệu Gốc (Có thể Thêm/Xóa dòng)")
         st.info("💡 Để **XÓA DÒNG**, bạn hãy click vào cột ngoài cùng bên trái của dòng đó, rồi nhấn phím `Delete` trên bàn phím (hoặc biểu tượng thùng rác). Sau đó bấm **LƯU DỮ LIỆU GỐC**.")
-        df_edit = df_main.copy()
-        for c in COLS_MONEY:
-            if c in df_edit.columns: 
-                df_edit[c] = df_edit[c].apply(lambda x: str(int(x)) if pd.notna(x) else "0")
-        
+        if snap.archive and snap.archive.years:
+            st.caption(f"Chỉ gồm HĐ còn hiệu lực hoặc mới đóng (sau {fmt_date(snap.cutoff)}). HĐ đã đóng trước đó nằm ở các sheet lưu trữ: {', '.join(archive.shard_name(y) for y in snap.archive.years)}.")
+        # Lọc / sắp xếp / chia trang trên server: trình duyệt chỉ nhận các dòng của trang đang xem
+        ids_goc = snap.shared('id_dong', lambda: editor.row_ids(df_main))
+        g1, g2, g3, g4 = st.columns([2, 1, 1.5, 2])
+        toa_loc = g1.multiselect("Toà", sorted(df_main['Toà'].dropna().astype(str).str.strip().unique()) if 'Toà' in df_main.columns else [], key="goc_toa")
+        can_loc = g2.text_input("Mã căn", key="goc_can")
+        khach_loc = g3.text_input("Tên khách", key="goc_khach")
+        khoang_loc = g4.date_input("Khoảng ngày", value=(), format="DD/MM/YYYY", key="goc_ngay")
+        g5, g6, g7, g8 = st.columns([2, 1, 1, 1])
+        sap_xep = g5.selectbox("Sắp xếp theo", [editor.SORT_NONE] + [c for c in df_main.columns if c not in (ROW_ID, SHEET_ROW)], key="goc_sx")
+        giam_dan = g6.toggle("Giảm dần", key="goc_giam")
+        co_trang = g7.selectbox("Số dòng / trang", editor.PAGE_SIZES, index=editor.PAGE_SIZES.index(editor.DEFAULT_PAGE_SIZE), key="goc_co")
+
+        tu_loc, den_loc = (khoang_loc[0], khoang_loc[-1]) if khoang_loc else (None, None)
+        vi_tri = editor.filter_rows(df_main, toa_loc, can_loc, khach_loc, tu_loc, den_loc)
+        vi_tri = editor.sort_rows(df_main, vi_tri, sap_xep, not giam_dan)
+        so_trang = editor.page_count(len(vi_tri), co_trang)
+        trang = g8.number_input(f"Trang (/{so_trang})", min_value=1, max_value=so_trang, value=1, step=1, key="goc_trang")
+        vi_tri_trang = editor.page_slice(vi_tri, trang, co_trang)
+        id_trang = list(ids_goc[vi_tri_trang])
+        st.caption(f"{len(vi_tri):,} / {len(df_main):,} dòng khớp bộ lọc · đang xem {len(vi_tri_trang)} dòng")
+
+        # Khóa bảng theo tập ID của trang: đổi trang / bộ lọc / dữ liệu -> bảng sửa mới, không áp nhầm dòng
         edited_df = st.data_editor(
-            df_edit, 
+            editor.to_editor(df_main, vi_tri_trang, ids_goc),
             use_container_width=True,
-            num_rows="dynamic", 
+            num_rows="dynamic",
+            hide_index=True,
+            key=f"goc_{hash(tuple(id_trang))}",
             column_config={
+                editor.ID_COL: None,
                 "Ngày ký": st.column_config.DateColumn(format="DD/MM/YY"),
                 "Ngày hết HĐ": st.column_config.DateColumn(format="DD/MM/YY"),
                 "Ngày in": st.column_config.DateColumn(format="DD/MM/YY"), 
@@ -574,21 +664,38 @@ if sh:
             }
         )
         if st.button("💾 LƯU DỮ LIỆU GỐC", type="primary"):
-            df_to_save = edited_df.copy()
-            for c in COLS_MONEY:
-                if c in df_to_save.columns: df_to_save[c] = df_to_save[c].apply(clean_money)
-            save_data(df_to_save, "HOP_DONG")
-            time.sleep(1); st.rerun()
+            df_to_save, tk = editor.apply_page(df_main, ids_goc, id_trang, edited_df)
+            if tk["bỏ qua"]: st.warning(f"⚠️ {tk['bỏ qua']} dòng đã bị thay đổi ở nơi khác từ lúc mở trang - bỏ qua, hãy kiểm tra lại.")
+            if tk["sửa"] or tk["thêm"] or tk["xóa"]:
+                save_hop_dong(df_to_save)
+                st.toast(f"Sửa {tk['sửa']} · thêm {tk['thêm']} · xóa {tk['xóa']} dòng")
+                cho_du_lieu_moi(); st.rerun()
+            else: st.info("Không có thay đổi nào để lưu.")
+
+        with st.expander(f"🏢 Danh mục Tòa / phòng - sheet {portfolio.ROOMS_SHEET} ({len(snap.buildings)} Tòa, {len(snap.df_rooms)} dòng)"):
+            st.caption("Mỗi dòng một phòng (Toà, Mã căn). Tòa mới chưa có phòng: để trống Mã căn. "
+                       "Tòa chỉ có trong HOP_DONG vẫn hiện ở các danh sách chọn Tòa.")
+            phong_thieu = portfolio.missing_rooms(snap.df_rooms, df_main)
+            bang_tn = st.data_editor(snap.df_rooms, key=f"tn_{data_version}", num_rows="dynamic", hide_index=True, use_container_width=True)
+            b1, b2 = st.columns(2)
+            if b1.button("💾 LƯU DANH MỤC TÒA", key='tn_luu'):
+                save_data(bang_tn, portfolio.ROOMS_SHEET); cho_du_lieu_moi(); st.rerun()
+            if not phong_thieu.empty and b2.button(f"➕ Thêm {len(phong_thieu)} phòng có trong HOP_DONG chưa khai báo", key='tn_them'):
+                save_data(pd.concat([snap.df_rooms, phong_thieu], ignore_index=True), portfolio.ROOMS_SHEET); cho_du_lieu_moi(); st.rerun()
 
     # --- TAB 4: TRUNG TÂM CẢNH BÁO (TÍCH HỢP FORM XỬ LÝ NHANH FULL TRƯỜNG) ---
     with tabs[4]:
         st.subheader("🏠 Trung Tâm Cảnh Báo & Xử Lý Nhanh")
         if not df_main.empty:
-            df_alert_tab = gop_du_lieu_phong(df_main)
+            # Chỉ các Tòa đang xem (thanh bên), như cảnh báo ở thanh bên
+            df_alert_tab = portfolio.select(snap.rooms, toa_xem).copy()
+            df_main_xem = portfolio.select(df_main, toa_xem)
             today = pd.Timestamp(date.today())
             
-            def get_latest_owner_info(ma_can):
-                df_owner = df_main[(df_main['Mã căn'] == ma_can) & (df_main['Giá HĐ'] > 0)]
+            def get_latest_owner_info(toa_nha, ma_can):
+                # Mã căn trùng giữa các Tòa -> khớp theo cả (Toà, Mã căn)
+                df_owner = df_main_xem[(df_main_xem['Toà'].fillna('').astype(str).str.strip() == toa_nha)
+                                       & (df_main_xem['Mã căn'] == ma_can) & (df_main_xem['Giá HĐ'] > 0)]
                 if not df_owner.empty:
                     return df_owner.iloc[-1]
                 return None
@@ -631,21 +738,7 @@ if sh:
 
                             # MỞ RỘNG TÍNH NĂNG ĐỔI GIÁ BẬC THANG NGAY TRONG CẢNH BÁO
                             with st.expander("📈 Thay đổi giá HĐ từng giai đoạn (nếu có)"):
-                                c_gd2_1, c_gd2_2, c_gd2_3, c_gd2_4 = st.columns([1, 2, 2, 2])
-                                with c_gd2_1: 
-                                    st.markdown("<br>", unsafe_allow_html=True)
-                                    gd2_on = st.checkbox("Bật GĐ 2", key=f"s1_gd2_{idx}")
-                                with c_gd2_2: gd2_tu = st.date_input("Từ ngày (GĐ 2)", value=new_nk + timedelta(days=180), key=f"s1_d2tu_{idx}")
-                                with c_gd2_3: gd2_den = st.date_input("Đến ngày (GĐ 2)", value=new_nk + timedelta(days=365), key=f"s1_d2den_{idx}")
-                                with c_gd2_4: gd2_gia = st.number_input("Giá HĐ (GĐ 2)", step=100000, key=f"s1_g2_{idx}")
-
-                                c_gd3_1, c_gd3_2, c_gd3_3, c_gd3_4 = st.columns([1, 2, 2, 2])
-                                with c_gd3_1: 
-                                    st.markdown("<br>", unsafe_allow_html=True)
-                                    gd3_on = st.checkbox("Bật GĐ 3", key=f"s1_gd3_{idx}")
-                                with c_gd3_2: gd3_tu = st.date_input("Từ ngày (GĐ 3)", value=new_nk + timedelta(days=365), key=f"s1_d3tu_{idx}")
-                                with c_gd3_3: gd3_den = st.date_input("Đến ngày (GĐ 3)", value=new_nk + timedelta(days=540), key=f"s1_d3den_{idx}")
-                                with c_gd3_4: gd3_gia = st.number_input("Giá HĐ (GĐ 3)", step=100000, key=f"s1_g3_{idx}")
+                                bang_gd_gh = nhap_giai_doan(f"s1_gd_{idx}")
 
                             if st.form_submit_button("Lưu Gia Hạn", type="primary"):
                                 new_row_1 = {
@@ -653,29 +746,11 @@ if sh:
                                     "Ngày ký": pd.to_datetime(new_nk), "Ngày hết HĐ": pd.to_datetime(new_nh), "Giá HĐ": new_gia,
                                     "TT cho chủ nhà": new_tt, "Cọc cho chủ nhà": new_coc,
                                     "Tên khách thuê": "", "Ngày in": "", "Ngày out": "", "Giá": 0, "KH cọc": 0, "KH thanh toán": 0, 
-                                    "Công ty": 0, "Cá Nhân": 0, "SALE THẢO": 0, "SALE NGA": 0, "SALE LINH": 0,
                                     "Hết hạn khách hàng": "", "Ráp khách khi hết hạn": ""
                                 }
-                                rows_to_add = [new_row_1]
-
-                                if gd2_on:
-                                    r2 = new_row_1.copy()
-                                    r2["Ngày ký"] = pd.to_datetime(gd2_tu)
-                                    r2["Ngày hết HĐ"] = pd.to_datetime(gd2_den)
-                                    r2["Giá HĐ"] = gd2_gia
-                                    r2["TT cho chủ nhà"] = 0; r2["Cọc cho chủ nhà"] = 0
-                                    rows_to_add.append(r2)
-
-                                if gd3_on:
-                                    r3 = new_row_1.copy()
-                                    r3["Ngày ký"] = pd.to_datetime(gd3_tu)
-                                    r3["Ngày hết HĐ"] = pd.to_datetime(gd3_den)
-                                    r3["Giá HĐ"] = gd3_gia
-                                    r3["TT cho chủ nhà"] = 0; r3["Cọc cho chủ nhà"] = 0
-                                    rows_to_add.append(r3)
-
-                                df_final = pd.concat([df_main, pd.DataFrame(rows_to_add)], ignore_index=True)
-                                save_data(df_final, "HOP_DONG"); time.sleep(1); st.rerun()
+                                new_row_1, gd_moi = schedule.entries_for_row(new_row_1, bang_gd_gh)
+                                df_final = pd.concat([df_main, pd.DataFrame([new_row_1])], ignore_index=True)
+                                save_hop_dong(df_final, gd_moi=gd_moi); cho_du_lieu_moi(); st.rerun()
 
             st.divider()
             
@@ -715,15 +790,11 @@ if sh:
                             t_coc = c_k5.number_input("Khách cọc", step=100000, key=f"s2_coc_{idx}")
                             t_tt = c_k6.number_input("Khách thanh toán", step=100000, key=f"s2_tt_{idx}")
 
-                            c_k7, c_k8, c_k9, c_k10, c_k11 = st.columns(5)
-                            t_thao = c_k7.number_input("Sale Thảo", step=50000, key=f"s2_thao_{idx}")
-                            t_nga = c_k8.number_input("Sale Nga", step=50000, key=f"s2_nga_{idx}")
-                            t_linh = c_k9.number_input("Sale Linh", step=50000, key=f"s2_linh_{idx}")
-                            t_cty = c_k10.number_input("Công ty", step=50000, key=f"s2_cty_{idx}")
-                            t_canhan = c_k11.number_input("Cá nhân", step=50000, key=f"s2_cn_{idx}")
+                            st.markdown("**Hoa hồng**")
+                            t_hh = nhap_hoa_hong(f"s2_hh_{idx}")
 
                             if st.form_submit_button("Lưu Khách Mới", type="primary"):
-                                owner_info = get_latest_owner_info(ma_can)
+                                owner_info = get_latest_owner_info(toa_nha, ma_can)
                                 if owner_info is not None:
                                     new_row = {
                                         "Tòa nhà": toa_nha, "Mã căn": ma_can, "Toà": toa_nha, 
@@ -732,11 +803,10 @@ if sh:
                                         "TT cho chủ nhà": 0, "Cọc cho chủ nhà": 0,
                                         "Tên khách thuê": t_khach, "Ngày in": pd.to_datetime(t_in), "Ngày out": pd.to_datetime(t_out),
                                         "Giá": t_gia, "KH cọc": t_coc, "KH thanh toán": t_tt, 
-                                        "Công ty": t_cty, "Cá Nhân": t_canhan, "SALE THẢO": t_thao, "SALE NGA": t_nga, "SALE LINH": t_linh,
                                         "Hết hạn khách hàng": "", "Ráp khách khi hết hạn": ""
                                     }
                                     df_final = pd.concat([df_main, pd.DataFrame([new_row])], ignore_index=True)
-                                    save_data(df_final, "HOP_DONG"); time.sleep(1); st.rerun()
+                                    save_hop_dong(df_final, commission.entries_for_row(new_row, t_hh)); cho_du_lieu_moi(); st.rerun()
                                 else:
                                     st.error("Lỗi: Không tìm thấy HĐ Chủ nhà gốc để kế thừa.")
 
@@ -775,15 +845,11 @@ if sh:
                             t_coc = c_k5.number_input("Khách cọc", step=100000, key=f"s3_coc_{idx}")
                             t_tt = c_k6.number_input("Khách thanh toán", step=100000, key=f"s3_tt_{idx}")
 
-                            c_k7, c_k8, c_k9, c_k10, c_k11 = st.columns(5)
-                            t_thao = c_k7.number_input("Sale Thảo", step=50000, key=f"s3_thao_{idx}")
-                            t_nga = c_k8.number_input("Sale Nga", step=50000, key=f"s3_nga_{idx}")
-                            t_linh = c_k9.number_input("Sale Linh", step=50000, key=f"s3_linh_{idx}")
-                            t_cty = c_k10.number_input("Công ty", step=50000, key=f"s3_cty_{idx}")
-                            t_canhan = c_k11.number_input("Cá nhân", step=50000, key=f"s3_cn_{idx}")
+                            st.markdown("**Hoa hồng**")
+                            t_hh = nhap_hoa_hong(f"s3_hh_{idx}")
 
                             if st.form_submit_button("Lưu Khách Mới", type="primary"):
-                                owner_info = get_latest_owner_info(ma_can)
+                                owner_info = get_latest_owner_info(toa_nha, ma_can)
                                 if owner_info is not None:
                                     new_row = {
                                         "Tòa nhà": toa_nha, "Mã căn": ma_can, "Toà": toa_nha, 
@@ -792,11 +858,10 @@ if sh:
                                         "TT cho chủ nhà": 0, "Cọc cho chủ nhà": 0,
                                         "Tên khách thuê": t_khach, "Ngày in": pd.to_datetime(t_in), "Ngày out": pd.to_datetime(t_out),
                                         "Giá": t_gia, "KH cọc": t_coc, "KH thanh toán": t_tt, 
-                                        "Công ty": t_cty, "Cá Nhân": t_canhan, "SALE THẢO": t_thao, "SALE NGA": t_nga, "SALE LINH": t_linh,
                                         "Hết hạn khách hàng": "", "Ráp khách khi hết hạn": ""
                                     }
                                     df_final = pd.concat([df_main, pd.DataFrame([new_row])], ignore_index=True)
-                                    save_data(df_final, "HOP_DONG"); time.sleep(1); st.rerun()
+                                    save_hop_dong(df_final, commission.entries_for_row(new_row, t_hh)); cho_du_lieu_moi(); st.rerun()
                                 else:
                                     st.error("Lỗi: Không tìm thấy HĐ Chủ nhà.")
 
@@ -838,12 +903,8 @@ if sh:
                             t_coc = c_k5.number_input("Khách cọc", step=100000, key=f"s4_coc_{idx}")
                             t_tt = c_k6.number_input("Khách thanh toán", step=100000, key=f"s4_tt_{idx}")
 
-                            c_k7, c_k8, c_k9, c_k10, c_k11 = st.columns(5)
-                            t_thao = c_k7.number_input("Sale Thảo", step=50000, key=f"s4_thao_{idx}")
-                            t_nga = c_k8.number_input("Sale Nga", step=50000, key=f"s4_nga_{idx}")
-                            t_linh = c_k9.number_input("Sale Linh", step=50000, key=f"s4_linh_{idx}")
-                            t_cty = c_k10.number_input("Công ty", step=50000, key=f"s4_cty_{idx}")
-                            t_canhan = c_k11.number_input("Cá nhân", step=50000, key=f"s4_cn_{idx}")
+                            st.markdown("**Hoa hồng**")
+                            t_hh = nhap_hoa_hong(f"s4_hh_{idx}")
 
                             if st.form_submit_button("Lưu Ký Mới Toàn Bộ", type="primary"):
                                 new_row = {
@@ -852,17 +913,17 @@ if sh:
                                     "TT cho chủ nhà": n_tt_chu, "Cọc cho chủ nhà": n_coc_chu,
                                     "Tên khách thuê": t_khach, "Ngày in": pd.to_datetime(t_in), "Ngày out": pd.to_datetime(t_out),
                                     "Giá": t_gia, "KH cọc": t_coc, "KH thanh toán": t_tt, 
-                                    "Công ty": t_cty, "Cá Nhân": t_canhan, "SALE THẢO": t_thao, "SALE NGA": t_nga, "SALE LINH": t_linh,
                                     "Hết hạn khách hàng": "", "Ráp khách khi hết hạn": ""
                                 }
                                 df_final = pd.concat([df_main, pd.DataFrame([new_row])], ignore_index=True)
-                                save_data(df_final, "HOP_DONG"); time.sleep(1); st.rerun()
+                                save_hop_dong(df_final, commission.entries_for_row(new_row, t_hh)); cho_du_lieu_moi(); st.rerun()
 
     with tabs[5]:
         st.subheader("🏢 Quản Lý Chi Phí Hợp Đồng (Trả Chủ Nhà)")
-        col1, col2 = st.columns(2)
+        col1, col2, col3 = st.columns(3)
         with col1: m_hd = st.selectbox("Chọn Tháng", range(1, 13), index=date.today().month - 1, key='m_hd')
         with col2: y_hd = st.number_input("Chọn Năm", value=date.today().year, key='y_hd')
+        with col3: mode_hd = st.radio("Cách tính", accrual.MODES, horizontal=True, key='mode_hd', help="Dồn tích: chỉ tính số ngày HĐ/khách thực sự nằm trong tháng")
         st.divider()
 
         start_mo_hd = pd.Timestamp(y_hd, m_hd, 1)
@@ -870,7 +931,11 @@ if sh:
         else: end_mo_hd = pd.Timestamp(y_hd, m_hd + 1, 1) - pd.Timedelta(days=1)
 
         if not df_main.empty:
-            df_raw_hd = df_main.copy()
+            phong_hd = portfolio.select(snap.month(y_hd, m_hd), toa_xem)
+            df_nguon_hd = snap.rows_since(start_mo_hd)
+            df_raw_hd = df_nguon_hd[facts.rows_in_rooms(df_nguon_hd, phong_hd[phong_hd['Có HĐ chủ']])].copy()
+            # Giá HĐ của tháng = giá giai đoạn đang hiệu lực (tra bisect trên sổ GIA_HD)
+            if not df_raw_hd.empty: df_raw_hd['Giá HĐ'] = stages.period_price(df_raw_hd, start_mo_hd)
             
             def process_row_hd(row):
                 hd_active = False
@@ -903,13 +968,23 @@ if sh:
                 return pd.Series([True, thoi_han_hd, trang_thai, thoi_han_thue, gia_thue, loi_nhuan], 
                                  index=['_keep', 'Thời hạn HĐ', 'Trạng thái', 'Thời hạn cho thuê', 'Giá thuê', 'Lợi nhuận ròng'])
 
-            hd_calcs = df_raw_hd.apply(process_row_hd, axis=1)
-            df_view_hd = pd.concat([df_raw_hd, hd_calcs], axis=1)
-            df_view_hd = df_view_hd[df_view_hd['_keep'] == True]
-            
+            if df_raw_hd.empty:
+                df_view_hd = df_raw_hd
+            else:
+                hd_calcs = df_raw_hd.apply(process_row_hd, axis=1)
+                df_view_hd = pd.concat([df_raw_hd, hd_calcs], axis=1)
+                df_view_hd = df_view_hd[df_view_hd['_keep'] == True].copy()
+
+            if mode_hd == accrual.MODE_ACCRUAL and not df_view_hd.empty:
+                acc_hd = accrual.accrue_contracts(df_view_hd, *accrual.month_bounds(y_hd, [m_hd]), stages)
+                df_view_hd['Số ngày HĐ'] = acc_hd['cost_days'].iloc[:, 0]
+                df_view_hd['Giá HĐ'] = acc_hd['cost'].iloc[:, 0]
+                df_view_hd['Giá thuê'] = acc_hd['rev'].iloc[:, 0].where(df_view_hd['Trạng thái'] == "Đã có khách thuê", 0)
+                df_view_hd['Lợi nhuận ròng'] = df_view_hd['Giá thuê'] - df_view_hd['Giá HĐ']
+
             if not df_view_hd.empty:
                 df_view_hd = df_view_hd.sort_values(by=['Giá thuê'], ascending=False)
-                df_view_hd = df_view_hd.drop_duplicates(subset=['Toà', 'Mã căn', 'Thời hạn HĐ'], keep='first')
+                df_view_hd = quality.dedupe_intervals(df_view_hd, 'Ngày ký', 'Ngày hết HĐ')
                 df_view_hd = df_view_hd.sort_values(by=['Toà', 'Mã căn'])
 
                 st.write(f"#### 📊 Tổng hợp chi phí Hợp Đồng tháng {m_hd}/{y_hd}")
@@ -922,7 +997,7 @@ if sh:
                 st.markdown("---")
 
                 cols_show = [
-                    "Toà", "Mã căn", "Chủ nhà - sale", "Thời hạn HĐ", "Giá HĐ", "TT cho chủ nhà", "Cọc cho chủ nhà",
+                    "Toà", "Mã căn", "Chủ nhà - sale", "Thời hạn HĐ", "Số ngày HĐ", "Giá HĐ", "TT cho chủ nhà", "Cọc cho chủ nhà",
                     "Trạng thái", "Thời hạn cho thuê", "Giá thuê", "Lợi nhuận ròng"
                 ]
                 cols_exist = [c for c in cols_show if c in df_view_hd.columns]
@@ -940,15 +1015,16 @@ if sh:
                 
                 styler = df_display_hd.style.applymap(color_negative_red, subset=['Lợi nhuận ròng']).set_properties(**{'border-color': 'lightgrey', 'border-style': 'solid', 'border-width': '1px'})
                 st.dataframe(styler, use_container_width=True)
-                st.download_button("📥 Tải Excel CPHĐ", convert_df_to_excel(df_export_hd), f"CP_HopDong_{m_hd}_{y_hd}.xlsx")
+                st.download_button("📥 Tải Excel CPHĐ", excel_khi_bam(df_export_hd), f"CP_HopDong_{m_hd}_{y_hd}.xlsx")
             else:
                 st.warning(f"Không có căn nào có Giá HĐ > 0 hoạt động trong tháng {m_hd}/{y_hd}")
 
     with tabs[6]:
         st.subheader("🏠 Quản Lý Chi Phí Cho Thuê (Thu Khách Hàng)")
-        col1, col2 = st.columns(2)
+        col1, col2, col3 = st.columns(3)
         with col1: m_ct = st.selectbox("Chọn Tháng", range(1, 13), index=date.today().month - 1, key='m_ct')
         with col2: y_ct = st.number_input("Chọn Năm", value=date.today().year, key='y_ct')
+        with col3: mode_ct = st.radio("Cách tính", accrual.MODES, horizontal=True, key='mode_ct', help="Dồn tích: chỉ tính số ngày HĐ/khách thực sự nằm trong tháng")
         st.divider()
 
         start_mo_ct = pd.Timestamp(y_ct, m_ct, 1)
@@ -956,7 +1032,10 @@ if sh:
         else: end_mo_ct = pd.Timestamp(y_ct, m_ct + 1, 1) - pd.Timedelta(days=1)
 
         if not df_main.empty:
-            df_raw_ct = df_main.copy()
+            phong_ct = portfolio.select(snap.month(y_ct, m_ct), toa_xem)
+            df_nguon_ct = snap.rows_since(start_mo_ct)
+            df_raw_ct = df_nguon_ct[facts.rows_in_rooms(df_nguon_ct, phong_ct[phong_ct['Có khách']])].copy()
+            if not df_raw_ct.empty: df_raw_ct['Giá HĐ'] = stages.period_price(df_raw_ct, start_mo_ct)
             
             def process_row_ct(row):
                 tenant_active = False
@@ -990,13 +1069,23 @@ if sh:
                 return pd.Series([True, thoi_han_thue, trang_thai_chu, thoi_han_hd, gia_hd, loi_nhuan], 
                                  index=['_keep', 'Thời hạn cho thuê', 'Trạng thái HĐ Chủ', 'Thời hạn HĐ', 'Giá HĐ Chủ', 'Lợi nhuận ròng'])
 
-            ct_calcs = df_raw_ct.apply(process_row_ct, axis=1)
-            df_view_ct = pd.concat([df_raw_ct, ct_calcs], axis=1)
-            df_view_ct = df_view_ct[df_view_ct['_keep'] == True]
-            
+            if df_raw_ct.empty:
+                df_view_ct = df_raw_ct
+            else:
+                ct_calcs = df_raw_ct.apply(process_row_ct, axis=1)
+                df_view_ct = pd.concat([df_raw_ct, ct_calcs], axis=1)
+                df_view_ct = df_view_ct[df_view_ct['_keep'] == True].copy()
+
+            if mode_ct == accrual.MODE_ACCRUAL and not df_view_ct.empty:
+                acc_ct = accrual.accrue_contracts(df_view_ct, *accrual.month_bounds(y_ct, [m_ct]), stages)
+                df_view_ct['Số ngày thuê'] = acc_ct['rev_days'].iloc[:, 0]
+                df_view_ct['Giá'] = acc_ct['rev'].iloc[:, 0]
+                df_view_ct['Giá HĐ Chủ'] = acc_ct['cost'].iloc[:, 0].where(df_view_ct['Trạng thái HĐ Chủ'] == "Đã có HĐ Chủ", 0)
+                df_view_ct['Lợi nhuận ròng'] = df_view_ct['Giá'] - df_view_ct['Giá HĐ Chủ']
+
             if not df_view_ct.empty:
                 df_view_ct = df_view_ct.sort_values(by=['Giá HĐ Chủ'], ascending=False)
-                df_view_ct = df_view_ct.drop_duplicates(subset=['Toà', 'Mã căn', 'Thời hạn cho thuê'], keep='first')
+                df_view_ct = quality.dedupe_intervals(df_view_ct, 'Ngày in', 'Ngày out')
                 df_view_ct = df_view_ct.sort_values(by=['Toà', 'Mã căn'])
 
                 df_da_co = df_view_ct[df_view_ct['Trạng thái HĐ Chủ'] == "Đã có HĐ Chủ"]
@@ -1020,7 +1109,7 @@ if sh:
                 st.markdown("---")
 
                 cols_show = [
-                    "Toà", "Mã căn", "Tên khách thuê", "Thời hạn cho thuê", "Giá", "KH thanh toán", "KH cọc",
+                    "Toà", "Mã căn", "Tên khách thuê", "Thời hạn cho thuê", "Số ngày thuê", "Giá", "KH thanh toán", "KH cọc",
                     "Trạng thái HĐ Chủ", "Thời hạn HĐ", "Giá HĐ Chủ", "Lợi nhuận ròng"
                 ]
                 cols_exist = [c for c in cols_show if c in df_view_ct.columns]
@@ -1040,7 +1129,7 @@ if sh:
                 
                 styler = df_display_ct.style.applymap(color_negative_red, subset=['Lợi nhuận ròng']).set_properties(**{'border-color': 'lightgrey', 'border-style': 'solid', 'border-width': '1px'})
                 st.dataframe(styler, use_container_width=True)
-                st.download_button("📥 Tải Excel Khách Thuê", convert_df_to_excel(df_export_ct), f"CP_ChoThue_{m_ct}_{y_ct}.xlsx")
+                st.download_button("📥 Tải Excel Khách Thuê", excel_khi_bam(df_export_ct), f"CP_ChoThue_{m_ct}_{y_ct}.xlsx")
             else:
                 st.warning(f"Không có căn nào có Giá thuê > 0 hoạt động trong tháng {m_ct}/{y_ct}")
 
@@ -1056,7 +1145,9 @@ if sh:
         else: end_mo_chung = pd.Timestamp(y_chung, m_chung + 1, 1) - pd.Timedelta(days=1)
 
         if not df_main.empty:
-            df_raw_chung = df_main.copy()
+            phong_chung = portfolio.select(snap.month(y_chung, m_chung), toa_xem)
+            df_nguon_chung = snap.rows_since(start_mo_chung)
+            df_raw_chung = df_nguon_chung[facts.rows_in_rooms(df_nguon_chung, phong_chung[phong_chung['Có HĐ chủ'] | phong_chung['Có khách']])].copy()
 
             def is_active_chung(row):
                 hd_active = False
@@ -1071,7 +1162,7 @@ if sh:
 
                 return hd_active or tenant_active
 
-            df_view_chung = df_raw_chung[df_raw_chung.apply(is_active_chung, axis=1)].copy()
+            df_view_chung = df_raw_chung[df_raw_chung.apply(is_active_chung, axis=1)].copy() if not df_raw_chung.empty else df_raw_chung
 
             if not df_view_chung.empty:
                 df_view_chung = df_view_chung.sort_values(by=['Toà', 'Mã căn'])
@@ -1095,7 +1186,7 @@ if sh:
                         df_display_chung[c] = df_display_chung[c].apply(fmt_vnd)
 
                 st.dataframe(df_display_chung.style.set_properties(**{'border-color': 'lightgrey', 'border-style': 'solid', 'border-width': '1px'}), use_container_width=True)
-                st.download_button("📥 Tải Excel", convert_df_to_excel(df_export_chung), f"QuanLy_TongHop_{m_chung}_{y_chung}.xlsx")
+                st.download_button("📥 Tải Excel", excel_khi_bam(df_export_chung), f"QuanLy_TongHop_{m_chung}_{y_chung}.xlsx")
             else:
                 st.warning(f"Không có dữ liệu hoạt động trong tháng {m_chung}/{y_chung}")
 
@@ -1106,7 +1197,9 @@ if sh:
         current_year = date.today().year
         current_month = date.today().month
 
-        y_kd = st.selectbox("Chọn Năm Tài Chính", range(2020, current_year + 5), index=(current_year - 2020), key='y_kd')
+        col_kd1, col_kd2 = st.columns(2)
+        with col_kd1: y_kd = st.selectbox("Chọn Năm Tài Chính", range(2020, current_year + 5), index=(current_year - 2020), key='y_kd')
+        with col_kd2: mode_kd = st.radio("Cách tính", accrual.MODES, horizontal=True, key='mode_kd', help="Dồn tích: chỉ tính số ngày HĐ/khách thực sự nằm trong tháng")
         st.divider()
 
         max_month = 12
@@ -1115,50 +1208,30 @@ if sh:
         elif y_kd > current_year:
             max_month = 0
 
-        def calc_month_stats_detailed(df_raw, df_chiphi, month, year):
+        def calc_month_stats_detailed(df_facts, df_chiphi, month, year, accrual_mode=False):
+            # Đọc từ bảng phòng - tháng: mỗi phòng một dòng, HĐ trùng khoảng đã được gộp sẵn
             start_d = pd.Timestamp(year, month, 1)
             if month == 12: end_d = pd.Timestamp(year + 1, 1, 1) - pd.Timedelta(days=1)
             else: end_d = pd.Timestamp(year, month + 1, 1) - pd.Timedelta(days=1)
 
-            dt_co_hd = 0
-            dt_khong_hd = 0
-            chi_phi_hd = 0
+            col_thue = 'Giá thuê dồn tích' if accrual_mode else 'Giá thuê'
+            col_hd = 'Giá HĐ dồn tích' if accrual_mode else 'Giá HĐ'
             chi_phi_vh = 0
-
-            df_dt_co = pd.DataFrame()
-            df_dt_khong = pd.DataFrame()
-            df_hd_cost = pd.DataFrame()
             df_cp_vh = pd.DataFrame()
 
-            if not df_raw.empty:
-                df_hd = df_raw.copy()
-                df_hd['owner_active'] = df_hd.apply(lambda r: True if pd.notna(r['Ngày ký']) and pd.notna(r['Ngày hết HĐ']) and r['Ngày ký'] <= end_d and r['Ngày hết HĐ'] >= start_d else False, axis=1)
-                
-                df_hd_active = df_hd[df_hd['owner_active']]
-                active_owner_tuples = set(zip(df_hd_active['Toà'], df_hd_active['Mã căn']))
-
-                df_hd_c = df_hd_active[df_hd_active['Giá HĐ'] > 0].copy()
-                if not df_hd_c.empty:
-                    df_hd_c['Thời hạn HĐ'] = df_hd_c['Ngày ký'].apply(fmt_date) + " - " + df_hd_c['Ngày hết HĐ'].apply(fmt_date)
-                    df_hd_c = df_hd_c.sort_values(by=['Giá HĐ'], ascending=False) 
-                    df_hd_cost = df_hd_c.drop_duplicates(subset=['Toà', 'Mã căn', 'Thời hạn HĐ'], keep='first')
-                    chi_phi_hd = df_hd_cost['Giá HĐ'].sum()
-
-                df_ct = df_raw.copy()
-                df_ct['tenant_active'] = df_ct.apply(lambda r: True if pd.notna(r['Ngày in']) and pd.notna(r['Ngày out']) and r['Ngày in'] <= end_d and r['Ngày out'] >= start_d else False, axis=1)
-                df_ct = df_ct[df_ct['tenant_active'] & (df_ct['Giá'] > 0)].copy()
-                
-                if not df_ct.empty:
-                    df_ct['Thời hạn cho thuê'] = df_ct['Ngày in'].apply(fmt_date) + " - " + df_ct['Ngày out'].apply(fmt_date)
-                    df_ct = df_ct.sort_values(by=['Giá'], ascending=False)
-                    df_ct = df_ct.drop_duplicates(subset=['Toà', 'Mã căn', 'Thời hạn cho thuê'], keep='first')
-                    
-                    is_co_hd = df_ct.apply(lambda r: (r['Toà'], r['Mã căn']) in active_owner_tuples, axis=1)
-                    df_dt_co = df_ct[is_co_hd]
-                    df_dt_khong = df_ct[~is_co_hd]
+            f = df_facts[df_facts['Tháng'] == start_d]
+            df_ct = f[f['Giá thuê'] > 0]
+            df_ct = df_ct.assign(**{'Số ngày': df_ct['Số ngày thuê'], 'Giá': df_ct[col_thue]})
+            df_dt_co = df_ct[df_ct['Có HĐ chủ']]
+            df_dt_khong = df_ct[~df_ct['Có HĐ chủ']]
+            df_hd_cost = f[f['Giá HĐ'] > 0]
+            df_hd_cost = df_hd_cost.assign(**{'Số ngày': df_hd_cost['Số ngày HĐ'], 'Giá HĐ': df_hd_cost[col_hd]})
+            if not accrual_mode:
+                df_dt_co, df_dt_khong, df_hd_cost = [d.drop(columns='Số ngày') for d in (df_dt_co, df_dt_khong, df_hd_cost)]
 
-                    dt_co_hd = df_dt_co['Giá'].sum()
-                    dt_khong_hd = df_dt_khong['Giá'].sum()
+            dt_co_hd = df_dt_co['Giá'].sum()
+            dt_khong_hd = df_dt_khong['Giá'].sum()
+            chi_phi_hd = df_hd_cost['Giá HĐ'].sum()
 
             if not df_chiphi.empty:
                 mask_cp = (df_chiphi['Ngày'] >= start_d) & (df_chiphi['Ngày'] <= end_d)
@@ -1172,15 +1245,24 @@ if sh:
             yearly_data = []
             detailed_data = {}
 
+            # Bảng thu - chi từng Tòa tính song song một lần cho mỗi (năm, cách tính) của phiên bản dữ liệu;
+            # số tổng = cộng bảng của các Tòa đang xem, không tính lại từ dòng gốc
+            accrual_kd = mode_kd == accrual.MODE_ACCRUAL
+            phan_toa_kd = snap.shared(('kd_theo_toa', y_kd, max_month, accrual_kd), lambda: portfolio.month_partials(
+                snap.year(y_kd), df_cp, y_kd, max_month, accrual_kd, snap.df_rooms))
+            df_pnl_kd = portfolio.merge_months(phan_toa_kd, toa_xem, max_month)
+            facts_kd = portfolio.select(snap.year(y_kd), toa_xem)
+            df_cp_kd = df_cp[portfolio.cp_buildings(df_cp, snap.df_rooms, snap.year(y_kd)).isin(toa_xem).to_numpy()] if toa_xem and not df_cp.empty else df_cp
             for m in range(1, max_month + 1):
-                dt_co, dt_khong, cp_hd, cp_vh, ln, d_dt_co, d_dt_khong, d_hd_cost, d_cp_vh = calc_month_stats_detailed(df_main, df_cp, m, y_kd)
+                _, _, _, _, _, d_dt_co, d_dt_khong, d_hd_cost, d_cp_vh = calc_month_stats_detailed(facts_kd, df_cp_kd, m, y_kd, accrual_kd)
+                r = df_pnl_kd.iloc[m - 1]
                 yearly_data.append({
                     "Tháng": f"Tháng {m}",
-                    "Doanh Thu (Có HĐ gốc)": dt_co,
-                    "Chi Phí HĐ (Chủ nhà)": cp_hd,
-                    "Chi Phí Khác (VH)": cp_vh,
-                    "Lợi Nhuận Ròng": ln,
-                    "DT Treo (Không HĐ)": dt_khong
+                    "Doanh Thu (Có HĐ gốc)": r['Doanh thu'],
+                    "Chi Phí HĐ (Chủ nhà)": r['Chi phí HĐ'],
+                    "Chi Phí Khác (VH)": r['Chi phí VH'],
+                    "Lợi Nhuận Ròng": r['Lợi nhuận'],
+                    "DT Treo (Không HĐ)": r['DT treo']
                 })
                 detailed_data[m] = {
                     'dt_co': d_dt_co,
@@ -1213,7 +1295,23 @@ if sh:
                 use_container_width=True
             )
             
-            st.download_button("📥 Tải Bảng Báo Cáo Tổng Excel", convert_df_to_excel(df_year), f"BaoCao_KinhDoanh_{y_kd}.xlsx")
+            st.download_button("📥 Tải Bảng Báo Cáo Tổng Excel", excel_khi_bam(df_year), f"BaoCao_KinhDoanh_{y_kd}.xlsx")
+            st.divider()
+
+            # Biểu đồ chỉ dùng bảng tổng hợp nhỏ, tính một lần cho mỗi (năm, tháng, cách tính) của phiên bản dữ liệu.
+            # Xu hướng lấp đầy: 3 năm gần nhất tính tới năm đang xem (chỉ đọc mảnh lưu trữ khi cần)
+            st.write("#### 📊 Biểu đồ")
+            bd = snap.shared(('bieu_do_kd', y_kd, max_month, accrual_kd, tuple(toa_xem)), lambda: dashboard.build_dashboard(
+                portfolio.select(snap.facts_since(pd.Timestamp(y_kd - 2, 1, 1)), toa_xem), portfolio.select(df_hh, toa_xem),
+                y_kd, max_month, df_pnl_kd, portfolio.building_totals(phan_toa_kd, toa_xem)))
+            plot_cfg = {'displaylogo': False}
+            g1, g2, g3, g4 = st.tabs(["💵 Thu - Chi", "🏢 Theo Tòa", "📉 Lấp đầy", "🤝 Hoa hồng"])
+            with g1: st.plotly_chart(dashboard.fig_pnl(bd['pnl']), use_container_width=True, config=plot_cfg)
+            with g2: st.plotly_chart(dashboard.fig_building(bd['toa']), use_container_width=True, config=plot_cfg)
+            with g3: st.plotly_chart(dashboard.fig_occupancy(bd['occ']), use_container_width=True, config=plot_cfg)
+            with g4:
+                if bd['hoa_hong'].empty: st.caption("Không có hoa hồng trong năm này.")
+                else: st.plotly_chart(dashboard.fig_commission(bd['hoa_hong']), use_container_width=True, config=plot_cfg)
             st.divider()
 
             st.write("#### 🔍 Giải trình chi tiết từng tháng")
@@ -1228,7 +1326,7 @@ if sh:
                     with t_hd:
                         st.markdown("**🟢 DOANH THU CHÍNH THỨC (Các phòng đang có HĐ Chủ)**")
                         if not d_m['dt_co'].empty:
-                            df_dt_co_disp = d_m['dt_co'][['Toà', 'Mã căn', 'Tên khách thuê', 'Giá']].copy()
+                            df_dt_co_disp = d_m['dt_co'][[c for c in ['Toà', 'Mã căn', 'Tên khách thuê', 'Số ngày', 'Giá'] if c in d_m['dt_co'].columns]].copy()
                             df_dt_co_disp['Giá'] = df_dt_co_disp['Giá'].apply(fmt_vnd)
                             st.dataframe(df_dt_co_disp, use_container_width=True)
                         else:
@@ -1236,7 +1334,7 @@ if sh:
                             
                         st.markdown("**🔴 CHI PHÍ HỢP ĐỒNG (Tiền trả Chủ nhà)**")
                         if not d_m['cp_hd'].empty:
-                            df_cp_hd_disp = d_m['cp_hd'][['Toà', 'Mã căn', 'Chủ nhà - sale', 'Giá HĐ']].copy()
+                            df_cp_hd_disp = d_m['cp_hd'][[c for c in ['Toà', 'Mã căn', 'Chủ nhà - sale', 'Số ngày', 'Giá HĐ'] if c in d_m['cp_hd'].columns]].copy()
                             df_cp_hd_disp['Giá HĐ'] = df_cp_hd_disp['Giá HĐ'].apply(fmt_vnd)
                             st.dataframe(df_cp_hd_disp, use_container_width=True)
                         else:
@@ -1244,7 +1342,7 @@ if sh:
                             
                         st.markdown("**⚪ DOANH THU TREO (Phòng có khách nhưng KHÔNG CÓ HĐ Chủ)**")
                         if not d_m['dt_khong'].empty:
-                            df_dt_khong_disp = d_m['dt_khong'][['Toà', 'Mã căn', 'Tên khách thuê', 'Giá']].copy()
+                            df_dt_khong_disp = d_m['dt_khong'][[c for c in ['Toà', 'Mã căn', 'Tên khách thuê', 'Số ngày', 'Giá'] if c in d_m['dt_khong'].columns]].copy()
                             df_dt_khong_disp['Giá'] = df_dt_khong_disp['Giá'].apply(fmt_vnd)
                             st.dataframe(df_dt_khong_disp, use_container_width=True)
                         else:
@@ -1262,4 +1360,421 @@ if sh:
                             st.caption("Không có chi phí phát sinh trong tháng này.")
 
         elif max_month == 0:
-            st.warning("Chưa có dữ liệu hoạt động cho năm tương lai.")
\ No newline at end of file
+            st.warning("Chưa có dữ liệu hoạt động cho năm tương lai.")
+
+    with tabs[9]:
+        st.subheader("📊 Công Suất Phòng & Chi Phí Phòng Trống")
+        st.write("**Tỉ lệ lấp đầy** = số ngày có khách / số ngày đang có HĐ chủ. **Chi phí mất** = tiền trả chủ nhà cho những ngày phòng trống (tính theo ngày).")
+
+        q_now = (date.today().month - 1) // 3
+        q_start = date(date.today().year, q_now * 3 + 1, 1) - pd.DateOffset(months=3)
+
+        c_occ1, c_occ2, c_occ3 = st.columns(3)
+        with c_occ1: occ_tu = st.date_input("Từ ngày", value=q_start.date(), key='occ_tu')
+        with c_occ2: occ_den = st.date_input("Đến ngày", value=date.today(), key='occ_den')
+        with c_occ3: occ_ky = st.selectbox("Chu kỳ", ["Tháng", "Quý", "Ngày"], key='occ_ky')
+        st.divider()
+
+        if occ_tu > occ_den:
+            st.warning("Ngày bắt đầu phải trước ngày kết thúc.")
+        elif not df_main.empty:
+            freq = {"Tháng": "M", "Quý": "Q", "Ngày": "D"}[occ_ky]
+            # Mỗi Tòa dựng ma trận ngày - phòng riêng (song song); tổng = cộng bảng các Tòa đang xem
+            phan_toa_occ = snap.shared(('cong_suat', occ_tu, occ_den, freq), lambda: portfolio.occupancy_partials(
+                snap.rows_since(pd.Timestamp(occ_tu)), occ_tu, occ_den, freq, stages))
+            df_occ_toa, df_occ_tong = portfolio.merge_occupancy(phan_toa_occ, toa_xem)
+
+            if df_occ_tong.empty:
+                st.warning("Không có dữ liệu phòng trong khoảng thời gian này.")
+            else:
+                sum_cols = ['Ngày có HĐ chủ', 'Ngày có khách', 'Ngày trống gánh phí', 'Chi phí mất (trống)']
+                tong = df_occ_tong[sum_cols].sum()
+                ti_le = tong['Ngày có khách'] / tong['Ngày có HĐ chủ'] * 100 if tong['Ngày có HĐ chủ'] > 0 else 0
+
+                st.write(f"#### 🏆 Tổng hợp từ {fmt_date(pd.Timestamp(occ_tu))} đến {fmt_date(pd.Timestamp(occ_den))}")
+                o1, o2, o3, o4 = st.columns(4)
+                o1.metric("Tỉ lệ lấp đầy", f"{ti_le:.1f}%")
+                o2.metric("Ngày-phòng có HĐ chủ", fmt_vnd(tong['Ngày có HĐ chủ']))
+                o3.metric("Ngày-phòng trống gánh phí", fmt_vnd(tong['Ngày trống gánh phí']))
+                o4.metric("Chi phí mất do trống", fmt_vnd(tong['Chi phí mất (trống)']))
+
+                st.write("#### 🏢 Theo từng Tòa")
+                df_toa_tong = df_occ_toa.groupby('Toà', as_index=False)[sum_cols].sum()
+                df_toa_tong['Tỉ lệ lấp đầy (%)'] = (df_toa_tong['Ngày có khách'] / df_toa_tong['Ngày có HĐ chủ'].where(df_toa_tong['Ngày có HĐ chủ'] > 0) * 100).fillna(0).round(1)
+                df_toa_disp = df_toa_tong.copy()
+                for c in sum_cols: df_toa_disp[c] = df_toa_disp[c].apply(fmt_vnd)
+                st.dataframe(df_toa_disp, use_container_width=True)
+
+                st.write("#### 📉 Tỉ lệ lấp đầy theo kỳ (%)")
+                st.line_chart(df_occ_toa.pivot(index='Kỳ', columns='Toà', values='Tỉ lệ lấp đầy (%)'))
+
+                with st.expander("📋 Chi tiết từng kỳ theo Tòa"):
+                    df_occ_disp = df_occ_toa.copy()
+                    for c in sum_cols: df_occ_disp[c] = df_occ_disp[c].apply(fmt_vnd)
+                    st.dataframe(df_occ_disp, use_container_width=True)
+
+                st.download_button("📥 Tải Excel Công Suất", excel_khi_bam(df_occ_toa), f"CongSuat_{occ_tu}_{occ_den}.xlsx")
+
+    with tabs[10]:
+        st.subheader("🤖 Hỏi Dữ Liệu")
+        st.caption("Trợ lý chỉ đọc bản tóm tắt (tổng theo tháng, theo Tòa, top phòng lãi/lỗ, nhóm cảnh báo), không gửi dữ liệu gốc.")
+
+        @st.cache_resource
+        def get_assistant():
+            kind, api_key, model = assistant.get_ai_config(st.secrets)
+            return assistant.Assistant(assistant.make_client(kind, api_key, model, assistant.ai_available()))
+
+        tro_ly = get_assistant()
+        if tro_ly.client.name == assistant.CLIENT_STUB:
+            st.info("ℹ️ Đang dùng chế độ offline (chưa cấu hình gemini_api_key): trả lời theo từ khóa như lỗ / lãi / trống / hết hạn.")
+
+        if 'hoi_dap' not in st.session_state: st.session_state.hoi_dap = []
+        with st.form("form_hoi_dap", clear_on_submit=True):
+            cau_hoi = st.text_input("Câu hỏi", placeholder="VD: Phòng nào lỗ nhiều nhất quý này?", key='cau_hoi')
+            gui = st.form_submit_button("💬 Hỏi")
+
+        if gui and cau_hoi.strip():
+            ngu_canh = snap.shared(('ngu_canh', date.today()), lambda: assistant.build_context(snap.facts, df_cp, df_main, date.today(), snap.df_rooms))
+            try:
+                with st.spinner("Đang phân tích..."):
+                    tra_loi, tu_cache = tro_ly.ask(cau_hoi.strip(), ngu_canh, data_version)
+                st.session_state.hoi_dap.insert(0, (cau_hoi.strip(), tra_loi, tu_cache))
+            except Exception as e:
+                st.error(f"❌ Lỗi trợ lý: {e}")
+
+        for hoi, dap, tu_cache in st.session_state.hoi_dap[:10]:
+            with st.chat_message("user"): st.write(hoi)
+            with st.chat_message("assistant"):
+                st.text(dap)
+                if tu_cache: st.caption("⚡ Trả lời từ bộ nhớ đệm (dữ liệu chưa đổi)")
+
+    with tabs[11]:
+        st.subheader("🤝 Sổ Hoa Hồng (Theo Người Nhận)")
+        y_hh = st.selectbox("Chọn Năm", range(2020, date.today().year + 5), index=(date.today().year - 2020), key='y_hh')
+        st.divider()
+
+        df_hh_nam = commission.rollup(df_hh, y_hh)
+        if df_hh_nam.empty:
+            st.info(f"Chưa có hoa hồng nào ghi nhận trong năm {y_hh}.")
+        else:
+            h1, h2 = st.columns(2)
+            h1.metric("Tổng hoa hồng", fmt_vnd(df_hh_nam['Tổng'].sum()))
+            h2.metric("Số người nhận", len(df_hh_nam))
+
+            df_hh_disp = df_hh_nam.copy()
+            for c in df_hh_disp.columns[1:]: df_hh_disp[c] = df_hh_disp[c].apply(fmt_vnd)
+            st.dataframe(df_hh_disp, use_container_width=True, hide_index=True)
+            st.download_button("📥 Tải Excel Hoa Hồng", excel_khi_bam(df_hh_nam), f"HoaHong_{y_hh}.xlsx")
+
+        with st.expander("📋 Sổ chi tiết (mỗi dòng = một khoản hoa hồng của một dòng HĐ)"):
+            chon_nguoi = st.multiselect("Người nhận", commission.payees(df_hh), key='hh_nguoi')
+            df_so = df_hh[df_hh['Người nhận'].isin(chon_nguoi)] if chon_nguoi else df_hh
+            df_so = df_so.sort_values(by=['Ngày in', 'Ngày ký'], ascending=False).copy()
+            for c in ['Ngày ký', 'Ngày in']: df_so[c] = df_so[c].apply(fmt_date)
+            df_so['Tiền'] = df_so['Tiền'].apply(fmt_vnd)
+            st.dataframe(df_so, use_container_width=True, hide_index=True)
+
+    # --- TAB 12: KIỂM TRA CHẤT LƯỢNG DỮ LIỆU HOP_DONG ---
+    with tabs[12]:
+        st.subheader("🧹 Kiểm Tra Chất Lượng Dữ Liệu HOP_DONG")
+        st.caption("Quét toàn bộ HOP_DONG: dòng trùng hoàn toàn, khách thuê chồng lấn trên cùng phòng, HĐ chủ bị hở, thiếu Toà, Mã căn viết khác nhau, ô ngày không đọc được (cả CHI_PHI, HOA_HONG). Số dòng tính theo sheet (dòng 1 là tiêu đề).")
+
+        df_loi, hash_dong = snap.shared('chat_luong', lambda: quality.scan(df_main, snap.date_issues))
+        df_tom_tat = quality.summarize(df_loi)
+        cols_q = st.columns(len(df_tom_tat))
+        for col, (_, r) in zip(cols_q, df_tom_tat.iterrows()): col.metric(r['Loại'], r['Số lỗi'])
+
+        if df_loi.empty:
+            st.success("✅ Không phát hiện lỗi dữ liệu.")
+        else:
+            chon_loai = st.multiselect("Loại lỗi", quality.ISSUE_TYPES, key='q_loai')
+            df_loi_xem = df_loi[df_loi['Loại'].isin(chon_loai)] if chon_loai else df_loi
+            st.dataframe(df_loi_xem, use_container_width=True, hide_index=True)
+            st.download_button("📥 Tải Excel Lỗi Dữ Liệu", excel_khi_bam(df_loi), "LoiDuLieu_HopDong.xlsx")
+
+            so_trung = len(df_main) - len(quality.drop_exact_duplicates(df_main, hash_dong))
+            if so_trung:
+                st.warning(f"Có {so_trung} dòng trùng hoàn toàn với một dòng khác (mọi cột giống nhau).")
+                if st.button(f"🗑 Xóa {so_trung} dòng trùng (giữ dòng đầu tiên)", key='q_xoa_trung'):
+                    save_hop_dong(quality.drop_exact_duplicates(df_main, hash_dong)); cho_du_lieu_moi(); st.rerun()
+
+        with st.expander("📅 Định dạng ngày đã nhận diện (số ô theo từng định dạng)"):
+            st.dataframe(snap.date_formats, use_container_width=True, hide_index=True)
+
+    # --- TAB 13: SỔ TIỀN CỌC (CỌC KHÁCH ĐANG GIỮ / CỌC ĐÃ ĐẶT CHỦ NHÀ) ---
+    with tabs[13]:
+        st.subheader("🔐 Sổ Tiền Cọc")
+        ngay_coc = st.date_input("Số dư tại ngày", date.today(), key='ngay_coc')
+        st.caption("Cọc khách: nhận ngày khách vào, trả ngày khách ra. Cọc chủ nhà: đặt ngày ký, nhận lại khi chuỗi HĐ chủ liền mạch kết thúc hoặc có khoản cọc mới thay thế.")
+        st.divider()
+
+        def tinh_so_coc(df_nguon):
+            items = deposit.deposit_items(df_nguon)
+            return items, deposit.build_events(items)
+
+        # Ngày xem trước mốc lưu trữ -> gồm cả các mảnh lưu trữ từ năm đó
+        coc_items, coc_events = snap.shared(('so_coc', snap.range_key(pd.Timestamp(ngay_coc))),
+                                            lambda: tinh_so_coc(snap.rows_since(pd.Timestamp(ngay_coc))))
+        tong_coc = deposit.totals(coc_events, ngay_coc)
+        k1, k2, k3 = st.columns(3)
+        k1.metric("Cọc khách đang giữ (phải trả lại)", fmt_vnd(tong_coc[deposit.KHACH]))
+        k2.metric("Cọc đang đặt ở chủ nhà", fmt_vnd(tong_coc[deposit.CHU_NHA]))
+        k3.metric("Chênh lệch (giữ - đặt)", fmt_vnd(tong_coc[deposit.KHACH] - tong_coc[deposit.CHU_NHA]))
+
+        if coc_events.empty:
+            st.info("Chưa có khoản cọc nào trong HOP_DONG.")
+        else:
+            df_coc_toa = deposit.balances(coc_events, ngay_coc, by=['Toà'])
+            df_coc_phong = deposit.balances(coc_events, ngay_coc)
+            df_coc_mo = deposit.open_items(coc_items, ngay_coc)
+            chuoi_coc = deposit.balance_series(coc_events, ngay_coc)
+            st.line_chart(chuoi_coc.set_index('Tháng'), height=260)
+
+            c_toa, c_phong = st.columns([1, 2])
+            with c_toa:
+                st.write("**Theo Tòa**")
+                df_disp = df_coc_toa.copy()
+                for c in df_disp.columns[1:]: df_disp[c] = df_disp[c].apply(fmt_vnd)
+                st.dataframe(df_disp, use_container_width=True, hide_index=True)
+            with c_phong:
+                st.write("**Theo phòng**")
+                df_disp = df_coc_phong.copy()
+                for c in df_disp.columns[2:]: df_disp[c] = df_disp[c].apply(fmt_vnd)
+                st.dataframe(df_disp, use_container_width=True, hide_index=True)
+
+            with st.expander(f"📋 Các khoản cọc còn hiệu lực ({len(df_coc_mo)})"):
+                df_disp = df_coc_mo.copy()
+                for c in ['Ngày nhận', 'Ngày trả']: df_disp[c] = df_disp[c].apply(fmt_date)
+                df_disp['Tiền'] = df_disp['Tiền'].apply(fmt_vnd)
+                st.dataframe(df_disp, use_container_width=True, hide_index=True)
+
+            with st.expander("📒 Lịch sử sự kiện cọc của một phòng"):
+                q1, q2 = st.columns(2)
+                with q1: toa_coc = st.selectbox("Tòa", sorted(coc_events['Toà'].unique()), key='toa_coc')
+                with q2: can_coc = st.selectbox("Mã căn", sorted(coc_events.loc[coc_events['Toà'] == toa_coc, 'Mã căn'].unique()), key='can_coc')
+                df_ls = coc_events[(coc_events['Toà'] == toa_coc) & (coc_events['Mã căn'] == can_coc)]
+                df_ls = df_ls[df_ls['Ngày'] <= pd.Timestamp(ngay_coc)].drop(columns=['Số dư Tòa', 'Số dư tổng'])
+                df_disp = df_ls.copy()
+                df_disp['Ngày'] = df_disp['Ngày'].apply(fmt_date)
+                for c in ['Tiền', 'Số dư phòng']: df_disp[c] = df_disp[c].apply(fmt_vnd)
+                st.dataframe(df_disp, use_container_width=True, hide_index=True)
+
+            def xuat_so_coc():
+                out_coc = io.BytesIO()
+                with pd.ExcelWriter(out_coc, engine='xlsxwriter') as writer:
+                    df_coc_toa.to_excel(writer, sheet_name='Theo Toa', index=False)
+                    df_coc_phong.to_excel(writer, sheet_name='Theo Phong', index=False)
+                    df_coc_mo.to_excel(writer, sheet_name='Dang Hieu Luc', index=False)
+                    coc_events[coc_events['Ngày'] <= pd.Timestamp(ngay_coc)].to_excel(writer, sheet_name='So Su Kien', index=False)
+                return out_coc.getvalue()
+            st.download_button("📥 Tải Excel Sổ Cọc", xuat_so_coc, f"SoCoc_{ngay_coc.strftime('%d%m%Y')}.xlsx")
+
+    # --- TAB 14: DỰ BÁO DÒNG TIỀN ---
+    with tabs[14]:
+        st.subheader("🔮 Dự Báo Dòng Tiền")
+        st.caption("Cam kết: HĐ chủ còn hiệu lực (theo giá từng giai đoạn) và các lượt thuê hiện tại, chia theo ngày trong tháng. "
+                   "Giả định: gia hạn HĐ chủ hết hạn trong kỳ, cho thuê lại phòng sau khi khách ra.")
+        hom_nay = date.today()
+        d1, d2, d3 = st.columns(3)
+        with d1:
+            so_thang = st.slider("Số tháng dự báo", 3, 24, forecast.HORIZON_MONTHS, key='db_thang')
+        with d2:
+            gia_han = st.toggle("Gia hạn HĐ chủ hết hạn", True, key='db_gia_han')
+            tang_chu = st.number_input("Tăng giá HĐ chủ khi gia hạn (%)", -50.0, 100.0, 0.0, 1.0,
+                                       key='db_tang_chu', disabled=not gia_han)
+        with d3:
+            thue_lai = st.toggle("Cho thuê lại sau khi khách ra", True, key='db_thue_lai')
+            c_trong, c_gia = st.columns(2)
+            with c_trong:
+                ngay_trong = st.number_input("Số ngày trống", 0, 365, forecast.DEFAULT_VACANCY_DAYS, 5,
+                                             key='db_trong', disabled=not thue_lai)
+            with c_gia:
+                doi_gia = st.number_input("Đổi giá thuê (%)", -50.0, 100.0, 0.0, 1.0,
+                                          key='db_doi_gia', disabled=not thue_lai)
+
+        # Chuẩn bị một lần cho mỗi (phiên bản dữ liệu, ngày); đổi kịch bản chỉ tính lại phép chiếu
+        goc_db = snap.shared(('du_bao_goc', hom_nay), lambda: forecast.prepare(df_main, hom_nay, stages))
+        kich_ban = (so_thang, gia_han, tang_chu if gia_han else 0.0, thue_lai, ngay_trong if thue_lai else 0,
+                    doi_gia if thue_lai else 0.0)
+        proj = snap.shared(('du_bao',) + kich_ban + (hom_nay,), lambda: forecast.project(
+            goc_db, so_thang, renew_owner=gia_han, owner_increase=kich_ban[2] / 100,
+            relet=thue_lai, vacancy_days=kich_ban[4], rent_change=kich_ban[5] / 100))
+
+        if proj.empty:
+            st.info("Không có HĐ chủ hay lượt thuê nào còn hiệu lực để dự báo.")
+        else:
+            df_db_thang = forecast.monthly(proj)
+            df_db_toa = forecast.by_building(proj)
+            df_db_phong = forecast.by_room(proj)
+            tong_thu = df_db_thang[[forecast.RENT, forecast.RENT_ASSUMED, forecast.DEPOSIT_BACK]].sum().sum()
+            tong_chi = df_db_thang[[forecast.OWNER, forecast.OWNER_ASSUMED, forecast.DEPOSIT_OUT]].sum().sum()
+            thap_nhat = df_db_thang.loc[df_db_thang['Lũy kế'].idxmin()]
+            m1, m2, m3, m4 = st.columns(4)
+            m1.metric("Tổng thu dự kiến", fmt_vnd(tong_thu))
+            m2.metric("Tổng chi dự kiến", fmt_vnd(tong_chi))
+            m3.metric("Dòng tiền ròng", fmt_vnd(tong_thu - tong_chi))
+            m4.metric("Lũy kế thấp nhất", fmt_vnd(thap_nhat['Lũy kế']), thap_nhat['Tháng'].strftime('%m/%Y'),
+                      delta_color='off')
+
+            st.plotly_chart(dashboard.fig_cashflow(df_db_thang), use_container_width=True,
+                            config={'displaylogo': False})
+
+            df_disp = df_db_thang.copy()
+            df_disp['Tháng'] = df_disp['Tháng'].dt.strftime('%m/%Y')
+            for c in forecast.FLOW_COLUMNS + ['Dòng tiền ròng', 'Lũy kế']: df_disp[c] = df_disp[c].apply(fmt_vnd)
+            df_disp['Ngày trống'] = df_disp['Ngày trống'].round(0).astype(int)
+            st.dataframe(df_disp, use_container_width=True, hide_index=True)
+
+            with st.expander(f"🏢 Theo Tòa ({len(df_db_toa)})"):
+                df_disp = df_db_toa.copy()
+                for c in forecast.FLOW_COLUMNS + ['Dòng tiền ròng']: df_disp[c] = df_disp[c].apply(fmt_vnd)
+                df_disp['Ngày trống'] = df_disp['Ngày trống'].round(0).astype(int)
+                st.dataframe(df_disp, use_container_width=True, hide_index=True)
+
+            with st.expander(f"🚪 Theo phòng ({len(df_db_phong)}), âm nhiều nhất trước"):
+                df_disp = df_db_phong.copy()
+                for c in forecast.FLOW_COLUMNS + ['Dòng tiền ròng']: df_disp[c] = df_disp[c].apply(fmt_vnd)
+                df_disp['Ngày trống'] = df_disp['Ngày trống'].round(0).astype(int)
+                st.dataframe(df_disp, use_container_width=True, hide_index=True)
+
+            def xuat_du_bao():
+                out_db = io.BytesIO()
+                with pd.ExcelWriter(out_db, engine='xlsxwriter') as writer:
+                    df_db_thang.to_excel(writer, sheet_name='Theo Thang', index=False)
+                    df_db_toa.to_excel(writer, sheet_name='Theo Toa', index=False)
+                    df_db_phong.to_excel(writer, sheet_name='Theo Phong', index=False)
+                    proj.to_excel(writer, sheet_name='Phong x Thang', index=False)
+                return out_db.getvalue()
+            st.download_button("📥 Tải Excel Dự Báo", xuat_du_bao, f"DuBao_{hom_nay.strftime('%d%m%Y')}_{so_thang}T.xlsx")
+
+    # --- TAB 15: NHẬT KÝ THAY ĐỔI + BÁO CÁO TẠI MỘT THỜI ĐIỂM ---
+    with tabs[15]:
+        st.subheader("🕰️ Nhật Ký Thay Đổi")
+        st.caption("Mỗi lần lưu chỉ ghi phần thay đổi (dòng thêm / xóa, ô sửa: giá trị cũ -> mới), kèm người sửa và thời điểm. "
+                   "Dữ liệu tại một thời điểm được dựng lại từ mốc gần nhất với thời điểm đó. "
+                   "Thời điểm hiển thị và nhập theo múi giờ của trình duyệt.")
+        # Nhật ký lưu giờ UTC -> hiển thị / nhập theo múi giờ người xem
+        mui_gio = st.context.timezone or journal.DEFAULT_TZ
+        if st.button("🔄 Đọc lại nhật ký", key='nk_doc_lai'): nhat_ky.entries(refresh=True)
+        nk_all = nhat_ky.entries()
+        if nhat_ky.last_error is not None:
+            st.warning(f"⚠️ Lần ghi nhật ký gần nhất bị lỗi: {nhat_ky.last_error}")
+
+        if nk_all.empty:
+            st.info("Chưa có thay đổi nào được ghi nhật ký. Nhật ký bắt đầu từ lần lưu đầu tiên sau khi bật tính năng này.")
+        else:
+            f1, f2, f3, f4 = st.columns(4)
+            with f1: nk_sheet = st.selectbox("Sheet", ["Tất cả"] + journal.TRACKED_SHEETS, key='nk_sheet')
+            with f2: nk_phong = st.text_input("Phòng (Toà/Mã căn)", key='nk_phong', placeholder="VD: MT60/101")
+            with f3:
+                ds_cot = sorted(c for c in nk_all['Cột'].unique() if c)
+                nk_cot = st.selectbox("Cột", ["Tất cả"] + ds_cot, key='nk_cot')
+            with f4:
+                ds_nguoi = sorted(u for u in nk_all['Người sửa'].unique() if u)
+                nk_nguoi = st.selectbox("Người sửa", ["Tất cả"] + ds_nguoi, key='nk_nguoi')
+            df_ls = nhat_ky.history(None if nk_sheet == "Tất cả" else nk_sheet, nk_phong,
+                                    None if nk_cot == "Tất cả" else nk_cot, None if nk_nguoi == "Tất cả" else nk_nguoi)
+            df_ls = df_ls.assign(**{'Thời điểm': journal.local_times(df_ls['Thời điểm'], mui_gio)})
+            st.caption(f"{len(df_ls)} thay đổi gần nhất (tối đa 500)")
+            st.dataframe(df_ls[['Thời điểm', 'Người sửa', 'Sheet', 'Thao tác', 'Phòng', 'Cột', 'Cũ', 'Mới']],
+                         use_container_width=True, hide_index=True)
+
+            st.divider()
+            st.write("### 📅 Báo cáo theo dữ liệu tại một thời điểm")
+            bat_dau = nhat_ky.started_at().tz_convert(mui_gio)
+            bay_gio = datetime.now(ZoneInfo(mui_gio))
+            st.caption(f"Dựng lại được từ {bat_dau.strftime('%d/%m/%Y %H:%M:%S')} (lần ghi nhật ký đầu tiên, giờ {mui_gio}).")
+            t1, t2, t3 = st.columns(3)
+            with t1: ngay_moc = st.date_input("Ngày", bay_gio.date(), min_value=bat_dau.date(), key='nk_ngay')
+            with t2: gio_moc = st.time_input("Giờ", bay_gio.time().replace(microsecond=0), key='nk_gio', step=60)
+            with t3: nam_moc = st.number_input("Năm báo cáo", 2020, 2035, bay_gio.year, key='nk_nam')
+            thoi_diem = datetime.combine(ngay_moc, gio_moc)
+            thoi_diem_utc = journal.to_utc(thoi_diem, mui_gio)
+
+            # Dựng lại một lần cho mỗi (thời điểm UTC, độ dài nhật ký, phiên bản dữ liệu)
+            df_moc, df_cp_moc, df_hh_moc, stages_moc = snap.shared(
+                ('nk_tai_moc', thoi_diem_utc, len(nk_all)), lambda: journal.frames_as_of(nhat_ky, thoi_diem_utc, snap.raw))
+            facts_moc = snap.shared(('nk_facts_moc', thoi_diem_utc, len(nk_all)),
+                                    lambda: facts.build_facts(df_moc, df_hh_moc, stages_moc))
+
+            cot_bc = ['Giá thuê dồn tích', 'Giá HĐ dồn tích', 'KH thanh toán', 'TT cho chủ nhà', 'Hoa hồng']
+
+            def tong_thang(df_f):
+                df_f = df_f[df_f['Tháng'].dt.year == nam_moc] if not df_f.empty else df_f
+                out = df_f.groupby('Tháng')[cot_bc].sum() if not df_f.empty else pd.DataFrame(columns=cot_bc)
+                return out.reindex(pd.date_range(f"{nam_moc}-01-01", periods=12, freq='MS'), fill_value=0)
+
+            df_bc_moc = tong_thang(facts_moc)
+            df_bc_nay = tong_thang(snap.facts)
+            m1, m2, m3 = st.columns(3)
+            m1.metric("Số dòng HOP_DONG tại mốc", len(df_moc), len(df_moc) - len(df_main), delta_color='off')
+            m2.metric(f"Doanh thu dồn tích {nam_moc} tại mốc", fmt_vnd(df_bc_moc['Giá thuê dồn tích'].sum()))
+            m3.metric(f"Chi chủ nhà dồn tích {nam_moc} tại mốc", fmt_vnd(df_bc_moc['Giá HĐ dồn tích'].sum()))
+
+            df_bc = df_bc_moc.copy()
+            for c in cot_bc: df_bc[f"{c} - đổi đến nay"] = df_bc_nay[c] - df_bc_moc[c]
+            df_bc = df_bc.rename_axis('Tháng').reset_index()
+            df_disp = df_bc.copy()
+            df_disp['Tháng'] = df_disp['Tháng'].dt.strftime('%m/%Y')
+            for c in df_disp.columns[1:]: df_disp[c] = df_disp[c].apply(fmt_vnd)
+            st.dataframe(df_disp, use_container_width=True, hide_index=True)
+
+            with st.expander(f"📋 HOP_DONG tại {thoi_diem.strftime('%d/%m/%Y %H:%M')} ({len(df_moc)} dòng)"):
+                st.dataframe(df_moc, use_container_width=True, hide_index=True)
+
+            def xuat_tai_moc():
+                out_nk = io.BytesIO()
+                with pd.ExcelWriter(out_nk, engine='xlsxwriter') as writer:
+                    df_bc.to_excel(writer, sheet_name='Theo Thang', index=False)
+                    df_moc.to_excel(writer, sheet_name='HOP_DONG', index=False)
+                    df_hh_moc.to_excel(writer, sheet_name='HOA_HONG', index=False)
+                    stages_moc.frame.to_excel(writer, sheet_name='GIA_HD', index=False)
+                    df_cp_moc.to_excel(writer, sheet_name='CHI_PHI', index=False)
+                return out_nk.getvalue()
+            st.download_button("📥 Tải Excel dữ liệu tại mốc", xuat_tai_moc, f"TaiMoc_{thoi_diem.strftime('%d%m%Y_%H%M')}.xlsx")
+
+    # --- TAB 16: BẢNG KÊ THÁNG CHO CHỦ NHÀ / KHÁCH THUÊ ---
+    with tabs[16]:
+        st.subheader("🧾 Bảng Kê Tháng")
+        st.caption("Mỗi chủ nhà / khách thuê một bảng kê HTML (mở bằng trình duyệt, in hoặc lưu PDF bằng Ctrl+P). "
+                   "Tải về một file zip gồm mọi bảng kê và trang mục lục. Chỉ gồm các Tòa đang xem ở thanh bên.")
+
+        @st.cache_resource
+        def get_statement_pool():
+            # Process pool dùng chung cả tiến trình: các tiến trình con giữ sẵn mẫu đã biên dịch giữa các lần tạo
+            return statements.make_pool()
+
+        b1, b2, b3 = st.columns(3)
+        with b1: m_bk = st.selectbox("Tháng", range(1, 13), index=date.today().month - 1, key='bk_thang')
+        with b2: y_bk = st.number_input("Năm", value=date.today().year, key='bk_nam')
+        with b3: loai_bk = st.multiselect("Loại bảng kê", list(statements.KIND_LABELS), default=list(statements.KIND_LABELS),
+                                          format_func=statements.KIND_LABELS.get, key='bk_loai')
+
+        def tao_bang_ke():
+            df_nguon = portfolio.select(snap.rows_since(pd.Timestamp(y_bk, m_bk, 1)), toa_xem)
+            ngay_lap = date.today().strftime('%d/%m/%Y')
+            return (statements.owner_statements(df_nguon, stages, y_bk, m_bk, ngay_lap)
+                    + statements.tenant_statements(df_nguon, df_cp, snap.df_rooms, y_bk, m_bk, ngay_lap))
+
+        ds_bk = snap.shared(('bang_ke', y_bk, m_bk, tuple(toa_xem), date.today()), tao_bang_ke)
+        ds_bk = [b for b in ds_bk if b['kind'] in loai_bk]
+        if not ds_bk:
+            st.info(f"Không có HĐ chủ hay lượt thuê nào trong tháng {m_bk}/{y_bk}.")
+        else:
+            df_bk = pd.DataFrame([{"Loại": statements.KIND_LABELS[b['kind']], "Tên": b['name'],
+                                   "Số dòng": len(b['sections'][0][2]), "Tiền tháng": b['totals'][0][1]} for b in ds_bk])
+            k1, k2 = st.columns(2)
+            k1.metric("Bảng kê chủ nhà", sum(b['kind'] == statements.KIND_OWNER for b in ds_bk))
+            k2.metric("Bảng kê khách thuê", sum(b['kind'] == statements.KIND_TENANT for b in ds_bk))
+            df_disp = df_bk.copy()
+            df_disp['Tiền tháng'] = df_disp['Tiền tháng'].apply(fmt_vnd)
+            st.dataframe(df_disp, use_container_width=True, hide_index=True)
+
+            with st.expander("👁 Xem trước một bảng kê"):
+                i_bk = st.selectbox("Bảng kê", range(len(ds_bk)), key='bk_xem',
+                                    format_func=lambda i: f"{statements.KIND_LABELS[ds_bk[i]['kind']]} - {ds_bk[i]['name']}")
+                st.iframe(statements.render(ds_bk[i_bk])[1].decode('utf-8'), height=520)
+
+            # Chỉ dựng zip khi bấm tải
+            st.download_button(f"📦 Tải {len(ds_bk)} bảng kê (zip)", lambda: statements.build_zip(ds_bk, get_statement_pool()),
+                               f"BangKe_{m_bk:02d}{y_bk}.zip", mime="application/zip")
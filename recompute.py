@@ -0,0 +1,312 @@
+import queue
+import threading
+import time
+from collections import OrderedDict
+from datetime import date
+
+import pandas as pd
+
+import commission
+import dates
+import facts
+import portfolio
+import quality
+import revisions
+import schedule
+import storage
+from core import (frame_version, gop_du_lieu_phong, normalize_chi_phi, normalize_gia_hd, normalize_hoa_hong,
+                  normalize_hop_dong, normalize_toa_nha)
+
+# ==============================================================================
+# TÍNH LẠI DỮ LIỆU DẪN XUẤT Ở LUỒNG NỀN (DÙNG CHUNG MỌI PHIÊN)
+# - Mỗi lần ghi chỉ gửi một sự kiện (tên sheet + bảng vừa ghi) vào hàng đợi rồi trả về ngay
+# - Luồng nền gộp các sự kiện đang chờ, chuẩn hóa, đồng bộ bảng phòng - tháng, gom phòng,
+#   tính nhóm cảnh báo rồi công bố một Snapshot mới bằng một lần gán tham chiếu
+# - Phiên nào cũng hiển thị ngay Snapshot đã công bố gần nhất; Snapshot không bao giờ bị sửa
+# ==============================================================================
+
+TABS = ["HOP_DONG", "CHI_PHI", "HOA_HONG", "GIA_HD", portfolio.ROOMS_SHEET]
+REFRESH_SECONDS = 300    # tự tải lại từ kho định kỳ để thấy thay đổi của người khác
+STARTUP_WAIT = 0.5       # lần tải đầu: chờ chừng này rồi vẽ khung trang, dữ liệu hiện khi tải xong
+SAVE_WAIT = 0.8          # sau khi lưu, chờ tối đa chừng này giây cho phiên bản mới
+SHARED_MAX_ENTRIES = 64  # số bảng dẫn xuất dùng chung giữ lại cho mỗi phiên bản dữ liệu
+
+
+def values_frame(df):
+    # Bảng đúng như khi đọc lại từ kho (mọi ô qua chuỗi rồi numericise) - không cần tải lại qua mạng
+    return revisions.frame_of(storage.frame_to_values(df))
+
+
+def alert_frames(rooms, today):
+    # Các nhóm cảnh báo ở thanh bên, tính trên bảng đã gom theo phòng
+    if rooms.empty: return {k: rooms for k in ['hd', 'kh', 'trong_co_hd', 'trong_khong_hd']}
+    het_con = (rooms['Ngày hết HĐ'] - today).dt.days
+    out_con = (rooms['Ngày out'] - today).dt.days
+    has_tenant = (rooms['Ngày in'] <= today) & (rooms['Ngày out'] >= today)
+    has_owner = (rooms['Ngày ký'] <= today) & (rooms['Ngày hết HĐ'] >= today)
+    return {
+        'hd': rooms[het_con.between(-999, 30)],
+        'kh': rooms[out_con.between(0, 7)],
+        'trong_co_hd': rooms[~has_tenant & has_owner],
+        'trong_khong_hd': rooms[~has_tenant & ~has_owner],
+    }
+
+
+class _Once:
+    # Tính một lần, các luồng gọi cùng lúc chờ chung một kết quả
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._done = False
+        self.value = None
+
+    def get(self, fn):
+        with self._lock:
+            if not self._done:
+                self.value = fn()
+                self._done = True
+        return self.value
+
+
+class SharedFrames:
+    # Bảng dẫn xuất dùng chung mọi phiên theo phiên bản dữ liệu: mỗi khóa tính đúng một lần,
+    # mọi phiên nhận cùng một đối tượng (không sao chép như st.cache_data) -> chỉ đọc
+    def __init__(self, max_entries=SHARED_MAX_ENTRIES):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+        self._max_entries = max_entries
+
+    def get(self, key, fn):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                entry = self._entries[key] = _Once()
+                while len(self._entries) > self._max_entries: self._entries.popitem(last=False)
+            else:
+                self._entries.move_to_end(key)
+        return entry.get(fn)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Snapshot:
+    # Một phiên bản dữ liệu đã tính xong; dùng chung mọi phiên, các phiên chỉ đọc, không sửa
+    def __init__(self, seq, raw, fact_store, today, fetch_seconds=None, archive=None, previous=None):
+        t0 = time.perf_counter()
+        self.seq = seq
+        self.fetch_seconds = dict(fetch_seconds or {})    # thời gian đọc từng sheet ở lần tải gần nhất
+        self.today = today
+        # Phiên bản từng sheet trên kho (bảng vừa đọc / vừa ghi, trước khi chuẩn hóa) - lần lưu sau ghi có điều kiện theo đó;
+        # sheet còn giữ bảng của bản trước (đọc lỗi, đợt này chỉ ghi sheet khác) -> giữ phiên bản cũ
+        old = previous.sheet_versions if previous is not None else {}
+        self.sheet_versions = {
+            tab: old[tab] if tab in old and df is previous.raw.get(tab) else revisions.sheet_version(df)
+            for tab, df in raw.items()
+        }
+        self.df_cp = normalize_chi_phi(raw.get("CHI_PHI", pd.DataFrame()).copy())
+        df_main = normalize_hop_dong(raw.get("HOP_DONG", pd.DataFrame()).copy())
+        df_hh = normalize_hoa_hong(raw.get("HOA_HONG", pd.DataFrame()).copy())
+        df_gd = normalize_gia_hd(raw.get("GIA_HD", pd.DataFrame()).copy())
+        self.df_rooms = normalize_toa_nha(raw.get(portfolio.ROOMS_SHEET, pd.DataFrame()).copy())
+        # Ô ngày không đọc được / định dạng ngày từng cột của lần chuẩn hóa này
+        self.date_issues = dates.PARSER.issues(TABS)
+        self.date_formats = dates.PARSER.summary(TABS)
+        # df_main chỉ gồm mảnh nóng; dòng đã lưu trữ lấy qua rows_since / facts_since
+        df_main, self.df_hh, self.so_hh_chuyen = commission.split_legacy(df_main, df_hh)
+        # Dòng GĐ2/GĐ3 kiểu cũ -> sổ GIA_HD; tra giá theo giai đoạn qua StageIndex
+        self.df_main, self.df_gd, self.so_gd_chuyen = schedule.split_legacy(df_main, df_gd)
+        self.stages = schedule.StageIndex(self.df_gd)
+        # Danh mục Tòa: khai báo trong TOA_NHA + Tòa chỉ có trong HOP_DONG
+        self.buildings = portfolio.buildings(self.df_rooms, self.df_main)
+        # Bảng đã chuẩn hóa thay cho bảng thô (chuẩn hóa lại không đổi gì) -> không giữ hai bản trong bộ nhớ;
+        # HOP_DONG còn cột hoa hồng cũ / dòng giai đoạn cũ thì giữ bảng thô để lần lưu sau vẫn chuyển được sang sổ
+        self.raw = {**raw, "CHI_PHI": self.df_cp, "HOA_HONG": self.df_hh, portfolio.ROOMS_SHEET: self.df_rooms}
+        if not self.so_hh_chuyen and not self.so_gd_chuyen: self.raw["HOP_DONG"], self.raw["GIA_HD"] = self.df_main, self.df_gd
+        fact_store.sync(self.df_main, self.df_hh, self.stages)
+        self.facts = fact_store.facts
+        self.archive = archive if archive is not None and archive.readable else None
+        self.cutoff = self.archive.cutoff(today) if self.archive else None
+        self._cold_facts = {}
+        self._cold_lock = threading.Lock()
+        self.version = "-".join(frame_version(d) for d in [self.df_main, self.df_cp, self.df_hh, self.df_gd, self.df_rooms])
+        if self.archive: self.version += f"-{self.archive.version}"
+        # Cùng phiên bản dữ liệu (tải lại định kỳ không có gì đổi) -> dùng lại các bảng dẫn xuất đã tính
+        same = previous is not None and previous.version == self.version and previous.today == today
+        self._shared = previous._shared if same else SharedFrames()
+        if same: self._cold_facts, self._cold_lock = previous._cold_facts, previous._cold_lock
+        # Bảng gom theo phòng hiển thị giá HĐ của giai đoạn đang hiệu lực hôm nay
+        rows = self.df_main.assign(**{'Giá HĐ': self.stages.period_price(self.df_main, today)}) if len(self.stages) else self.df_main
+        self.rooms = gop_du_lieu_phong(rows) if not rows.empty else rows
+        self.alerts = alert_frames(self.rooms, pd.Timestamp(today))
+        self.built_at = time.time()
+        self.build_seconds = time.perf_counter() - t0
+
+    def shared(self, key, fn):
+        # Bảng dẫn xuất tốn công (báo cáo, quét, sổ cọc...) tính một lần cho phiên bản này
+        return self._shared.get(key, fn)
+
+    def range_key(self, start):
+        # Khóa phần dữ liệu mà khoảng từ start cần: None = chỉ mảnh nóng, năm = kèm mảnh lạnh từ năm đó
+        return pd.Timestamp(start).year if self._needs_archive(start) else None
+
+    def _needs_archive(self, start):
+        return self.cutoff is not None and bool(self.archive.years) and pd.Timestamp(start) < self.cutoff
+
+    def _cold_rows(self, start):
+        cold = self.archive.rows_since(start)
+        if cold.empty or self.df_main.empty: return cold
+        # Dòng vừa chuyển mà vẫn còn ở mảnh nóng (lưu từ bản cũ) chỉ tính một lần
+        return cold[~quality.row_hashes(cold).isin(set(quality.row_hashes(self.df_main))).to_numpy()]
+
+    def rows_since(self, start):
+        # Dòng HOP_DONG có thể chạm tới khoảng từ ngày start trở đi (mảnh nóng + mảnh lạnh cần thiết)
+        if not self._needs_archive(start): return self.df_main
+        cold = self._cold_rows(start)
+        if cold.empty: return self.df_main
+        return pd.concat([self.df_main, cold], ignore_index=True)
+
+    def facts_since(self, start):
+        if not self._needs_archive(start): return self.facts
+        key = pd.Timestamp(start).year
+        with self._cold_lock:
+            if key not in self._cold_facts:
+                cold = self._cold_rows(start)
+                # Hoa hồng của phòng đã có ở mảnh nóng được tính ở đó; phần còn lại đi theo mảnh lạnh
+                hh = self.df_hh
+                if not hh.empty and not self.df_main.empty:
+                    hh = hh[~facts.rows_in_rooms(hh, self.df_main)]
+                self._cold_facts[key] = facts.merge_facts(facts.build_facts(cold, hh, self.stages), self.facts) if not cold.empty else self.facts
+            return self._cold_facts[key]
+
+    def month(self, year, month):
+        f = self.facts_since(pd.Timestamp(year, month, 1))
+        return f[f['Tháng'] == pd.Timestamp(year, month, 1)]
+
+    def year(self, year):
+        f = self.facts_since(pd.Timestamp(year, 1, 1))
+        return f[f['Tháng'].dt.year == year] if not f.empty else f
+
+
+class RecomputeWorker:
+    def __init__(self, fetch, fact_store, tabs=TABS, refresh_seconds=REFRESH_SECONDS,
+                 max_fetch_workers=storage.FETCH_CONCURRENCY, archive=None):
+        # fetch(tab) -> DataFrame thô của một worksheet; archive: kho lạnh của HOP_DONG (tùy chọn)
+        self._fetch = fetch
+        self._archive = archive
+        self._max_fetch_workers = max_fetch_workers
+        self._fact_store = fact_store
+        self._tabs = list(tabs)
+        self._refresh_seconds = refresh_seconds
+        self._queue = queue.Queue()
+        self._cond = threading.Condition()
+        self._snapshot = None
+        self._first_ticket = None
+        self._submitted = 0
+        self._applied = 0
+        self.last_error = None
+        self.archive_error = None     # lỗi của lần chuyển kho lạnh gần nhất (None = ổn / chưa chạy)
+        threading.Thread(target=self._run, daemon=True, name="mt60-recompute").start()
+
+    # --- phía phiên ---
+    def _submit(self, event):
+        with self._cond:
+            self._submitted += 1
+            ticket = self._submitted
+        self._queue.put((ticket, event))
+        return ticket
+
+    def submit_write(self, tab_name, df):
+        return self._submit(('write', tab_name, values_frame(df)))
+
+    def submit_reload(self):
+        return self._submit(('reload',))
+
+    def wait(self, ticket, timeout=None):
+        # True khi Snapshot đã gồm sự kiện `ticket` (hoặc sự kiện đó lỗi - xem last_error)
+        with self._cond:
+            return self._cond.wait_for(lambda: self._applied >= ticket, timeout)
+
+    def pending(self):
+        with self._cond:
+            return self._applied < self._submitted
+
+    def loading(self):
+        # Lần tải đầu tiên của tiến trình đang chạy (chưa có Snapshot nào)
+        return self._snapshot is None and self._first_ticket is not None and self.pending()
+
+    def current(self, timeout=None):
+        # Snapshot mới nhất; lần đầu tiên trong tiến trình thì gửi lệnh tải và chờ tối đa timeout
+        # (None = chờ tới khi xong). Hết hạn mà chưa xong -> None, xem loading()
+        snap = self._snapshot
+        if snap is None:
+            with self._cond:
+                # Chưa tải, hoặc lần tải trước lỗi (đã xử lý mà vẫn chưa có Snapshot) -> tải (lại)
+                if self._snapshot is None and (self._first_ticket is None or self._applied >= self._first_ticket):
+                    self._first_ticket = self.submit_reload()
+            self.wait(self._first_ticket, timeout)
+            snap = self._snapshot
+        elif snap.today != date.today() and not self.pending():
+            self._submit(('rebuild',))     # qua ngày mới -> tính lại nhóm cảnh báo
+        return snap
+
+    # --- luồng nền ---
+    def _drain(self, timeout):
+        # Lấy một sự kiện (chờ tối đa timeout) rồi gom hết các sự kiện đang chờ
+        try:
+            events = [self._queue.get(timeout=timeout)]
+        except queue.Empty:
+            return []
+        while True:
+            try: events.append(self._queue.get_nowait())
+            except queue.Empty: return events
+
+    def _load_all(self, prev):
+        # Đọc mọi sheet song song; sheet đọc lỗi (chưa tạo, mất mạng...) giữ bản đã có, chưa có thì là bảng rỗng
+        results, seconds = storage.fetch_all(self._fetch, self._tabs, self._max_fetch_workers)
+        raw = {tab: prev.get(tab, pd.DataFrame()) if isinstance(r, Exception) else r for tab, r in results.items()}
+        # Sheet đang có dữ liệu mà đọc ra trống: có thể đọc trúng lúc đang ghi -> đọc lại sau một nhịp, vẫn trống mới tin
+        for tab in [t for t, df in raw.items() if df.empty and not prev.get(t, pd.DataFrame()).empty]:
+            time.sleep(revisions.EMPTY_RETRY_WAIT)
+            try: raw[tab] = self._fetch(tab)
+            except Exception: raw[tab] = prev[tab]
+        return raw, seconds
+
+    def _archive_closed(self, raw):
+        # Chuyển dòng đã đóng lâu sang kho lạnh; lỗi ở bước này không chặn việc công bố dữ liệu
+        # nhưng được giữ lại ở archive_error để hiện trên trang (lần chuyển thành công sau đó xóa lỗi)
+        if self._archive is None: return
+        try:
+            self._archive.refresh_names()
+            raw["HOP_DONG"], _ = self._archive.archive_closed(raw.get("HOP_DONG", pd.DataFrame()), date.today())
+            self.archive_error = None
+        except Exception as e:
+            self.archive_error = e
+
+    def _run(self):
+        while True:
+            events = self._drain(self._refresh_seconds)
+            if not events:
+                if self._snapshot is None: continue
+                events = [(None, ('reload',))]
+            try:
+                base = self._snapshot
+                raw = dict(base.raw) if base is not None else {}
+                seconds = base.fetch_seconds if base is not None else {}
+                if base is None or any(e[0] == 'reload' for _, e in events):
+                    raw, seconds = self._load_all(raw)
+                    # Không chuyển kho khi đợt này có lần ghi (bản vừa tải đã cũ)
+                    if not any(e[0] == 'write' for _, e in events): self._archive_closed(raw)
+                # Ghi sau cùng của mỗi sheet thắng, đè lên dữ liệu vừa tải
+                for _, e in events:
+                    if e[0] == 'write': raw[e[1]] = e[2]
+                seq = base.seq + 1 if base is not None else 1
+                snap = Snapshot(seq, raw, self._fact_store, date.today(), seconds, self._archive, base)
+                self.last_error = None
+            except Exception as e:
+                snap = self._snapshot
+                self.last_error = e
+            tickets = [t for t, _ in events if t is not None]
+            with self._cond:
+                self._snapshot = snap
+                if tickets: self._applied = max(self._applied, max(tickets))
+                self._cond.notify_all()
@@ -0,0 +1,248 @@
+import time
+
+import pandas as pd
+
+import journal
+import storage
+from core import SHEET_ROW, frame_version, normalize_chi_phi, normalize_gia_hd, normalize_hoa_hong, normalize_hop_dong, normalize_toa_nha
+
+# ==============================================================================
+# NHIỀU NGƯỜI CÙNG LƯU (KIỂM SOÁT ĐỒNG THỜI LẠC QUAN)
+# - Mỗi lần lưu ghi đè cả sheet từ bản đang xem -> hai người lưu cách nhau vài giây thì lần sau xóa mất lần trước
+# - Phiên bản sheet = dấu vân tay nội dung lúc đọc (Snapshot.sheet_versions). Lưu = ghi có điều kiện
+#   "kho vẫn đúng phiên bản tôi đã dựa vào" (StorageBackend.update_if_version); không có khóa chung bắt người khác chờ
+# - Phiên bản dòng = mã dòng theo nội dung như nhật ký (journal.row_ids): sửa một ô -> dòng mang mã mới
+# - Kho đã đổi -> gộp ba bên (bản gốc đang xem / bản của tôi / bản trên kho):
+#     dòng chỉ một bên đổi -> lấy bên đó (hai người sửa hai dòng khác nhau -> giữ cả hai)
+#     cùng dòng gốc bị hai bên đổi khác nhau -> xung đột: giữ bản trên kho, đưa hai bản cho người dùng chọn
+#   Ghi có điều kiện vẫn trượt (có người vừa ghi tiếp) -> đọc lại, gộp lại, thử tiếp tới hết SAVE_BUDGET_SECONDS:
+#   lần nào cũng có người ghi được nên mỗi lượt là một bước tiến, không giới hạn số lượt
+# - Phiên bản tính thẳng trên giá trị ô (không numericise từng ô) -> so trong lúc giữ khóa ghi rất nhanh;
+#   bản gốc / bản của tôi chỉ băm dòng một lần cho cả lần lưu, bản trên kho nhớ mã dòng giữa các lượt
+# - Bản trên kho trống trong khi bản gốc có dữ liệu = đọc trúng lúc sheet đang được ghi (lỗi tạm thời):
+#   chờ rồi đọc lại, không bao giờ coi là người khác đã xóa hết dòng
+# ==============================================================================
+
+SAVE_BUDGET_SECONDS = 20    # thời gian tối đa cho một lần lưu (mọi lượt đọc lại + gộp)
+EMPTY_RETRY_WAIT = 0.3      # bản trên kho đọc ra trống bất thường -> chờ chừng này rồi đọc lại
+EMPTY_RETRIES = 3           # trống liên tiếp chừng này lần thì coi là sheet trống thật
+VERSION_ATTR = "sheet_version"   # DataFrame.attrs: phiên bản của giá trị sheet mà bảng được đọc ra
+
+# Chuẩn hóa bản trên kho giống Snapshot để so cùng dạng với bản gốc (sheet=None: không ghi nhận ô ngày lỗi)
+NORMALIZERS = {
+    "HOP_DONG": lambda df: normalize_hop_dong(df, sheet=None),
+    "CHI_PHI": lambda df: normalize_chi_phi(df, sheet=None),
+    "HOA_HONG": lambda df: normalize_hoa_hong(df, sheet=None),
+    "GIA_HD": lambda df: normalize_gia_hd(df, sheet=None),
+    "TOA_NHA": normalize_toa_nha,
+}
+
+
+def values_version(values):
+    # Phiên bản của giá trị sheet (dòng đầu là tiêu đề): băm chuỗi từng ô, dòng ngắn coi như ô trống ở cuối
+    if len(values) < 2: return frame_version(pd.DataFrame())
+    header = [str(h) for h in values[0]]
+    w = len(header)
+    rows = [r if len(r) == w else list(r[:w]) + [""] * (w - len(r)) for r in values[1:]]
+    return frame_version(pd.DataFrame(rows, columns=header, dtype=object).astype(str))
+
+
+def sheet_version(df):
+    # Bảng đọc qua frame_of -> phiên bản của đúng giá trị đã đọc; bảng khác -> phiên bản của giá trị sẽ ghi ra
+    if df is None: return frame_version(pd.DataFrame())
+    if VERSION_ATTR in df.attrs: return df.attrs[VERSION_ATTR]
+    return values_version(storage.frame_to_values(df)) if not df.empty else frame_version(pd.DataFrame())
+
+
+def _records_frame(values):
+    records = storage.values_to_records(values)
+    return pd.DataFrame(records) if records else pd.DataFrame()
+
+
+def frame_of(values):
+    # Giá trị sheet -> bảng như get_all_records, kèm phiên bản của chính giá trị đó (Snapshot ghi có điều kiện theo nó)
+    df = _records_frame(values)
+    df.attrs[VERSION_ATTR] = values_version(values)
+    return df
+
+
+def _rows(values, header):
+    # Dòng dạng dict (bỏ ô trống), chỉ giữ các cột của bản sắp ghi
+    keep = set(header)
+    _, rows = journal.sheet_rows(values)
+    return [{k: v for k, v in r.items() if k in keep} for r in rows]
+
+
+def _side(values, header, cache=None):
+    # (dòng, mã dòng) của một bên; cache: dòng (tuple ô) -> (dict, hash) nhớ giữa các lượt gộp
+    if cache is None:
+        rows = _rows(values, header)
+        return rows, journal.row_ids(rows)
+    src = [str(h).strip() for h in values[0]] if values else []
+    keep = set(header)
+    rows, ids, seen = [], [], {}
+    for raw in values[1:]:
+        key = tuple(raw)
+        hit = cache.get(key)
+        if hit is None:
+            r = {h: str(v) for h, v in zip(src, raw) if h and h in keep and str(v) != ""}
+            hit = cache[key] = (r, journal.row_hash(r))
+        r, h = hit
+        k = seen.get(h, 0)
+        seen[h] = k + 1
+        rows.append(r)
+        ids.append(f"{h}-{k}")
+    return rows, ids
+
+
+def _content(pairs):
+    # Nội dung (không kèm số lần lặp) của các dòng -> so hai bên có đổi giống nhau không
+    return sorted(i.rsplit("-", 1)[0] for i, _ in pairs)
+
+
+def _by_room(pairs):
+    out = {}
+    for i, r in pairs: out.setdefault(journal.room_of(r), []).append((i, r))
+    return out
+
+
+def merge(base_values, mine_values, theirs_values, sheet=""):
+    # Gộp ba bên trên giá trị sheet -> (giá trị sau gộp, [xung đột]). Cột theo bản của tôi;
+    # dòng tôi thêm / sửa nằm ở chỗ dòng cùng phòng bị thay, không có thì nối cuối
+    header = [str(h).strip() for h in mine_values[0]]
+    return _merge(header, _side(base_values, header), _side(mine_values, header), _side(theirs_values, header), sheet)
+
+
+def _merge(header, base_side, mine_side, theirs_side, sheet):
+    (base, b_ids), (mine, m_ids), (theirs, t_ids) = base_side, mine_side, theirs_side
+    b_set, m_set, t_set = set(b_ids), set(m_ids), set(t_ids)
+    base_by_id = dict(zip(b_ids, base))
+
+    my_del = {i for i in b_ids if i not in m_set}
+    their_del = {i for i in b_ids if i not in t_set}
+    my_add = _by_room((i, r) for i, r in zip(m_ids, mine) if i not in b_set)
+    their_add = _by_room((i, r) for i, r in zip(t_ids, theirs) if i not in b_set)
+    my_del_room = _by_room((i, base_by_id[i]) for i in b_ids if i in my_del)
+    their_del_room = _by_room((i, base_by_id[i]) for i in b_ids if i in their_del)
+
+    conflicts, held = [], set()
+    for room, dels in my_del_room.items():
+        both = {i for i, _ in dels} & {i for i, _ in their_del_room.get(room, [])}
+        if not both or _content(my_add.get(room, [])) == _content(their_add.get(room, [])): continue
+        held.add(room)
+        still = [r for i, r in dels if i not in their_del]
+        conflicts.append({
+            "Sheet": sheet, "Phòng": room, "Cột": header,
+            "Gốc": [base_by_id[i] for i in b_ids if i in both],
+            "Của tôi": [r for _, r in my_add.get(room, [])],
+            "Người khác": [r for _, r in their_add.get(room, [])],
+            # Chọn bản của tôi: bỏ các dòng này khỏi bản trên kho rồi thêm "Của tôi"
+            "Bỏ": [r for _, r in their_add.get(room, [])] + still,
+        })
+
+    drop = {i for i in my_del - their_del if journal.room_of(base_by_id[i]) not in held}
+    pending = {room: [r for i, r in pairs if i not in t_set] for room, pairs in my_add.items() if room not in held}
+    out = []
+    for i, r in zip(t_ids, theirs):
+        if i in drop:
+            out += pending.pop(journal.room_of(r), [])
+            continue
+        out.append(r)
+    for rest in pending.values(): out += rest
+    return [header] + [[r.get(h, "") for h in header] for r in out], conflicts
+
+
+def keep_mine(values, conflict):
+    # Giá trị sheet sau khi chọn bản của tôi cho một xung đột (trên bản đang có)
+    header = [str(h).strip() for h in values[0]] if values else list(conflict["Cột"])
+    rows = _rows(values, header) if values else []
+    remove = {}
+    for i in journal.row_ids(conflict["Bỏ"]):
+        h = i.rsplit("-", 1)[0]
+        remove[h] = remove.get(h, 0) + 1
+    out, placed = [], False
+    for i, r in zip(journal.row_ids(rows), rows):
+        h = i.rsplit("-", 1)[0]
+        if remove.get(h, 0) > 0:
+            remove[h] -= 1
+            if not placed: out += conflict["Của tôi"]; placed = True
+            continue
+        out.append(r)
+    if not placed: out += conflict["Của tôi"]
+    return [header] + [[r.get(h, "") for h in header] for r in out]
+
+
+def conflict_frames(conflict):
+    # (bản của tôi, bản người khác) dạng bảng để hiển thị
+    cols = conflict["Cột"]
+    return pd.DataFrame(conflict["Của tôi"], columns=cols).fillna(""), pd.DataFrame(conflict["Người khác"], columns=cols).fillna("")
+
+
+def _theirs(tab_name, current, normalize):
+    # Bản trên kho về cùng dạng với bản gốc đang xem (đã chuẩn hóa)
+    df = _records_frame(current)
+    fn = NORMALIZERS.get(tab_name) if normalize else None
+    if fn is not None: df = fn(df)
+    return storage.frame_to_values(df)
+
+
+def _transient_empty(current, expect_rows, empties):
+    # Kho đọc ra trống (hoặc chỉ còn tiêu đề) trong khi lẽ ra phải có dòng: thường là đọc trúng lúc sheet đang được ghi.
+    # Chờ rồi đọc lại; trống liên tiếp EMPTY_RETRIES lần mới tin là sheet trống thật
+    if len(current) >= 2 or not expect_rows or empties >= EMPTY_RETRIES: return False
+    time.sleep(EMPTY_RETRY_WAIT)
+    return True
+
+
+def save(backend, tab_name, df, base, base_version, normalize=True, budget=SAVE_BUDGET_SECONDS):
+    # Ghi df nếu kho vẫn là bản base (phiên bản base_version); kho đã đổi -> gộp với bản trên kho rồi ghi.
+    # Trả về (bảng đã ghi, bảng trên kho ngay trước lần ghi, [xung đột], có gộp không); hết giờ -> bảng đã ghi None
+    # Số dòng sheet lúc đọc chỉ dùng trong bộ nhớ, không ghi ra sheet
+    df = df.drop(columns=[SHEET_ROW], errors='ignore')
+    mine_values = storage.frame_to_values(df)
+    base_values = storage.frame_to_values(base if base is not None else df.iloc[0:0])
+    header = [str(h).strip() for h in mine_values[0]]
+    expected, out_values, before, conflicts = base_version, mine_values, base, []
+    base_side = mine_side = None
+    theirs_cache, seen, empties = {}, {}, 0
+    deadline = time.monotonic() + budget
+
+    def _version(values):
+        # Nhớ phiên bản vừa thấy trên kho -> lần thử sau ghi có điều kiện theo đó, không tính lại
+        seen["v"] = values_version(values)
+        return seen["v"]
+
+    while True:
+        ok, current = backend.update_if_version(tab_name, out_values, expected, _version)
+        if ok:
+            merged = expected != base_version
+            out = pd.DataFrame(out_values[1:], columns=out_values[0]) if merged else df
+            return out, before, conflicts, merged
+        if time.monotonic() >= deadline: return None, before, conflicts, True
+        if _transient_empty(current, len(base_values) >= 2, empties):
+            empties += 1
+            continue
+        empties = 0
+        expected = seen["v"]
+        theirs = _theirs(tab_name, current, normalize)
+        if base_side is None: base_side, mine_side = _side(base_values, header), _side(mine_values, header)
+        out_values, conflicts = _merge(header, base_side, mine_side, _side(theirs, header, theirs_cache), tab_name)
+        before = pd.DataFrame(theirs[1:], columns=theirs[0])
+
+
+def resolve(backend, conflict, normalize=True, budget=SAVE_BUDGET_SECONDS):
+    # Chọn bản của tôi cho một xung đột: áp lên bản đang có trên kho, ghi có điều kiện theo chính bản đó.
+    # Trả về (bảng đã ghi, bảng trên kho ngay trước lần ghi); hết giờ -> (None, None)
+    tab_name = conflict["Sheet"]
+    deadline, empties = time.monotonic() + budget, 0
+    while time.monotonic() < deadline:
+        current = backend.values_or_empty(tab_name)
+        # Xung đột có dòng đang nằm trên kho mà kho đọc ra trống -> đọc trúng lúc đang ghi, đọc lại
+        if _transient_empty(current, bool(conflict["Gốc"] or conflict["Người khác"]), empties):
+            empties += 1
+            continue
+        theirs = _theirs(tab_name, current, normalize)
+        out_values = keep_mine(theirs, conflict)
+        ok, _ = backend.update_if_version(tab_name, out_values, values_version(current), values_version)
+        if ok: return pd.DataFrame(out_values[1:], columns=out_values[0]), pd.DataFrame(theirs[1:], columns=theirs[0])
+    return None, None
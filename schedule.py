@@ -0,0 +1,234 @@
+import numpy as np
+import pandas as pd
+
+from core import COLUMNS_GD, clean_money, contract_moves
+
+# ==============================================================================
+# GIÁ HĐ CHỦ THEO GIAI ĐOẠN (SHEET GIA_HD)
+# - HOP_DONG giữ một dòng đầu HĐ: Ngày ký = ngày bắt đầu, Ngày hết HĐ = hết giai đoạn cuối,
+#   Giá HĐ = giá giai đoạn 1. HĐ được nhận diện bằng (Toà, Mã căn, Ngày ký) của dòng đó
+# - GIA_HD: mỗi dòng = (HĐ, Từ ngày, Đến ngày, Giá HĐ), bao nhiêu giai đoạn cũng được;
+#   HĐ một giá không có dòng nào ở đây
+# - Giai đoạn bắt đầu muộn hơn đè lên giai đoạn trước (như occupancy.py): giai đoạn có hiệu lực
+#   từ Từ ngày tới min(Đến ngày, Từ ngày của giai đoạn sau - 1)
+# - StageIndex xếp mọi giai đoạn thành một mảng khóa (mã HĐ, Từ ngày) đã sắp xếp -> tra giá tại
+#   một ngày cho cả cột bằng một lần np.searchsorted (bisect)
+# - Dòng GĐ2/GĐ3 kiểu cũ (bản sao dòng HĐ, bỏ trống phần khách) được tách sang sổ này trong bộ nhớ;
+#   lần lưu HOP_DONG kế tiếp ghi luôn sheet GIA_HD
+# - Sửa Toà / Mã căn / Ngày ký của HĐ (không còn dòng nào mang khóa cũ) -> các giai đoạn đổi khóa theo,
+#   GĐ1 (Từ ngày = Ngày ký cũ) dời về Ngày ký mới; xóa hết dòng của HĐ -> xóa các giai đoạn của HĐ đó
+# ==============================================================================
+
+CONTRACT_KEYS = ["Toà", "Mã căn", "Ngày ký"]
+INPUT_COLUMNS = ["Từ ngày", "Đến ngày", "Giá HĐ"]
+TENANT_COLUMNS = ["Tên khách thuê", "Ngày in", "Ngày out"]
+ZERO_COLUMNS = ["Giá", "KH cọc", "KH thanh toán", "TT cho chủ nhà", "Cọc cho chủ nhà"]
+
+_DAY0 = np.datetime64('1900-01-01', 'D')
+_SPAN = 1 << 17    # số ngày tối đa của một mã HĐ trong khóa gộp (~358 năm)
+
+
+def empty_schedule():
+    return pd.DataFrame(columns=COLUMNS_GD)
+
+
+def empty_input():
+    # Bảng nhập giai đoạn trên form (sau GĐ1)
+    return pd.DataFrame({"Từ ngày": pd.Series(dtype='datetime64[ns]'), "Đến ngày": pd.Series(dtype='datetime64[ns]'),
+                         "Giá HĐ": pd.Series(dtype=float)})
+
+
+def _contract_keys(df):
+    out = df.reindex(columns=CONTRACT_KEYS).copy()
+    out['Toà'] = out['Toà'].fillna('').astype(str).str.strip()
+    out['Mã căn'] = out['Mã căn'].fillna('').astype(str)
+    out['Ngày ký'] = pd.to_datetime(out['Ngày ký'], errors='coerce')
+    return out
+
+
+def _days(values):
+    return pd.to_datetime(pd.Series(values)).to_numpy(dtype='datetime64[D]')
+
+
+def _is_stage_row(df):
+    # Dòng GĐ kiểu cũ: có khoảng + giá HĐ chủ, phần khách trống, không có khoản thanh toán nào
+    t = df.reindex(columns=TENANT_COLUMNS)
+    blank = t['Tên khách thuê'].fillna('').astype(str).str.strip().eq('')
+    for c in ['Ngày in', 'Ngày out']: blank &= pd.to_datetime(t[c], errors='coerce').isna()
+    money = df.reindex(columns=ZERO_COLUMNS).apply(pd.to_numeric, errors='coerce').fillna(0)
+    return (blank & money.eq(0).all(axis=1) & (pd.to_numeric(df['Giá HĐ'], errors='coerce').fillna(0) > 0)).to_numpy()
+
+
+def split_legacy(df_main, df_gd):
+    # Dòng GĐ kiểu cũ -> sổ giai đoạn. Một dòng là giai đoạn sau của HĐ đứng trước nó (cùng phòng, cùng
+    # chủ nhà) khi bắt đầu muộn hơn và không hở ngày với các HĐ trước. Dòng đầu HĐ (và các dòng khách cùng HĐ)
+    # được kéo Ngày hết HĐ tới hết giai đoạn cuối. Dòng đã là đầu HĐ trong sổ không bị gắn; giai đoạn đã có
+    # trong sổ (cùng HĐ, cùng Từ ngày) thì sổ được ưu tiên.
+    # Trả về (HOP_DONG gọn, sổ đã gộp, số dòng chuyển)
+    need = ['Toà', 'Mã căn', 'Ngày ký', 'Ngày hết HĐ', 'Giá HĐ']
+    if df_main.empty or not all(c in df_main.columns for c in need): return df_main, df_gd, 0
+    df = df_main.reset_index(drop=True)
+    keys = _contract_keys(df)
+    end = pd.to_datetime(df['Ngày hết HĐ'], errors='coerce')
+    own = (keys['Toà'] != '').to_numpy() & keys['Ngày ký'].notna().to_numpy() & end.notna().to_numpy()
+    cand = own & _is_stage_row(df)
+    if cand.any() and not df_gd.empty:
+        cand &= ~pd.MultiIndex.from_frame(keys).isin(pd.MultiIndex.from_frame(_contract_keys(df_gd)))
+    if not cand.any(): return df_main, df_gd, 0
+
+    # Xếp theo phòng, ngày bắt đầu; cùng ngày thì dòng thường đứng trước dòng giai đoạn
+    sub = keys[own].assign(_end=end[own], _cand=cand[own], _chu=df.loc[own, 'Chủ nhà - sale'].fillna('').astype(str).str.strip()
+                           if 'Chủ nhà - sale' in df.columns else '')
+    sub = sub.sort_values(['Toà', 'Mã căn', 'Ngày ký', '_cand'], kind='stable')
+    room = sub['Toà'] + '\x1f' + sub['Mã căn']
+    same_room = room.eq(room.shift()).to_numpy()
+    reach = sub.groupby(room.to_numpy(), sort=False)['_end'].cummax().groupby(room.to_numpy(), sort=False).shift()
+    attach = (sub['_cand'].to_numpy() & same_room & sub['_chu'].eq(sub['_chu'].shift()).to_numpy()
+              & (sub['Ngày ký'] > sub['Ngày ký'].shift()).to_numpy()
+              & (sub['Ngày ký'] <= reach + pd.Timedelta(days=1)).fillna(False).to_numpy())
+    if not attach.any(): return df_main, df_gd, 0
+
+    # Mỗi dòng không gắn mở một HĐ; dòng gắn thuộc HĐ mở gần nhất trước nó
+    contract = np.cumsum(~attach)
+    head_of = pd.Series(sub.index[~attach], index=contract[~attach])
+    price = pd.to_numeric(df['Giá HĐ'], errors='coerce').fillna(0)
+    heads = head_of.loc[np.unique(contract[attach])].to_numpy()
+    stage_rows = sub.index[attach]
+    stage_heads = head_of.loc[contract[attach]].to_numpy()
+    # Giai đoạn 1 = khoảng của dòng đầu HĐ, các giai đoạn sau = các dòng được gắn
+    rows = np.r_[heads, stage_rows]
+    migrated = pd.DataFrame({
+        'Toà': keys['Toà'].to_numpy()[rows], 'Mã căn': keys['Mã căn'].to_numpy()[rows],
+        'Ngày ký': keys['Ngày ký'].to_numpy()[np.r_[heads, stage_heads]],
+        'Từ ngày': keys['Ngày ký'].to_numpy()[rows], 'Đến ngày': end.to_numpy()[rows],
+        'Giá HĐ': price.to_numpy()[rows],
+    }).sort_values(CONTRACT_KEYS + ['Từ ngày'], kind='stable')
+    hop = pd.MultiIndex.from_frame(migrated[CONTRACT_KEYS]).unique()
+    if not df_gd.empty:
+        da_co = pd.MultiIndex.from_frame(_contract_keys(df_gd).assign(**{'Từ ngày': pd.to_datetime(df_gd['Từ ngày'])}))
+        migrated = migrated[~pd.MultiIndex.from_frame(migrated[CONTRACT_KEYS + ['Từ ngày']]).isin(da_co)]
+    parts = [p for p in [df_gd, migrated] if not p.empty]
+    merged = pd.concat(parts, ignore_index=True)[COLUMNS_GD] if parts else empty_schedule()
+
+    # Bỏ dòng giai đoạn cũ, kéo Ngày hết HĐ của mọi dòng cùng HĐ tới hết giai đoạn cuối
+    out = df.drop(index=stage_rows)
+    het = merged.groupby(CONTRACT_KEYS)['Đến ngày'].max().reindex(hop)
+    moi = het.reindex(pd.MultiIndex.from_frame(_contract_keys(out))).to_numpy()
+    cu = pd.to_datetime(out['Ngày hết HĐ'], errors='coerce').to_numpy()
+    out['Ngày hết HĐ'] = np.where(pd.notna(moi) & (pd.isna(cu) | (moi > cu)), moi, cu)
+    return out.reset_index(drop=True), merged, len(stage_rows)
+
+
+def entries_for_row(row, df_input):
+    # Bảng nhập giai đoạn của một form -> (dòng HĐ đã kéo Ngày hết HĐ, các dòng sổ GIA_HD của HĐ đó).
+    # Không có giai đoạn hợp lệ nào -> HĐ một giá, sổ không đổi
+    if df_input is None or df_input.empty: return row, empty_schedule()
+    df = df_input.reindex(columns=INPUT_COLUMNS).copy()
+    for c in ["Từ ngày", "Đến ngày"]: df[c] = pd.to_datetime(df[c], errors='coerce')
+    df["Giá HĐ"] = df["Giá HĐ"].apply(clean_money)
+    ky, het = pd.to_datetime(row["Ngày ký"]), pd.to_datetime(row["Ngày hết HĐ"])
+    df = df.dropna(subset=["Từ ngày", "Đến ngày"])
+    df = df[(df["Từ ngày"] <= df["Đến ngày"]) & (df["Từ ngày"] > ky) & (df["Giá HĐ"] > 0)]
+    if df.empty or pd.isna(ky): return row, empty_schedule()
+    stages = pd.concat([pd.DataFrame({"Từ ngày": [ky], "Đến ngày": [het], "Giá HĐ": [float(row.get("Giá HĐ", 0) or 0)]}), df],
+                       ignore_index=True).sort_values("Từ ngày", kind='stable')
+    key = _contract_keys(pd.DataFrame([row])).iloc[0]
+    out = pd.DataFrame({c: [key[c]] * len(stages) for c in CONTRACT_KEYS})
+    for c in INPUT_COLUMNS: out[c] = stages[c].to_numpy()
+    row = {**row, "Ngày hết HĐ": max(het, df["Đến ngày"].max()) if pd.notna(het) else df["Đến ngày"].max()}
+    return row, out[COLUMNS_GD]
+
+
+def follow_contracts(df_gd, old_main, new_main):
+    # Sổ sau khi HOP_DONG đổi từ old_main sang new_main. Trả về (sổ, số dòng sổ đổi khóa / bị xóa)
+    if df_gd.empty: return df_gd, 0
+    moves = contract_moves(old_main, new_main, _contract_keys)
+    if not moves: return df_gd, 0
+    keys = list(_contract_keys(df_gd).itertuples(index=False, name=None))
+    hit = np.array([k in moves for k in keys])
+    if not hit.any(): return df_gd, 0
+    target = [moves.get(k) for k in keys]
+    doi = np.flatnonzero(hit & np.array([t is not None for t in target]))
+    out = df_gd.copy()
+    if len(doi):
+        idx = out.index[doi]
+        cu_ky = pd.to_datetime(out.loc[idx, 'Ngày ký'], errors='coerce')
+        for j, c in enumerate(CONTRACT_KEYS): out.loc[idx, c] = [target[i][j] for i in doi]
+        # GĐ1 bắt đầu đúng Ngày ký cũ -> đi theo Ngày ký mới
+        moi_ky = pd.to_datetime(out.loc[idx, 'Ngày ký'], errors='coerce')
+        gd1 = (pd.to_datetime(out.loc[idx, 'Từ ngày'], errors='coerce') == cu_ky) & moi_ky.notna()
+        out.loc[idx[gd1.to_numpy()], 'Từ ngày'] = moi_ky[gd1]
+    xoa = hit & np.array([t is None for t in target])
+    return out[~xoa].reset_index(drop=True), int(hit.sum())
+
+
+class StageIndex:
+    # Mọi giai đoạn của sổ, xếp theo (HĐ, Từ ngày); chỉ đọc, dùng chung mọi phiên như Snapshot
+    def __init__(self, df_gd=None):
+        gd = df_gd if df_gd is not None and not df_gd.empty else empty_schedule()
+        gd = gd.dropna(subset=["Ngày ký", "Từ ngày", "Đến ngày"])
+        gd = gd[gd["Từ ngày"] <= gd["Đến ngày"]]
+        gd = gd.sort_values(CONTRACT_KEYS + ["Từ ngày"], kind='stable')
+        gd = gd.drop_duplicates(subset=CONTRACT_KEYS + ["Từ ngày"], keep='last').reset_index(drop=True)
+        self.frame = gd[COLUMNS_GD]
+        keys = pd.MultiIndex.from_frame(_contract_keys(gd))
+        self.contracts = keys.unique()          # theo thứ tự đã sắp xếp -> mã HĐ tăng dần trong mảng
+        self._code = self.contracts.get_indexer(keys).astype(np.int64)
+        self._from = _days(gd["Từ ngày"])
+        # Hiệu lực tới min(Đến ngày, Từ ngày của giai đoạn sau - 1) trong cùng HĐ
+        to = _days(gd["Đến ngày"])
+        nxt = np.r_[self._from[1:], np.datetime64('NaT', 'D')] if len(gd) else to
+        same = np.r_[self._code[1:] == self._code[:-1], False] if len(gd) else np.zeros(0, dtype=bool)
+        self._to = np.where(same & (nxt - 1 < to), nxt - 1, to) if len(gd) else to
+        self._price = gd["Giá HĐ"].to_numpy(dtype=float)
+        self._key = self._code * _SPAN + (self._from - _DAY0).astype(np.int64)
+
+    def __len__(self):
+        return len(self._price)
+
+    def codes(self, df):
+        # Mã HĐ của từng dòng (-1 = HĐ một giá)
+        if not len(self) or df.empty: return np.full(len(df), -1, dtype=np.int64)
+        return self.contracts.get_indexer(pd.MultiIndex.from_frame(_contract_keys(df))).astype(np.int64)
+
+    def price_at(self, df, when):
+        # Giá giai đoạn có hiệu lực tại ngày when (cột / một ngày) của từng dòng; NaN = không có giai đoạn nào
+        code = self.codes(df)
+        out = np.full(len(df), np.nan)
+        if not len(self) or not (code >= 0).any(): return out
+        d = _days(when) if np.ndim(when) else np.full(len(df), np.datetime64(pd.Timestamp(when).date(), 'D'))
+        ok = (code >= 0) & ~np.isnat(d)
+        q = code * _SPAN + np.where(ok, (d - _DAY0).astype(np.int64), 0)
+        i = np.clip(np.searchsorted(self._key, q, side='right') - 1, 0, None)
+        ok &= (self._code[i] == code) & (d >= self._from[i]) & (d <= self._to[i])
+        out[ok] = self._price[i[ok]]
+        return out
+
+    def period_price(self, df, start, col_start='Ngày ký', col_price='Giá HĐ'):
+        # Giá HĐ của kỳ bắt đầu từ start: giai đoạn có hiệu lực ở ngày đầu tiên HĐ chạy trong kỳ;
+        # HĐ một giá giữ Giá HĐ của dòng
+        start = pd.Timestamp(start)
+        first_day = pd.to_datetime(df[col_start], errors='coerce').where(lambda s: s > start, start)
+        gia = self.price_at(df, first_day)
+        return pd.Series(np.where(np.isnan(gia), pd.to_numeric(df[col_price], errors='coerce').fillna(0), gia), index=df.index)
+
+    def expand(self, df, col_start='Ngày ký', col_end='Ngày hết HĐ', col_price='Giá HĐ'):
+        # Dòng có giai đoạn -> một dòng cho mỗi giai đoạn (khoảng + giá của giai đoạn), giữ nguyên index gốc
+        # để cộng ngược về dòng; dòng HĐ một giá giữ nguyên
+        code = self.codes(df)
+        if not (code >= 0).any(): return df
+        lo = np.searchsorted(self._code, code, side='left')
+        n = np.where(code >= 0, np.searchsorted(self._code, code, side='right') - lo, 0)
+        n_rows = np.where(n > 0, n, 1)
+        pos = np.repeat(np.arange(len(df)), n_rows)
+        stage = np.repeat(lo, n_rows) + (np.arange(n_rows.sum()) - np.repeat(np.cumsum(n_rows) - n_rows, n_rows))
+        has = np.repeat(n > 0, n_rows)
+        out = df.iloc[pos].copy()
+        idx = stage[has]
+        out[col_start] = pd.to_datetime(out[col_start])
+        out[col_end] = pd.to_datetime(out[col_end])
+        out.loc[has, col_start] = pd.to_datetime(self._from[idx])
+        out.loc[has, col_end] = pd.to_datetime(self._to[idx])
+        out[col_price] = pd.to_numeric(out[col_price], errors='coerce')
+        out.loc[has, col_price] = self._price[idx]
+        return out
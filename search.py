@@ -0,0 +1,174 @@
+import re
+import threading
+import unicodedata
+from bisect import bisect_left
+
+import pandas as pd
+
+# ==============================================================================
+# TRA CỨU NHANH PHÒNG / KHÁCH / CHỦ NHÀ
+# Chỉ mục ngược (token -> các phòng) trên Mã căn, Toà, Tên khách thuê, Chủ nhà - sale.
+# - Bỏ dấu tiếng Việt ("Nguyễn Đức" ~ "nguyen duc")
+# - Khớp tiền tố qua danh sách token đã sắp xếp + bisect
+# - Khớp gần đúng (sai 1 ký tự) qua chỉ mục "xóa 1 ký tự" kiểu SymSpell
+# - Cập nhật theo phiên bản dữ liệu: chỉ đánh chỉ mục lại những phòng có thay đổi
+# ==============================================================================
+
+ROOM_KEYS = ['Toà', 'Mã căn']
+FIELD_WEIGHTS = {'Mã căn': 3.0, 'Tên khách thuê': 2.0, 'Chủ nhà - sale': 2.0, 'Toà': 1.0}
+MATCH_EXACT, MATCH_PREFIX, MATCH_FUZZY = 1.0, 0.6, 0.3
+MIN_FUZZY_LEN = 3
+
+_TOKEN_RE = re.compile(r'[0-9a-z]+')
+
+
+def normalize_text(text):
+    text = unicodedata.normalize('NFD', str(text).lower().replace('đ', 'd'))
+    return ''.join(ch for ch in text if unicodedata.category(ch) != 'Mn')
+
+
+def normalize_column(col):
+    # Vector hóa cho cả cột: bỏ dấu bằng bảng tra theo giá trị duy nhất
+    col = col.fillna('').astype(str)
+    uniques = pd.unique(col)
+    mapping = {u: normalize_text(u) for u in uniques}
+    return col.map(mapping)
+
+
+def tokenize(text):
+    return _TOKEN_RE.findall(text)
+
+
+def _deletes(token):
+    return {token[:i] + token[i + 1:] for i in range(len(token))}
+
+
+class SearchIndex:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.version = None
+        self._postings = {}         # token -> {room: trọng số cao nhất của field chứa token}
+        self._room_tokens = {}      # room -> {token: trọng số}
+        self._room_sig = {}         # room -> chữ ký nội dung để biết phòng nào đổi
+        self._room_rows = {}        # room -> index các dòng trong df_main (lịch sử phòng)
+        self._sorted_tokens = []
+        self._delete_index = {}     # chuỗi bị xóa 1 ký tự -> {token}
+
+    # --- XÂY / CẬP NHẬT CHỈ MỤC ---
+    def _room_tokens_long(self, df):
+        # Bảng dài (phòng, token, trọng số) cho toàn bộ df - vector hóa, không lặp từng dòng
+        cols = [c for c in FIELD_WEIGHTS if c in df.columns]
+        room = df['Toà'].astype(str).str.strip() + '\x1f' + df['Mã căn'].astype(str)
+        parts = []
+        for c in cols:
+            part = pd.DataFrame({'room': room, 'token': normalize_column(df[c]).str.findall(_TOKEN_RE)})
+            part = part.explode('token').dropna(subset=['token'])
+            part['w'] = FIELD_WEIGHTS[c]
+            parts.append(part)
+        long = pd.concat(parts, ignore_index=True)
+        long = long.groupby(['room', 'token'], sort=False, as_index=False)['w'].max()
+        return room, long
+
+    def _room_documents(self, df):
+        room, long = self._room_tokens_long(df)
+        # Chữ ký mỗi phòng = tổng hash các cặp (token, trọng số) -> chỉ dựng dict cho phòng đã đổi
+        sig = pd.util.hash_pandas_object(long[['token', 'w']], index=False).groupby(long['room']).sum()
+        changed = [r for r, h in sig.items() if self._room_sig.get(self._split(r)) != h]
+        docs = {}
+        if changed:
+            sub = long[long['room'].isin(changed)]
+            for r, grp in sub.groupby('room', sort=False):
+                docs[self._split(r)] = dict(zip(grp['token'], grp['w']))
+        index = df.index.to_numpy()
+        rows = {self._split(r): index[pos] for r, pos in df.groupby(room.to_numpy(), sort=False).indices.items()}
+        return {self._split(r): int(h) for r, h in sig.items()}, docs, rows
+
+    @staticmethod
+    def _split(room):
+        return tuple(room.split('\x1f', 1))
+
+    def _remove_room(self, room):
+        for tok in self._room_tokens.pop(room, {}):
+            rooms = self._postings.get(tok)
+            if rooms is None: continue
+            rooms.pop(room, None)
+            if not rooms:
+                del self._postings[tok]
+                for d in _deletes(tok):
+                    toks = self._delete_index.get(d)
+                    if toks is not None:
+                        toks.discard(tok)
+                        if not toks: del self._delete_index[d]
+
+    def _add_room(self, room, tokens):
+        self._room_tokens[room] = tokens
+        for tok, w in tokens.items():
+            if tok not in self._postings:
+                self._postings[tok] = {}
+                for d in _deletes(tok):
+                    self._delete_index.setdefault(d, set()).add(tok)
+            self._postings[tok][room] = w
+
+    def update(self, df_main, version):
+        with self._lock:
+            if version == self.version: return 0
+            if df_main.empty or not all(c in df_main.columns for c in ROOM_KEYS):
+                sigs, docs, rows = {}, {}, {}
+            else:
+                sigs, docs, rows = self._room_documents(df_main)
+
+            removed = [r for r in self._room_tokens if r not in sigs]
+            for room in removed:
+                self._remove_room(room)
+                self._room_sig.pop(room, None)
+            for room, tokens in docs.items():
+                self._remove_room(room)
+                self._add_room(room, tokens)
+                self._room_sig[room] = sigs[room]
+            self._room_rows = rows
+            if removed or docs: self._sorted_tokens = sorted(self._postings)
+            self.version = version
+            return len(removed) + len(docs)
+
+    # --- TRA CỨU ---
+    def _match_token(self, q):
+        # Trả về {room: điểm} cho một token của câu hỏi
+        scores = {}
+
+        def add(tok, kind):
+            for room, w in self._postings.get(tok, {}).items():
+                scores[room] = max(scores.get(room, 0.0), w * kind)
+
+        i = bisect_left(self._sorted_tokens, q)
+        while i < len(self._sorted_tokens) and self._sorted_tokens[i].startswith(q):
+            tok = self._sorted_tokens[i]
+            add(tok, MATCH_EXACT if tok == q else MATCH_PREFIX)
+            i += 1
+
+        if len(q) >= MIN_FUZZY_LEN:
+            candidates = set(self._delete_index.get(q, ())) | ({q} & self._postings.keys())
+            for d in _deletes(q):
+                if d in self._postings: candidates.add(d)
+                candidates |= self._delete_index.get(d, set())
+            for tok in candidates - {q}:
+                add(tok, MATCH_FUZZY)
+        return scores
+
+    def search(self, query, limit=20):
+        q_tokens = tokenize(normalize_text(query))
+        if not q_tokens: return []
+        with self._lock:
+            per_token = [self._match_token(q) for q in q_tokens]
+            total = {}
+            for scores in per_token:
+                for room, s in scores.items():
+                    total[room] = total.get(room, 0.0) + s
+            # Ưu tiên phòng khớp đủ mọi từ khóa, sau đó theo điểm
+            n_hit = {room: sum(room in s for s in per_token) for room in total}
+            ranked = sorted(total, key=lambda r: (-n_hit[r], -total[r], r))
+            return [(room, round(total[room], 2), n_hit[room] == len(q_tokens)) for room in ranked[:limit]]
+
+    def room_history(self, df_main, room):
+        rows = self._room_rows.get(room)
+        if rows is None: return df_main.iloc[0:0]
+        return df_main.loc[rows]
@@ -0,0 +1,251 @@
+import html
+import io
+import math
+import multiprocessing
+import os
+import re
+import unicodedata
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from string import Template
+
+import pandas as pd
+
+import accrual
+import portfolio
+from core import fmt_date, fmt_vnd
+
+# ==============================================================================
+# BẢNG KÊ THÁNG CHO TỪNG CHỦ NHÀ / TỪNG KHÁCH THUÊ (HTML, IN RA PDF TỪ TRÌNH DUYỆT)
+# - Chủ nhà : các HĐ chủ còn hiệu lực trong tháng, Giá HĐ theo giai đoạn, tiền dồn tích theo ngày,
+#             TT / Cọc cho chủ nhà
+# - Khách   : các lượt thuê trong tháng (tiền thuê dồn tích, KH thanh toán, KH cọc)
+#             + phí điện / nước / dịch vụ trong CHI_PHI của phòng đó, trong thời gian khách ở
+# - Dữ liệu của mọi bảng kê được dựng một lần bằng phép tính trên cả bảng (không lặp từng người);
+#   phần dựng HTML chạy theo lô trên một process pool, mỗi tiến trình biên dịch mẫu một lần lúc import
+#   và dùng lại cho mọi bảng kê; lô nhỏ dựng ngay trong tiến trình hiện tại (khởi động tiến trình tốn hơn)
+# - Kết quả: một file zip gồm từng bảng kê + trang mục lục
+# ==============================================================================
+
+KIND_OWNER = "chu-nha"
+KIND_TENANT = "khach"
+KIND_LABELS = {KIND_OWNER: "Chủ nhà", KIND_TENANT: "Khách thuê"}
+
+PARALLEL_MIN = 40          # ít hơn chừng này bảng kê -> dựng ngay, không dùng process pool
+POOL_WORKERS = max(1, min(4, os.cpu_count() or 1))
+
+OWNER_COLUMNS = ["Toà", "Mã căn", "Ngày ký", "Ngày hết HĐ", "Giá HĐ", "Số ngày", "Tiền tháng", "TT cho chủ nhà", "Cọc cho chủ nhà"]
+TENANT_COLUMNS = ["Toà", "Mã căn", "Ngày in", "Ngày out", "Giá", "Số ngày", "Tiền thuê tháng", "KH thanh toán", "KH cọc"]
+CHARGE_COLUMNS = ["Ngày", "Mã căn", "Loại", "Chỉ số đồng hồ", "Tiền"]
+MONEY_COLUMNS = {"Giá HĐ", "Tiền tháng", "TT cho chủ nhà", "Cọc cho chủ nhà", "Giá", "Tiền thuê tháng", "KH thanh toán", "KH cọc", "Tiền"}
+
+_PAGE = Template("""<!DOCTYPE html>
+<html lang="vi"><head><meta charset="utf-8"><title>$title</title>
+<style>
+body{font-family:Arial,Helvetica,sans-serif;margin:32px;color:#222;font-size:13px}
+h1{font-size:20px;margin:0 0 4px}h2{font-size:15px;margin:24px 0 8px}
+.meta{color:#666;margin-bottom:16px}
+table{border-collapse:collapse;width:100%}th,td{border:1px solid #ccc;padding:5px 7px}
+th{background:#f3f3f3;text-align:left}td.so{text-align:right;white-space:nowrap}
+.tong{margin-top:16px;font-size:14px}.tong td{border:none;padding:3px 8px}.tong td.so{font-weight:bold}
+@media print{body{margin:12mm}a{display:none}}
+</style></head><body>
+<h1>$title</h1>
+<div class="meta">Kỳ: tháng $period &middot; Lập ngày $created</div>
+$body
+</body></html>
+""")
+_SECTION = Template("<h2>$heading</h2>\n$table")
+_INDEX_ROW = Template('<tr><td>$kind</td><td><a href="$file">$name</a></td><td class="so">$total</td></tr>')
+
+
+# --- Dựng HTML (chạy trong tiến trình con) ---
+def _cell(col, val):
+    if col in MONEY_COLUMNS: return f'<td class="so">{html.escape(fmt_vnd(val))}</td>'
+    return f"<td>{html.escape('' if val is None else str(val))}</td>"
+
+
+def _table(columns, rows):
+    if not rows: return "<p><i>Không có.</i></p>"
+    head = "".join(f"<th>{html.escape(c)}</th>" for c in columns)
+    body = "\n".join("<tr>" + "".join(_cell(c, v) for c, v in zip(columns, r)) + "</tr>" for r in rows)
+    return f"<table><thead><tr>{head}</tr></thead><tbody>\n{body}\n</tbody></table>"
+
+
+def _totals(items):
+    rows = "".join(f'<tr><td>{html.escape(k)}</td><td class="so">{html.escape(fmt_vnd(v))}</td></tr>' for k, v in items)
+    return f'<table class="tong">{rows}</table>'
+
+
+def render(stmt):
+    # Một bảng kê (dict thuần, gửi qua được tiến trình) -> (tên file, nội dung HTML dạng bytes)
+    sections = [_SECTION.substitute(heading=h, table=_table(cols, rows)) for h, cols, rows in stmt['sections']]
+    page = _PAGE.substitute(
+        title=html.escape(f"Bảng kê {KIND_LABELS[stmt['kind']].lower()}: {stmt['name']}"),
+        period=stmt['period'], created=stmt['created'],
+        body="\n".join(sections) + _totals(stmt['totals']))
+    return stmt['file'], page.encode('utf-8')
+
+
+def render_batch(stmts):
+    return [render(s) for s in stmts]
+
+
+# --- Chuẩn bị dữ liệu (tiến trình chính) ---
+def _slug(text):
+    text = unicodedata.normalize('NFD', str(text)).replace('đ', 'd').replace('Đ', 'D')
+    text = ''.join(ch for ch in text if unicodedata.category(ch) != 'Mn')
+    return re.sub(r'[^A-Za-z0-9]+', '-', text).strip('-').lower() or "khong-ten"
+
+
+def _text_dates(df, cols):
+    out = df.copy()
+    for c in cols: out[c] = out[c].map(fmt_date)
+    return out
+
+
+def _month(year, month):
+    starts, ends = accrual.month_bounds(year, [month])
+    return starts, ends, starts[0], ends[0]
+
+
+def _records(df, columns):
+    return df[columns].astype(object).where(df[columns].notna(), None).values.tolist()
+
+
+def _groups(df, key):
+    # Tên -> vị trí các dòng của người đó (df đã sắp theo tên), một lần gom nhóm cho cả bảng
+    return df.groupby(key, sort=False).indices.items()
+
+
+def owner_statements(df_main, stages, year, month, created):
+    # Một bảng kê cho mỗi "Chủ nhà - sale" có HĐ chủ còn hiệu lực trong tháng
+    starts, ends, start, end = _month(year, month)
+    if df_main.empty: return []
+    own = df_main[(df_main['Ngày ký'] <= end) & (df_main['Ngày hết HĐ'] >= start)]
+    own = own[own['Chủ nhà - sale'].fillna('').astype(str).str.strip() != '']
+    # Mỗi dòng thuê lặp lại HĐ chủ -> mỗi HĐ (Toà, Mã căn, Ngày ký) lấy một lần
+    own = own.drop_duplicates(['Toà', 'Mã căn', 'Ngày ký'])
+    if own.empty: return []
+    acc = accrual.accrue_contracts(own, starts, ends, stages)
+    own = own.assign(**{
+        'Giá HĐ': stages.period_price(own, start) if stages is not None and len(stages) else own['Giá HĐ'],
+        'Số ngày': acc['cost_days'].iloc[:, 0].to_numpy(),
+        'Tiền tháng': acc['cost'].iloc[:, 0].round(0).to_numpy(),
+        'Chủ nhà - sale': own['Chủ nhà - sale'].astype(str).str.strip(),
+        'TT cho chủ nhà': pd.to_numeric(own['TT cho chủ nhà'], errors='coerce').fillna(0),
+        'Cọc cho chủ nhà': pd.to_numeric(own['Cọc cho chủ nhà'], errors='coerce').fillna(0),
+    }).sort_values(['Chủ nhà - sale', 'Toà', 'Mã căn']).reset_index(drop=True)
+    rows = _records(_text_dates(own, ['Ngày ký', 'Ngày hết HĐ']), OWNER_COLUMNS)
+    sums = own.groupby('Chủ nhà - sale', sort=False)[['Tiền tháng', 'TT cho chủ nhà', 'Cọc cho chủ nhà']].sum()
+    period = f"{month:02d}/{year}"
+    out = []
+    for name, pos in _groups(own, 'Chủ nhà - sale'):
+        tong = sums.loc[name]
+        out.append({
+            'kind': KIND_OWNER, 'name': name, 'period': period, 'created': created,
+            'file': f"{KIND_OWNER}/{_slug(name)}_{year}{month:02d}.html",
+            'sections': [("Hợp đồng chủ nhà trong tháng", OWNER_COLUMNS, [rows[i] for i in pos])],
+            'totals': [("Tiền HĐ của tháng (theo ngày)", float(tong['Tiền tháng'])),
+                       ("TT cho chủ nhà", float(tong['TT cho chủ nhà'])),
+                       ("Cọc cho chủ nhà", float(tong['Cọc cho chủ nhà']))],
+        })
+    return out
+
+
+def _stay_charges(df_cp, df_rooms, df_main, stays, start, end):
+    # Phí CHI_PHI trong tháng -> lượt thuê (cột _luot): cùng Mã căn, ngày phát sinh trong thời gian thuê,
+    # cùng Tòa (Tòa gán qua Mã căn); Mã căn có ở nhiều Tòa thì chỉ nhận khi đúng một lượt thuê khớp
+    if df_cp.empty: return pd.DataFrame(columns=CHARGE_COLUMNS + ['_luot'])
+    cp = df_cp[(df_cp['Ngày'] >= start) & (df_cp['Ngày'] <= end)]
+    if cp.empty: return pd.DataFrame(columns=CHARGE_COLUMNS + ['_luot'])
+    cp = cp.assign(**{'Toà CP': portfolio.cp_buildings(cp, df_rooms, df_main).to_numpy(),
+                      'Mã căn': cp['Mã căn'].astype(str), '_cp': range(len(cp))})
+    m = cp.merge(stays[['Toà', 'Mã căn', 'Ngày in', 'Ngày out', '_luot']].astype({'Mã căn': str}), on='Mã căn')
+    m = m[(m['Ngày'] >= m['Ngày in']) & (m['Ngày'] <= m['Ngày out'])
+          & ((m['Toà CP'] == m['Toà']) | (m['Toà CP'] == portfolio.CHUA_RO))]
+    m = m[~m['_cp'].duplicated(keep=False)]
+    m = m.assign(Tiền=pd.to_numeric(m['Tiền'], errors='coerce').fillna(0)).sort_values('Ngày')
+    return _text_dates(m.reindex(columns=CHARGE_COLUMNS + ['_luot']), ['Ngày'])
+
+
+def tenant_statements(df_main, df_cp, df_rooms, year, month, created):
+    # Một bảng kê cho mỗi "Tên khách thuê" có lượt thuê trong tháng, kèm phí CHI_PHI của các lượt thuê đó
+    starts, ends, start, end = _month(year, month)
+    if df_main.empty: return []
+    ten = df_main[(df_main['Ngày in'] <= end) & (df_main['Ngày out'] >= start)]
+    ten = ten[ten['Tên khách thuê'].fillna('').astype(str).str.strip() != '']
+    if ten.empty: return []
+    acc = accrual.accrue(ten, 'Ngày in', 'Ngày out', 'Giá', starts, ends)
+    ten = ten.assign(**{
+        'Số ngày': acc[1].iloc[:, 0].to_numpy(),
+        'Tiền thuê tháng': acc[0].iloc[:, 0].round(0).to_numpy(),
+        'Tên khách thuê': ten['Tên khách thuê'].astype(str).str.strip(),
+        'KH thanh toán': pd.to_numeric(ten['KH thanh toán'], errors='coerce').fillna(0),
+        'KH cọc': pd.to_numeric(ten['KH cọc'], errors='coerce').fillna(0),
+    }).sort_values(['Tên khách thuê', 'Toà', 'Mã căn', 'Ngày in']).reset_index(drop=True)
+    ten['_luot'] = range(len(ten))
+
+    charges = _stay_charges(df_cp, df_rooms, df_main, ten, start, end)
+    ten['Phí'] = charges.groupby('_luot')['Tiền'].sum().reindex(ten['_luot'], fill_value=0).to_numpy()
+    charge_rows = _records(charges, CHARGE_COLUMNS)
+    by_stay = {}
+    for i, luot in enumerate(charges['_luot']): by_stay.setdefault(luot, []).append(charge_rows[i])
+
+    rows = _records(_text_dates(ten, ['Ngày in', 'Ngày out']), TENANT_COLUMNS)
+    sums = ten.groupby('Tên khách thuê', sort=False)[['Tiền thuê tháng', 'Phí', 'KH thanh toán', 'KH cọc']].sum()
+    period = f"{month:02d}/{year}"
+    out = []
+    for name, pos in _groups(ten, 'Tên khách thuê'):
+        tong = sums.loc[name]
+        rent, fees = float(tong['Tiền thuê tháng']), float(tong['Phí'])
+        out.append({
+            'kind': KIND_TENANT, 'name': name, 'period': period, 'created': created,
+            'file': f"{KIND_TENANT}/{_slug(name)}_{year}{month:02d}.html",
+            'sections': [("Tiền thuê trong tháng", TENANT_COLUMNS, [rows[i] for i in pos]),
+                         ("Điện / nước / dịch vụ", CHARGE_COLUMNS, [r for i in pos for r in by_stay.get(i, [])])],
+            'totals': [("Tiền thuê của tháng (theo ngày)", rent), ("Điện / nước / dịch vụ", fees),
+                       ("Tổng phải trả", rent + fees),
+                       ("KH đã thanh toán", float(tong['KH thanh toán'])), ("KH cọc", float(tong['KH cọc']))],
+        })
+    return out
+
+
+def _dedupe_files(stmts):
+    # Hai người khác tên nhưng cùng tên file không dấu -> thêm số thứ tự (bản sao, không sửa danh sách dùng chung)
+    seen, out = {}, []
+    for s in stmts:
+        n = seen.get(s['file'], 0)
+        seen[s['file']] = n + 1
+        out.append({**s, 'file': s['file'].replace('.html', f"-{n + 1}.html")} if n else s)
+    return out
+
+
+def make_pool(max_workers=POOL_WORKERS):
+    # spawn: tiến trình con không thừa hưởng các luồng của app (fork trong tiến trình nhiều luồng dễ treo)
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def render_all(stmts, pool=None):
+    # [(tên file, bytes)] theo đúng thứ tự stmts; lô lớn chia đều cho các tiến trình của pool
+    if pool is None or len(stmts) < PARALLEL_MIN: return render_batch(stmts)
+    size = max(1, math.ceil(len(stmts) / (pool._max_workers * 4)))
+    chunks = [stmts[i:i + size] for i in range(0, len(stmts), size)]
+    return [f for part in pool.map(render_batch, chunks) for f in part]
+
+
+def build_zip(stmts, pool=None):
+    # File zip: mọi bảng kê + index.html (mục lục, tổng của từng bảng kê)
+    stmts = _dedupe_files(stmts)
+    files = render_all(stmts, pool)
+    rows = "\n".join(_INDEX_ROW.substitute(
+        kind=KIND_LABELS[s['kind']], file=html.escape(s['file']), name=html.escape(s['name']),
+        total=html.escape(fmt_vnd(s['totals'][0][1]))) for s in stmts)
+    index = _PAGE.substitute(
+        title="Mục lục bảng kê", period=stmts[0]['period'] if stmts else "", created=stmts[0]['created'] if stmts else "",
+        body=f"<table><thead><tr><th>Loại</th><th>Tên</th><th>Tiền tháng</th></tr></thead><tbody>{rows}</tbody></table>")
+    buf = io.BytesIO()
+    with zipfile.ZipFile(buf, 'w', zipfile.ZIP_DEFLATED) as z:
+        z.writestr("index.html", index.encode('utf-8'))
+        for name, data in files: z.writestr(name, data)
+    return buf.getvalue()
@@ -0,0 +1,370 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from datetime import datetime, timezone
+
+# ==============================================================================
+# KHO DỮ LIỆU (STORAGE BACKEND)
+# - gsheet : Google Sheets thật (MT60_DATABASE)
+# - sqlite : file SQLite cục bộ, cùng ngữ nghĩa worksheet như Google Sheets
+# - memory : SQLite trong RAM, dùng cho chạy thử / đo tải (loadtest.py)
+# Chọn qua biến môi trường MT60_STORAGE hoặc Streamlit Secrets "storage_backend".
+# ==============================================================================
+
+BACKEND_GSHEET = "gsheet"
+BACKEND_SQLITE = "sqlite"
+BACKEND_MEMORY = "memory"
+BACKENDS = [BACKEND_GSHEET, BACKEND_SQLITE, BACKEND_MEMORY]
+
+DEFAULT_SQLITE_PATH = "mt60_local.db"
+FETCH_CONCURRENCY = 4    # số worksheet đọc song song tối đa (tránh vượt hạn mức API của Sheets)
+
+
+def get_backend_config(secrets=None):
+    def _secret(key):
+        try:
+            return secrets[key] if secrets is not None and key in secrets else None
+        except Exception:
+            return None
+
+    kind = os.environ.get("MT60_STORAGE") or _secret("storage_backend") or BACKEND_GSHEET
+    kind = str(kind).strip().lower()
+    if kind not in BACKENDS:
+        raise ValueError(f"MT60_STORAGE không hợp lệ: {kind} (chọn một trong {BACKENDS})")
+    path = os.environ.get("MT60_SQLITE_PATH") or _secret("sqlite_path") or DEFAULT_SQLITE_PATH
+    return kind, path
+
+
+def get_spreadsheet_key(secrets=None):
+    # Mở theo key (ID trong URL) thay vì theo tên để khỏi tốn một lượt tìm kiếm trên Drive
+    key = os.environ.get("MT60_SPREADSHEET_KEY")
+    if key: return key
+    try:
+        if secrets is not None and "spreadsheet_key" in secrets: return secrets["spreadsheet_key"]
+    except Exception:
+        pass
+    return None
+
+
+def open_local_backend(kind, path=DEFAULT_SQLITE_PATH):
+    if kind == BACKEND_MEMORY: return SQLiteBackend(":memory:")
+    if kind == BACKEND_SQLITE: return SQLiteBackend(path)
+    raise ValueError(f"Không phải kho cục bộ: {kind}")
+
+
+def frame_to_values(df):
+    # Giống hệt cách save_data ghi lên Sheets: ô trống -> "", mọi giá trị -> chuỗi
+    df_save = df.fillna("").astype(str)
+    return [df_save.columns.values.tolist()] + df_save.values.tolist()
+
+
+def fetch_all(fetch, tab_names, max_workers=FETCH_CONCURRENCY):
+    # Đọc nhiều worksheet song song (giới hạn max_workers luồng) -> thời gian tổng ~ lượt đọc chậm nhất.
+    # Trả về ({tab: kết quả hoặc Exception}, {tab: số giây của từng lượt đọc})
+    def _timed(tab):
+        t0 = time.perf_counter()
+        try:
+            out = fetch(tab)
+        except Exception as e:
+            out = e
+        return out, time.perf_counter() - t0
+
+    tab_names = list(tab_names)
+    if not tab_names: return {}, {}
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(tab_names))), thread_name_prefix="mt60-fetch") as pool:
+        done = dict(zip(tab_names, pool.map(_timed, tab_names)))
+    return {t: r for t, (r, _) in done.items()}, {t: sec for t, (_, sec) in done.items()}
+
+
+def _numericise(value):
+    # Bắt chước gspread.utils.numericise (mặc định của get_all_records)
+    if not isinstance(value, str) or value == "" or "_" in value: return value
+    return _numericise_text(value)
+
+
+@lru_cache(maxsize=1 << 16)
+def _numericise_text(value):
+    # Ô chuỗi lặp lại rất nhiều (mã phòng, tên tòa, số tiền) -> nhớ kết quả, mỗi lần đọc lại / gộp không parse lại
+    cleaned = value.replace(",", "")
+    try: return int(cleaned)
+    except ValueError: pass
+    try: return float(cleaned)
+    except ValueError: return value
+
+
+def values_to_records(values):
+    if len(values) < 2: return []
+    header = values[0]
+    records = []
+    for row in values[1:]:
+        row = list(row) + [""] * (len(header) - len(row))
+        records.append({h: _numericise(v) for h, v in zip(header, row)})
+    return records
+
+
+class StorageBackend:
+    name = "base"
+
+    def worksheet_names(self): raise NotImplementedError
+    def get_all_values(self, tab_name): raise NotImplementedError
+    # Ghi đè toàn bộ worksheet (ghi tại chỗ, không qua trạng thái trống), tạo mới nếu chưa có
+    def update(self, tab_name, values): raise NotImplementedError
+    def append_rows(self, tab_name, rows): raise NotImplementedError
+
+    def get_all_records(self, tab_name):
+        return values_to_records(self.get_all_values(tab_name))
+
+    def values_or_empty(self, tab_name):
+        # Worksheet chưa có -> [] (lỗi khác như mất mạng vẫn ném ra, không coi là sheet trống)
+        try: return self.get_all_values(tab_name)
+        except KeyError: return []
+
+    # Ghi đè chỉ khi sheet vẫn đúng phiên bản expected (version_of: giá trị sheet -> phiên bản).
+    # Trả về (đã ghi, giá trị sheet đang có nếu chưa ghi) -> bên gọi gộp luôn, không phải đọc lại.
+    # Mặc định đọc - so - ghi: Sheets không có ghi có điều kiện nên còn một khe hở ngắn giữa lượt đọc và lượt ghi
+    def update_if_version(self, tab_name, values, expected, version_of):
+        current = self.values_or_empty(tab_name)
+        if version_of(current) != expected: return False, current
+        self.update(tab_name, values)
+        return True, None
+
+
+class GSheetBackend(StorageBackend):
+    name = BACKEND_GSHEET
+
+    def __init__(self, spreadsheet):
+        self.sh = spreadsheet
+        # Handle worksheet được giữ lại, không gọi sh.worksheet() mỗi lần đọc/ghi
+        self._wks = {}
+        self._wks_lock = threading.Lock()
+
+    def _worksheet(self, tab_name, create=False):
+        wks = self._wks.get(tab_name)
+        if wks is not None: return wks
+        with self._wks_lock:
+            if tab_name not in self._wks:
+                try:
+                    self._wks[tab_name] = self.sh.worksheet(tab_name)
+                except Exception:
+                    if not create: raise
+                    self._wks[tab_name] = self.sh.add_worksheet(title=tab_name, rows=100, cols=26)
+            return self._wks[tab_name]
+
+    def _call(self, tab_name, fn, create=False):
+        try:
+            return fn(self._worksheet(tab_name, create))
+        except Exception:
+            # Handle cũ có thể đã hỏng (worksheet bị xóa / đổi tên) -> bỏ khỏi cache
+            self._wks.pop(tab_name, None)
+            raise
+
+    def worksheet_names(self):
+        with self._wks_lock:
+            self._wks = {w.title: w for w in self.sh.worksheets()}
+            return list(self._wks)
+
+    def get_all_values(self, tab_name):
+        return self._call(tab_name, lambda w: w.get_all_values())
+
+    def get_all_records(self, tab_name):
+        return self._call(tab_name, lambda w: w.get_all_records())
+
+    def values_or_empty(self, tab_name):
+        from gspread.exceptions import WorksheetNotFound
+        try: return self.get_all_values(tab_name)
+        except WorksheetNotFound: return []
+
+    def update(self, tab_name, values):
+        # Ghi đè tại chỗ, không clear trước: người đọc giữa chừng không bao giờ thấy sheet trống.
+        # Một lượt update phủ cả lưới cũ (phần thừa ghi ô trống) rồi mới thu nhỏ lưới về đúng cỡ dữ liệu
+        n_rows = max(len(values), 1)
+        n_cols = max((len(r) for r in values), default=1) or 1
+        def _write(wks):
+            rows, cols = max(n_rows, wks.row_count), max(n_cols, wks.col_count)
+            if rows > wks.row_count or cols > wks.col_count: wks.resize(rows=rows, cols=cols)
+            grid = [list(r) + [""] * (cols - len(r)) for r in values] + [[""] * cols for _ in range(rows - len(values))]
+            wks.update(grid, "A1")
+            if rows > n_rows or cols > n_cols: wks.resize(rows=n_rows, cols=n_cols)
+        self._call(tab_name, _write, create=True)
+
+    def append_rows(self, tab_name, rows):
+        self._call(tab_name, lambda w: w.append_rows(rows), create=True)
+
+
+# ==============================================================================
+# QUẢN LÝ CLIENT GOOGLE DÙNG CHUNG TOÀN TIẾN TRÌNH
+# - Một bộ credentials (google-auth) + một HTTP session keep-alive cho mỗi service account
+# - Token được làm mới nền trước khi hết hạn -> lần tải đầu sau khi nghỉ không phải chờ xác thực
+# - Spreadsheet mở theo key và được dùng lại giữa các phiên
+# ==============================================================================
+
+GOOGLE_SCOPES = ["https://www.googleapis.com/auth/spreadsheets", "https://www.googleapis.com/auth/drive"]
+
+
+class _ClientEntry:
+    def __init__(self, creds, session, client):
+        self.creds = creds
+        self.session = session
+        self.client = client
+        self.refresh_lock = threading.Lock()
+
+
+class GSheetClientManager:
+    REFRESH_MARGIN = 300    # làm mới token trước khi hết hạn 5 phút
+    POOL_SIZE = 16
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._clients = {}
+        self._backends = {}
+        self._keys_by_name = {}
+
+    @staticmethod
+    def _fingerprint(creds_dict):
+        return (creds_dict.get("client_email"), creds_dict.get("private_key_id"))
+
+    def _refresh(self, entry):
+        from google.auth.transport.requests import Request
+        with entry.refresh_lock:
+            entry.creds.refresh(Request(session=entry.session))
+
+    def _refresh_loop(self, entry):
+        while True:
+            expiry = entry.creds.expiry
+            if expiry is None:
+                wait = self.REFRESH_MARGIN
+            else:
+                now = datetime.now(timezone.utc).replace(tzinfo=None)
+                wait = (expiry - now).total_seconds() - self.REFRESH_MARGIN
+            time.sleep(max(wait, 30))
+            try:
+                self._refresh(entry)
+            except Exception:
+                time.sleep(60)
+
+    def _create_client(self, creds_dict):
+        import gspread
+        import requests
+        from google.oauth2.service_account import Credentials
+        from google.auth.transport.requests import AuthorizedSession
+
+        creds_dict = dict(creds_dict)
+        if 'private_key' in creds_dict:
+            creds_dict['private_key'] = creds_dict['private_key'].replace('\\\\n', '\n').replace('\\n', '\n')
+        creds = Credentials.from_service_account_info(creds_dict, scopes=GOOGLE_SCOPES)
+
+        session = AuthorizedSession(creds)
+        adapter = requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=self.POOL_SIZE, max_retries=2)
+        session.mount("https://", adapter)
+
+        entry = _ClientEntry(creds, session, gspread.Client(auth=creds, session=session))
+        self._refresh(entry)
+        threading.Thread(target=self._refresh_loop, args=(entry,), daemon=True, name="mt60-token-refresh").start()
+        return entry
+
+    def get_client(self, creds_dict):
+        fp = self._fingerprint(creds_dict)
+        with self._lock:
+            if fp not in self._clients:
+                self._clients[fp] = self._create_client(creds_dict)
+            return self._clients[fp].client
+
+    def open(self, creds_dict, spreadsheet_key=None, spreadsheet_name=None):
+        client = self.get_client(creds_dict)
+        fp = self._fingerprint(creds_dict)
+        key = spreadsheet_key or self._keys_by_name.get(spreadsheet_name)
+        with self._lock:
+            if key and (fp, key) in self._backends: return self._backends[(fp, key)]
+        if key:
+            spreadsheet = client.open_by_key(key)
+        else:
+            # Chưa cấu hình key: tìm theo tên đúng một lần rồi nhớ lại key
+            spreadsheet = client.open(spreadsheet_name)
+            key = spreadsheet.id
+            self._keys_by_name[spreadsheet_name] = key
+        with self._lock:
+            return self._backends.setdefault((fp, key), GSheetBackend(spreadsheet))
+
+
+_client_manager = None
+_client_manager_lock = threading.Lock()
+
+def get_client_manager():
+    global _client_manager
+    with _client_manager_lock:
+        if _client_manager is None: _client_manager = GSheetClientManager()
+        return _client_manager
+
+
+class SQLiteBackend(StorageBackend):
+    name = BACKEND_SQLITE
+
+    def __init__(self, path=":memory:"):
+        if path == ":memory:": self.name = BACKEND_MEMORY
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("CREATE TABLE IF NOT EXISTS worksheets (name TEXT PRIMARY KEY)")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS cells ("
+                " sheet TEXT NOT NULL, row_no INTEGER NOT NULL, data TEXT NOT NULL,"
+                " PRIMARY KEY (sheet, row_no))"
+            )
+
+    @staticmethod
+    def _encode(row):
+        return json.dumps(["" if v is None else str(v) for v in row], ensure_ascii=False)
+
+    def _exists(self, tab_name):
+        cur = self._conn.execute("SELECT 1 FROM worksheets WHERE name = ?", (tab_name,))
+        return cur.fetchone() is not None
+
+    def worksheet_names(self):
+        with self._lock:
+            return [r[0] for r in self._conn.execute("SELECT name FROM worksheets ORDER BY rowid")]
+
+    def _read(self, tab_name):
+        cur = self._conn.execute("SELECT data FROM cells WHERE sheet = ? ORDER BY row_no", (tab_name,))
+        return [json.loads(r[0]) for r in cur]
+
+    def _write(self, tab_name, values):
+        self._conn.execute("INSERT OR IGNORE INTO worksheets (name) VALUES (?)", (tab_name,))
+        self._conn.execute("DELETE FROM cells WHERE sheet = ?", (tab_name,))
+        self._conn.executemany(
+            "INSERT INTO cells (sheet, row_no, data) VALUES (?, ?, ?)",
+            [(tab_name, i, self._encode(row)) for i, row in enumerate(values)]
+        )
+
+    def get_all_values(self, tab_name):
+        with self._lock:
+            if not self._exists(tab_name):
+                raise KeyError(f"Không tìm thấy worksheet: {tab_name}")
+            return self._read(tab_name)
+
+    def update(self, tab_name, values):
+        with self._lock, self._conn:
+            self._write(tab_name, values)
+
+    def update_if_version(self, tab_name, values, expected, version_of):
+        # Đọc - so - ghi trong một giao dịch BEGIN IMMEDIATE: tiến trình khác dùng chung file không chen vào giữa
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            current = self._read(tab_name) if self._exists(tab_name) else []
+            if version_of(current) != expected: return False, current
+            self._write(tab_name, values)
+            return True, None
+
+    def append_rows(self, tab_name, rows):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR IGNORE INTO worksheets (name) VALUES (?)", (tab_name,))
+            cur = self._conn.execute("SELECT COALESCE(MAX(row_no), -1) FROM cells WHERE sheet = ?", (tab_name,))
+            start = cur.fetchone()[0] + 1
+            self._conn.executemany(
+                "INSERT INTO cells (sheet, row_no, data) VALUES (?, ?, ?)",
+                [(tab_name, start + i, self._encode(row)) for i, row in enumerate(rows)]
+            )